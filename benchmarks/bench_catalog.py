@@ -0,0 +1,63 @@
+# benchmarks/bench_catalog.py
+"""
+Article lookup latency: unindexed query (old schema), indexed query, and the
+in-process catalog cache.
+
+    python benchmarks/bench_catalog.py [--articles 20000] [--lookups 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def _report(label, lookups, elapsed):
+    print(f"{label:<18} {elapsed / lookups * 1e6:9.1f} µs/lookup  {lookups / elapsed:10.0f} lookups/s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--options", type=int, default=3)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "products.db")
+    import whatsapp_db
+    from whatsapp_catalog import CatalogCache
+
+    whatsapp_db.init_db()
+    whatsapp_db.executemany(
+        "INSERT INTO products (main_product, option, image, description, mrp, category) VALUES (?, ?, ?, ?, ?, ?)",
+        [(str(10000 + a), f"opt{o}", f"https://img/{a}/{o}.jpg", f"Article {a}", "499", "slippers")
+         for a in range(args.articles) for o in range(args.options)],
+    )
+    keys = [str(10000 + random.randrange(args.articles + args.articles // 10)) for _ in range(args.lookups)]
+    query = "SELECT image, description FROM products WHERE main_product=?"
+
+    whatsapp_db.execute("DROP INDEX idx_products_main_product")
+    start = time.perf_counter()
+    for k in keys:
+        whatsapp_db.fetchall(query, (k,))
+    _report("no index (before)", len(keys), time.perf_counter() - start)
+
+    whatsapp_db.execute("CREATE INDEX idx_products_main_product ON products (main_product)")
+    start = time.perf_counter()
+    for k in keys:
+        whatsapp_db.fetchall(query, (k,))
+    _report("indexed query", len(keys), time.perf_counter() - start)
+
+    cache = CatalogCache()
+    cache.load()
+    start = time.perf_counter()
+    for k in keys:
+        cache.lookup(k)
+    _report("catalog cache", len(keys), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# benchmarks/bench_db.py
+"""
+Compares the webhook's database work per inbound message using the old
+connect-per-call helpers against the shared whatsapp_db connection layer.
+
+    python benchmarks/bench_db.py [--calls 5000] [--threads 4]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def _seed(db_path, articles=500, options=4):
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO products (main_product, option, image, description, mrp, category) VALUES (?, ?, ?, ?, ?, ?)",
+        [(str(2000 + a), f"opt{o}", f"https://img/{a}/{o}.jpg", f"Article {a} option {o}", "499", "slippers")
+         for a in range(articles) for o in range(options)],
+    )
+    conn.commit()
+    conn.close()
+
+
+# ====== Old code path: one sqlite3.connect per helper ======
+def legacy_webhook_call(db_path, msg_id, user_id, article):
+    conn = sqlite3.connect(db_path)
+    exists = conn.execute("SELECT id FROM processed_messages WHERE id = ?", (msg_id,)).fetchone()
+    conn.close()
+    if exists:
+        return
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT OR IGNORE INTO processed_messages (id) VALUES (?)", (msg_id,))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("SELECT state, last_updated FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+    conn.close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("SELECT image, description FROM products WHERE main_product=?", (article,)).fetchall()
+    conn.close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("REPLACE INTO user_state (user_id, state, last_updated) VALUES (?, ?, ?)",
+                 (user_id, "awaiting_article", int(time.time())))
+    conn.commit()
+    conn.close()
+
+
+# ====== New code path: whatsapp_db shared connection ======
+def pooled_webhook_call(db, msg_id, user_id, article):
+    if db.fetchone("SELECT id FROM processed_messages WHERE id = ?", (msg_id,)):
+        return
+    db.execute("INSERT OR IGNORE INTO processed_messages (id) VALUES (?)", (msg_id,))
+    db.fetchone("SELECT state, last_updated FROM user_state WHERE user_id = ?", (user_id,))
+    db.fetchall("SELECT image, description FROM products WHERE main_product=?", (article,))
+    db.execute("REPLACE INTO user_state (user_id, state, last_updated) VALUES (?, ?, ?)",
+               (user_id, "awaiting_article", int(time.time())))
+
+
+def _run(label, fn, calls, threads):
+    per_thread = calls // threads
+
+    def worker(t):
+        for i in range(per_thread):
+            fn(f"{label}-{t}-{i}", f"91{t:04d}{i % 50:04d}", str(2000 + i % 500))
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+    elapsed = time.perf_counter() - start
+    total = per_thread * threads
+    print(f"{label:<8} {total:>7} calls  {elapsed:7.2f}s  {total / elapsed:9.0f} webhook calls/s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DB_PATH"] = os.path.join(tmp, "products.db")
+    import whatsapp_db
+
+    whatsapp_db.init_db()
+    _seed(whatsapp_db.DB_PATH)
+
+    _run("legacy", lambda m, u, a: legacy_webhook_call(whatsapp_db.DB_PATH, m, u, a), args.calls, args.threads)
+    _run("pooled", lambda m, u, a: pooled_webhook_call(whatsapp_db, m, u, a), args.calls, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# benchmarks/bench_export.py
+"""
+Peak memory of the catalog export paths. Each mode runs in its own child
+process so max RSS is not shared between them.
+
+    python benchmarks/bench_export.py [--rows 200000]
+
+Modes:
+  pandas  - the old /export_excel (read_sql_query -> DataFrame -> BytesIO xlsx)
+  xlsx    - chunked cursor -> XlsxWriter constant_memory -> temp file
+  csv     - chunked cursor -> CSV chunks
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+
+def _seed(rows):
+    import whatsapp_db
+
+    whatsapp_db.init_db()
+    whatsapp_db.executemany(
+        "INSERT INTO products (main_product, option, image, description, mrp, category) VALUES (?, ?, ?, ?, ?, ?)",
+        [(str(10000 + i // 4), f"opt{i % 4}", f"https://res.cloudinary.com/demo/{i}.jpg",
+          f"Comfort slipper article {i} with cushioned sole", "499", "slippers") for i in range(rows)],
+    )
+
+
+def _run_mode(mode):
+    import whatsapp_db
+
+    start = time.perf_counter()
+    size = 0
+    if mode == "pandas":
+        from io import BytesIO
+        import pandas as pd
+
+        df = pd.read_sql_query(
+            "SELECT id, main_product, option, description, mrp, category FROM products", whatsapp_db.get_conn()
+        )
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False, sheet_name="Products")
+        size = len(output.getvalue())
+    else:
+        import whatsapp_export as ex
+
+        cols = list(ex.DEFAULT_EXPORT_COLUMNS)
+        if mode == "xlsx":
+            body = ex.stream_file(ex.write_xlsx(cols, ex.iter_rows(cols)))
+        else:
+            body = ex.stream_csv(cols, ex.iter_rows(cols))
+        for chunk in body:
+            size += len(chunk)
+
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:<7} {elapsed:7.2f}s  peak RSS {peak_mb:8.1f} MB  output {size / 1e6:7.1f} MB", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--mode", choices=["pandas", "xlsx", "csv"])
+    args = parser.parse_args()
+
+    if args.mode:
+        _run_mode(args.mode)
+        return
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "products.db")
+    _seed(args.rows)
+    print(f"{args.rows} rows", flush=True)
+    for mode in ("pandas", "xlsx", "csv"):
+        subprocess.run([sys.executable, __file__, "--mode", mode], env=os.environ, check=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+# benchmarks/bench_load.py
+"""
+End-to-end load test: runs the Flask app from main.py with N workers against
+a temp DB_PATH and the local Graph API stand-in (mock_graph.py), replays
+realistic webhook traffic and reports throughput, latency percentiles and
+DB contention per worker count.
+
+    python benchmarks/bench_load.py [--workers 1,2,4] [--duration 10] [--concurrency 16]
+                                    [--latency-ms 50] [--error-rate 0.01] [--async]
+
+Traffic mix (weights via --mix): full conversations (hi -> 2 -> article ->
+unknown article -> 1), re-delivered duplicates, delivery status callbacks
+and batched webhooks with several entries/changes. Workers are gunicorn
+when it is installed (--server gunicorn), otherwise forked werkzeug servers
+sharing one listening socket.
+
+Latencies are measured at the client, so with --async they are ack times;
+DB figures come from each run's /metrics (summed over all workers) once
+the webhook queue has drained.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+ARTICLES = 500
+OPTIONS = 3
+
+
+# ====== Setup ======
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def _start_mock_graph(args):
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "mock_graph.py"), "--port", str(port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+         "--error-rate", str(args.error_rate), "--throttle-rate", str(args.throttle_rate)],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_for(url)
+    except RuntimeError:
+        proc.terminate()
+        raise
+    return proc, url
+
+
+def _app_env(tmp, graph_url, args):
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": tmp,
+        "DB_PATH": os.path.join(tmp, "products.db"),
+        "GRAPH_BASE_URL": graph_url,
+        "WHATSAPP_TOKEN": "bench",
+        "WHATSAPP_PHONE_ID": "bench",
+        "WEBHOOK_ASYNC": "1" if args.async_ else "0",
+        "LOG_LEVEL": "WARNING",
+        "METRICS_FLUSH_INTERVAL": "1",
+        "BACKUP_INTERVAL_MINUTES": "0",
+    })
+    if not args.real_limits:
+        # Measure the app, not Meta's send quotas.
+        for name in ("RATE_GLOBAL_PER_SEC", "RATE_GLOBAL_BURST", "RATE_RECIPIENT_PER_SEC", "RATE_RECIPIENT_BURST"):
+            env[name] = "1000000"
+    return env
+
+
+def _prepare_db(env):
+    subprocess.run([sys.executable, "-c", "import whatsapp_db; whatsapp_db.init_db()"],
+                   env=env, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    conn = sqlite3.connect(env["DB_PATH"])
+    conn.executemany(
+        "INSERT INTO products (main_product, option, image, description, mrp, category) VALUES (?, ?, ?, ?, ?, ?)",
+        [(str(2000 + a), f"opt{o}", f"https://img.example/{a}/{o}.jpg", f"Article {2000 + a} option {o}",
+          "499", "slippers") for a in range(ARTICLES) for o in range(OPTIONS)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def _start_gunicorn(workers, port, env, args):
+    return [subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(args.threads),
+         "-b", f"127.0.0.1:{port}", "--log-level", "warning", "main:app"],
+        env=env, cwd=ROOT, stdout=subprocess.DEVNULL,
+    )]
+
+
+def _serve_werkzeug(sock, env):
+    os.environ.update(env)
+    os.chdir(ROOT)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import main
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    make_server("127.0.0.1", sock.getsockname()[1], main.app, threaded=True,
+                request_handler=QuietHandler, fd=sock.fileno()).serve_forever()
+
+
+def _start_werkzeug(workers, port, env, args):
+    # Prefork like gunicorn: one listening socket, N processes accepting on it.
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(1024)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_werkzeug(sock, env)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    sock.close()
+    return pids
+
+
+def _stop_workers(handles):
+    for h in handles:
+        if isinstance(h, int):
+            try:
+                os.kill(h, 15)
+                os.waitpid(h, 0)
+            except OSError:
+                pass
+        else:
+            h.terminate()
+            h.wait()
+
+
+# ====== Traffic ======
+def _envelope(messages=(), statuses=(), entries=1):
+    """Wraps messages or statuses in a webhook body, spread over ``entries`` entries."""
+    key, items = ("messages", list(messages)) if messages else ("statuses", list(statuses))
+    entry_list = []
+    for i in range(entries):
+        value = {"messaging_product": "whatsapp", "metadata": {"phone_number_id": "bench"},
+                 key: items[i::entries]}
+        entry_list.append({"id": "bench", "changes": [{"field": "messages", "value": value}]})
+    return {"object": "whatsapp_business_account", "entry": entry_list}
+
+
+def _text(sender, body):
+    return {"from": sender, "id": f"wamid.{uuid.uuid4().hex}", "timestamp": str(int(time.time())),
+            "type": "text", "text": {"body": body}}
+
+
+def _button(sender, title):
+    return {"from": sender, "id": f"wamid.{uuid.uuid4().hex}", "timestamp": str(int(time.time())),
+            "type": "interactive",
+            "interactive": {"type": "button_reply", "button_reply": {"id": "option_2", "title": title}}}
+
+
+class Client:
+    """One simulated traffic source; records (kind, latency, ok) per webhook POST."""
+
+    def __init__(self, base_url, cid, results):
+        self.url = base_url + "/webhook"
+        self.session = requests.Session()
+        self.cid = cid
+        self.results = results
+        self.senders = (f"9199{cid:04d}{n:04d}" for n in itertools.count())
+        self.last = None
+
+    def post(self, kind, payload, messages=0):
+        start = time.perf_counter()
+        try:
+            res = self.session.post(self.url, json=payload, timeout=30)
+            ok = res.status_code == 200 and res.text != "Error"
+        except requests.RequestException:
+            ok = False
+        self.results.append((kind, time.perf_counter() - start, ok, messages))
+        self.last = payload
+
+    def conversation(self):
+        sender = next(self.senders)
+        article = str(2000 + random.randrange(ARTICLES))
+        self.post("greeting", _envelope([_text(sender, "hi")]), 1)
+        self.post("option", _envelope([_button(sender, "2")]), 1)
+        self.post("article", _envelope([_text(sender, article)]), 1)
+        self.post("unknown_article", _envelope([_text(sender, "99" + article)]), 1)
+        self.post("menu", _envelope([_button(sender, "1")]), 1)
+
+    def duplicate(self):
+        if self.last is None:
+            return self.conversation()
+        self.post("duplicate", self.last, 0)
+
+    def status(self):
+        statuses = [{"id": f"wamid.{uuid.uuid4().hex}", "status": s, "timestamp": str(int(time.time())),
+                     "recipient_id": next(self.senders)} for s in ("sent", "delivered", "read")]
+        self.post("status", _envelope(statuses=statuses), 0)
+
+    def batch(self, size=6):
+        messages = [_text(next(self.senders), "hi") for _ in range(size)]
+        self.post("batch", _envelope(messages, entries=2), size)
+
+
+def _run_clients(base_url, args, weights):
+    results = []
+    stop_at = time.perf_counter() + args.duration
+    scenarios = list(weights)
+
+    def run(cid):
+        client = Client(base_url, cid, results)
+        actions = {"conversation": client.conversation, "duplicate": client.duplicate,
+                   "status": client.status, "batch": client.batch}
+        while time.perf_counter() < stop_at:
+            actions[random.choices(scenarios, weights=[weights[s] for s in scenarios])[0]]()
+
+    threads = [threading.Thread(target=run, args=(c,)) for c in range(args.concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+# ====== Reporting ======
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _histogram(metrics, name):
+    """Sums a histogram over all label sets: ({le: cumulative}, count, sum)."""
+    buckets, count, total = {}, 0, 0.0
+    for series, value in metrics.items():
+        base = series.split("{", 1)[0]
+        if base == f"{name}_bucket":
+            le = series.split('le="', 1)[1].split('"', 1)[0]
+            buckets[le] = buckets.get(le, 0) + value
+        elif base == f"{name}_count":
+            count += value
+        elif base == f"{name}_sum":
+            total += value
+    return buckets, count, total
+
+
+def _histogram_quantile(buckets, count, q):
+    target = q * count
+    for le, cumulative in sorted(((float(k), v) for k, v in buckets.items() if k != "+Inf")):
+        if cumulative >= target:
+            return le
+    return float("inf")
+
+
+def _fetch_metrics(base_url, args):
+    if args.async_:
+        # Wait for the webhook queue to drain so processed counts are final.
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            time.sleep(1.5)
+            data = requests.get(base_url + "/metrics?format=json", timeout=30).json()
+            if not data.get('queue_depth{queue="webhook"}'):
+                return data
+    time.sleep(1.5)  # every worker flushes once per METRICS_FLUSH_INTERVAL
+    return requests.get(base_url + "/metrics?format=json", timeout=30).json()
+
+
+def _report(workers, results, elapsed, metrics):
+    latencies = sorted(r[1] for r in results)
+    errors = sum(1 for r in results if not r[2])
+    messages = sum(r[3] for r in results)
+    db_buckets, db_count, db_total = _histogram(metrics, "db_statement_seconds")
+    tx_buckets, tx_count, _ = _histogram(metrics, "db_transaction_seconds")
+    slow = db_count - sum(v for k, v in db_buckets.items() if k == "0.025")
+    graph_calls = sum(v for k, v in metrics.items() if k.startswith("graph_responses_total"))
+    return {
+        "workers": workers,
+        "requests": len(results),
+        "errors": errors,
+        "req_per_s": len(results) / elapsed,
+        "msg_per_s": messages / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "graph_calls": int(graph_calls),
+        "db_statements": int(db_count),
+        "db_avg_ms": db_total / db_count * 1000 if db_count else 0.0,
+        "db_p99_ms": _histogram_quantile(db_buckets, db_count, 0.99) * 1000,
+        "db_slow_pct": slow / db_count * 100 if db_count else 0.0,
+        "tx_p99_ms": _histogram_quantile(tx_buckets, tx_count, 0.99) * 1000,
+        "by_kind": {
+            kind: round(_percentile(sorted(r[1] for r in results if r[0] == kind), 0.95) * 1000, 1)
+            for kind in sorted({r[0] for r in results})
+        },
+    }
+
+
+def _print_table(rows):
+    header = (f"{'workers':>7} {'requests':>8} {'errors':>6} {'req/s':>8} {'msg/s':>8} {'p50 ms':>7} "
+              f"{'p95 ms':>7} {'p99 ms':>7} {'db avg':>7} {'db p99':>7} {'db>25ms':>7} {'tx p99':>7}")
+    print(header, flush=True)
+    for r in rows:
+        print(f"{r['workers']:>7} {r['requests']:>8} {r['errors']:>6} {r['req_per_s']:>8.0f} {r['msg_per_s']:>8.0f} "
+              f"{r['p50_ms']:>7.1f} {r['p95_ms']:>7.1f} {r['p99_ms']:>7.1f} {r['db_avg_ms']:>7.2f} "
+              f"{r['db_p99_ms']:>7.1f} {r['db_slow_pct']:>6.1f}% {r['tx_p99_ms']:>7.1f}", flush=True)
+    for r in rows:
+        print(f"  {r['workers']} worker(s) p95 by kind (ms):", r["by_kind"], flush=True)
+
+
+def _parse_mix(value):
+    weights = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts to compare")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--server", choices=("gunicorn", "werkzeug"), default=None)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per worker count")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent client connections")
+    parser.add_argument("--mix", default="conversation=6,duplicate=1,status=2,batch=1")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="mock Graph API latency")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--async", dest="async_", action="store_true", help="run with WEBHOOK_ASYNC=1")
+    parser.add_argument("--real-limits", action="store_true", help="keep the production send rate limits")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.server is None:
+        try:
+            import gunicorn  # noqa: F401
+            args.server = "gunicorn"
+        except ImportError:
+            args.server = "werkzeug"
+    start_workers = _start_gunicorn if args.server == "gunicorn" else _start_werkzeug
+    weights = _parse_mix(args.mix)
+
+    mock, graph_url = _start_mock_graph(args)
+    print(f"🧪 Mock Graph API at {graph_url} ({args.latency_ms:g}±{args.jitter_ms:g} ms, "
+          f"{args.error_rate:.0%} errors) | server={args.server} | async={args.async_}", flush=True)
+
+    rows = []
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            tmp = tempfile.mkdtemp(prefix="bench-load-")
+            env = _app_env(tmp, graph_url, args)
+            _prepare_db(env)
+            port = _free_port()
+            handles = start_workers(workers, port, env, args)
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                _wait_for(base_url + "/health", timeout=60)
+                time.sleep(1.0)  # let every worker finish importing
+                results, elapsed = _run_clients(base_url, args, weights)
+                rows.append(_report(workers, results, elapsed, _fetch_metrics(base_url, args)))
+                print(f"✅ {workers} worker(s): {len(results)} requests in {elapsed:.1f}s", flush=True)
+            finally:
+                _stop_workers(handles)
+                shutil.rmtree(tmp, ignore_errors=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    _print_table(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
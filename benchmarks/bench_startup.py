@@ -0,0 +1,120 @@
+# benchmarks/bench_startup.py
+"""
+Measures worker cold-start cost: how long `import main` takes in a fresh
+interpreter, on a brand-new database (migrations run) and on an existing one,
+and which heavy optional dependencies got loaded along the way.
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 15] [--json startup.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Only the admin/export routes need these; a webhook worker should not.
+HEAVY_MODULES = ("PIL", "cloudinary", "openpyxl", "xlsxwriter", "pandas")
+
+CHILD = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print("BENCH " + json.dumps({{
+    "import_ms": elapsed * 1000,
+    "modules": len(sys.modules),
+    "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}), flush=True)
+"""
+
+
+def _env(tmp):
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": tmp,
+        "DB_PATH": os.path.join(tmp, "products.db"),
+        "LOG_LEVEL": "WARNING",
+        "BACKUP_INTERVAL_MINUTES": "0",
+    })
+    return env
+
+
+def _run_child(env, extra_args=()):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, *extra_args, "-c", CHILD], env=env, cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    wall = (time.perf_counter() - start) * 1000
+    line = next(l for l in proc.stdout.splitlines() if l.startswith("BENCH "))
+    result = json.loads(line[len("BENCH "):])
+    result["process_ms"] = wall
+    return result, proc.stderr
+
+
+def _import_profile(env, top):
+    """Top modules by cumulative import time, from python -X importtime."""
+    _, stderr = _run_child(env, ("-X", "importtime"))
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, raw_name = line[len("import time:"):].split("|")
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        if depth <= 1:  # main itself and what it imports directly
+            rows.append((int(cumulative_us), int(self_us), "  " * depth + raw_name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def _summary(label, results):
+    imports = [r["import_ms"] for r in results]
+    processes = [r["process_ms"] for r in results]
+    print(f"{label:<6} import main: median {statistics.median(imports):7.1f} ms  "
+          f"min {min(imports):7.1f} ms  | whole process median {statistics.median(processes):7.1f} ms  "
+          f"| {results[-1]['modules']} modules | heavy loaded: {', '.join(results[-1]['heavy']) or 'none'}",
+          flush=True)
+    return {"import_ms_median": statistics.median(imports), "import_ms_min": min(imports),
+            "process_ms_median": statistics.median(processes), "modules": results[-1]["modules"],
+            "heavy": results[-1]["heavy"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="modules to list from -X importtime")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    cold, warm = [], []
+    for _ in range(args.runs):
+        tmp = tempfile.mkdtemp(prefix="bench-startup-")
+        try:
+            env = _env(tmp)
+            cold.append(_run_child(env)[0])   # fresh database: every migration runs
+            warm.append(_run_child(env)[0])   # same database: schema already current
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {"cold": _summary("cold", cold), "warm": _summary("warm", warm)}
+
+    tmp = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        profile = _import_profile(_env(tmp), args.top)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"\n{'cumulative ms':>13} {'self ms':>8}  module", flush=True)
+    for cumulative_us, self_us, name in profile:
+        print(f"{cumulative_us / 1000:>13.1f} {self_us / 1000:>8.1f}  {name}", flush=True)
+    report["top_imports"] = [{"module": n, "cumulative_ms": c / 1000} for c, _, n in profile]
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# benchmarks/mock_graph.py
+"""
+Local stand-in for graph.facebook.com's /messages endpoint.
+
+    python benchmarks/mock_graph.py --port 8765 --latency-ms 80 --error-rate 0.02
+
+Point the bot at it with GRAPH_BASE_URL=http://127.0.0.1:8765.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockGraphServer:
+    """Threaded HTTP server that answers like the Cloud API messages endpoint."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0,
+                 error_rate=0.0, throttle_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.lock = threading.Lock()
+        self.requests = []
+        self.status_counts = {}
+        self.peers = set()      # client (host, port) pairs, i.e. distinct connections
+        self._scripted = []     # statuses to answer with before rolling the dice
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def script(self, *statuses):
+        """Answers the next requests with these statuses (e.g. 429, 500), in order."""
+        with self.lock:
+            self._scripted.extend(statuses)
+
+    @property
+    def hits(self):
+        """Requests answered so far, whatever their status."""
+        with self.lock:
+            return sum(self.status_counts.values())
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                delay = server.latency_ms + random.uniform(0, server.jitter_ms)
+                if delay:
+                    time.sleep(delay / 1000)
+
+                with server.lock:
+                    server.peers.add(self.client_address)
+                    scripted = server._scripted.pop(0) if server._scripted else None
+                roll = random.random()
+                if scripted is not None and scripted != 200:
+                    status, reply = scripted, {"error": {"message": "Scripted failure", "code": scripted}}
+                elif scripted is None and roll < server.throttle_rate:
+                    status, reply = 429, {"error": {"message": "Rate limit hit", "code": 130429}}
+                elif scripted is None and roll < server.throttle_rate + server.error_rate:
+                    status, reply = 500, {"error": {"message": "Service unavailable", "code": 2}}
+                else:
+                    try:
+                        payload = json.loads(body or b"{}")
+                    except ValueError:
+                        payload = {}
+                    status = 200
+                    reply = {
+                        "messaging_product": "whatsapp",
+                        "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+                        "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}],
+                    }
+                    with server.lock:
+                        server.requests.append(payload)
+
+                with server.lock:
+                    server.status_counts[status] = server.status_counts.get(status, 0) + 1
+
+                data = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (read timeout)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = MockGraphServer(args.host, args.port, args.latency_ms, args.jitter_ms,
+                             args.error_rate, args.throttle_rate)
+    print(f"🧪 Mock Graph API listening on {server.base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,32 @@
 # main.py
 import os
-from flask import Flask, send_file, request
+from flask import Flask, Response, request
 
-from whatsapp_chatbot import handle_webhook
+from whatsapp_chatbot import handle_webhook, message_queue
 from whatsapp_orders import register_order_routes
 from whatsapp_admin import register_admin_routes
+from whatsapp_backup import snapshot_response
+from whatsapp_catalog import catalog
+import whatsapp_db
+from whatsapp_db import DB_PATH
+from whatsapp_dedup import dedup
+from whatsapp_delivery import delivery
+from whatsapp_flows import flows
+from whatsapp_graph import graph
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+from whatsapp_outbox import outbox
+from whatsapp_ratelimit import limiter
+from whatsapp_state import state_cache
 
 app = Flask(__name__)
 app.secret_key = "walkmate-secret-key"
 
+# ===============================
+# Schema (migrations run once, before any route touches the DB)
+# ===============================
+whatsapp_db.init_db()
+
 # ===============================
 # Register routes from other modules
 # ===============================
@@ -24,7 +42,6 @@ def download_db_temp():
     token = request.args.get("token")
 
     BACKUP_TOKEN = os.getenv("BACKUP_TOKEN", "WalkBack2025")
-    DB_PATH = os.getenv("DB_PATH", "/data/products.db")
 
     if token != BACKUP_TOKEN:
         return "Unauthorized", 403
@@ -32,11 +49,7 @@ def download_db_temp():
     if not os.path.exists(DB_PATH):
         return f"Database not found at {DB_PATH}", 404
 
-    return send_file(
-        DB_PATH,
-        as_attachment=True,
-        download_name="products_backup.db"
-    )
+    return snapshot_response("products_backup.db")
 
 # ===============================
 # Default home route
@@ -52,19 +65,37 @@ def index():
 def health():
     return {
         "status": "ok",
-        "routes": ["/", "/webhook", "/send-template", "/send-shipment", "/admin"],
-        "env_loaded": bool(os.getenv("WHATSAPP_TOKEN"))
+        "routes": ["/", "/webhook", "/send-template", "/send-template-bulk", "/send-shipment", "/send-shipment-batch", "/admin", "/metrics"],
+        "env_loaded": bool(os.getenv("WHATSAPP_TOKEN")),
+        "queue": message_queue.stats(),
+        "state_cache": state_cache.stats(),
+        "dedup": dedup.stats(),
+        "catalog": catalog.stats(),
+        "flows": flows.stats(),
+        "graph": graph.stats(),
+        "outbox": outbox.stats(),
+        "delivery": delivery.stats(),
+        "rate_limit": limiter.stats()
     }, 200
 
+# ===============================
+# Metrics (Prometheus text, or ?format=json)
+# ===============================
+@app.get("/metrics")
+def metrics_endpoint():
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.args.get("token") != token:
+        return "Unauthorized", 403
+
+    if request.args.get("format") == "json":
+        return metrics.render_json(), 200
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 # ===============================
 # Entry point
 # ===============================
 if __name__ == "__main__":
-    print(
-        "🚀 Walkmate WhatsApp Bot running on port",
-        os.environ.get("PORT", 5000),
-        flush=True
-    )
+    get_logger("main").info("🚀 Walkmate WhatsApp Bot running", extra={"port": os.environ.get("PORT", 5000)})
     app.run(
         host="0.0.0.0",
         port=int(os.environ.get("PORT", 5000)),
@@ -0,0 +1,49 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from mock_graph import MockGraphServer  # noqa: E402
+
+# Everything reads its config at import time, so the scratch DB and the
+# Graph API stand-in have to be in place before the app is imported.
+_tmp = tempfile.mkdtemp(prefix="walkmate-tests-")
+_graph = MockGraphServer().start()
+os.environ.update({
+    "DATA_DIR": _tmp,
+    "DB_PATH": os.path.join(_tmp, "test.db"),
+    "UPLOAD_DIR": os.path.join(_tmp, "uploads"),
+    "GRAPH_BASE_URL": _graph.base_url,
+    "WHATSAPP_PHONE_ID": "123",
+    "WEBHOOK_ASYNC": "0",
+    "OUTBOX_BACKOFF_BASE": "0.1",
+    "OUTBOX_POLL_INTERVAL": "0.1",
+    "LOG_LEVEL": "WARNING",
+})
+
+
+@pytest.fixture(scope="session")
+def app():
+    import main
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def graph_server():
+    """The stand-in the app sends to; its request log starts empty for each test."""
+    with _graph.lock:
+        _graph.requests.clear()
+        _graph.status_counts.clear()
+    _graph.error_rate = _graph.throttle_rate = 0.0
+    return _graph
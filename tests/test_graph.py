@@ -0,0 +1,151 @@
+# tests/test_graph.py
+"""GraphClient against the local stand-in (benchmarks/mock_graph.py)."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mock_graph import MockGraphServer
+from whatsapp_graph import CIRCUIT_OPEN, CircuitBreaker, GraphClient
+
+
+@pytest.fixture
+def server():
+    srv = MockGraphServer().start()
+    yield srv
+    srv.stop()
+
+
+def client(**kwargs):
+    kwargs.setdefault("timeout", (2, 2))
+    kwargs.setdefault("backoff", 0)
+    return GraphClient(**kwargs)
+
+
+def url(server):
+    return f"{server.base_url}/v21.0/123/messages"
+
+
+def test_sends_share_pooled_connections(server):
+    server.latency_ms = 20
+    graph = client(pool_size=4)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda i: graph.post(url(server), {"to": str(i)}), range(40)))
+
+    assert [code for _, code in results] == [200] * 40
+    assert len(server.requests) == 40
+    assert len(server.peers) <= 4
+    assert graph.stats()["calls"] == 40
+
+
+def test_429_is_retried(server):
+    server.script(429, 429)
+    graph = client(max_retries=3)
+
+    data, code = graph.post(url(server), {"to": "1"})
+
+    assert code == 200
+    assert data["messages"][0]["id"].startswith("wamid.")
+    assert server.hits == 3
+    assert graph.stats()["retries"] == 2
+
+
+def test_429_gives_up_after_max_retries(server):
+    server.throttle_rate = 1.0
+    graph = client(max_retries=2)
+
+    _, code = graph.post(url(server), {"to": "1"})
+
+    assert code == 429
+    assert server.hits == 3
+
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_5xx_is_returned_without_resending(server, status):
+    server.script(status)
+    graph = client(max_retries=3)
+
+    _, code = graph.post(url(server), {"to": "1"})
+
+    assert code == status
+    assert server.hits == 1
+
+
+def test_read_timeout_sends_once(server):
+    server.latency_ms = 600
+    graph = client(timeout=(1, 0.2), max_retries=3)
+
+    start = time.perf_counter()
+    data, code = graph.post(url(server), {"to": "1"})
+    elapsed = time.perf_counter() - start
+
+    time.sleep(0.8)  # let the server finish the request it was still working on
+    assert code == 500 and "error" in data
+    assert elapsed < 0.6
+    assert server.hits == 1
+
+
+def test_connection_errors_are_retried_then_reported(server):
+    server.stop()
+    graph = client(max_retries=2)
+
+    data, code = graph.post(url(server), {"to": "1"})
+
+    assert code == 500
+    assert "Max retries exceeded" in data["error"]
+
+
+def test_breaker_opens_and_closes(server):
+    server.error_rate = 1.0
+    graph = client(max_retries=0)
+    graph.breaker = CircuitBreaker(threshold=3, cooldown=0.3)
+
+    for _ in range(3):
+        assert graph.post(url(server), {"to": "1"})[1] == 500
+    assert graph.breaker.state == "open"
+
+    # Open: rejected without touching the network.
+    assert graph.post(url(server), {"to": "1"}) == ({"error": CIRCUIT_OPEN}, 503)
+    assert server.hits == 3
+
+    # After the cooldown one probe goes through; a failure re-opens the breaker.
+    time.sleep(0.35)
+    assert graph.post(url(server), {"to": "1"})[1] == 500
+    assert graph.breaker.state == "open"
+    assert server.hits == 4
+
+    # A successful probe closes it again.
+    server.error_rate = 0.0
+    time.sleep(0.35)
+    assert graph.post(url(server), {"to": "1"})[1] == 200
+    assert graph.breaker.state == "closed"
+    assert graph.post(url(server), {"to": "1"})[1] == 200
+    stats = graph.breaker.stats()
+    assert stats["opens"] == 2 and stats["rejected"] == 1
+
+
+def test_probe_is_released_when_the_limiter_fails(server, monkeypatch):
+    import whatsapp_graph
+
+    monkeypatch.setattr(whatsapp_graph, "GRAPH_BASE_URL", server.base_url)
+    server.error_rate = 1.0
+    graph = client(max_retries=0)
+    graph.breaker = CircuitBreaker(threshold=1, cooldown=0.1)
+    assert graph.post(url(server), {"to": "1"})[1] == 500
+    time.sleep(0.15)
+
+    def locked(recipient=None):
+        raise RuntimeError("database is locked")
+
+    with monkeypatch.context() as m:
+        m.setattr(whatsapp_graph.limiter, "acquire", locked)
+        with pytest.raises(RuntimeError):
+            graph.post_message({"to": "1"})
+    assert graph.breaker.state == "half_open"
+
+    # The probe was never sent, so the next call may still take it.
+    server.error_rate = 0.0
+    monkeypatch.setattr(whatsapp_graph.limiter, "acquire", lambda recipient=None: None)
+    assert graph.post_message({"to": "1"})[1] == 200
+    assert graph.breaker.state == "closed"
@@ -0,0 +1,77 @@
+# tests/test_outbox.py
+"""Outbox reservations against the local Graph stand-in."""
+import time
+import uuid
+
+import pytest
+
+import whatsapp_db
+import whatsapp_outbox
+from whatsapp_outbox import outbox
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def status(key):
+    row = whatsapp_db.fetchone("SELECT status FROM outbox WHERE idem_key = ?", (key,))
+    return row and row[0]
+
+
+@pytest.fixture
+def key(app):
+    return f"test-{uuid.uuid4().hex}"
+
+
+def test_concurrent_keys_send_once(key, graph_server):
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        codes = sorted(code for _, code in pool.map(
+            lambda _: outbox.deliver({"to": "9170001", "type": "text"}, "test", key=key), range(5)))
+
+    # Replays answer 202 while the first call is in flight and 200 once it has been sent.
+    assert set(codes) <= {200, 202}
+    assert len([p for p in graph_server.requests if p.get("to") == "9170001"]) == 1
+
+
+def test_send_that_raises_is_queued_not_stranded(key, graph_server, monkeypatch):
+    def locked(payload):
+        raise RuntimeError("database is locked")
+
+    with monkeypatch.context() as m:
+        m.setattr(whatsapp_outbox.graph, "post_message", locked)
+        data, code = outbox.deliver({"to": "9170002", "type": "text"}, "test", key=key)
+
+    assert code == 202 and data["queued"]
+    assert status(key) in ("pending", "sent")
+    assert wait_for(lambda: status(key) == "sent")
+    assert [p for p in graph_server.requests if p.get("to") == "9170002"]
+
+
+def test_stale_reservation_is_reclaimed(key, graph_server, monkeypatch):
+    monkeypatch.setattr(whatsapp_outbox, "OUTBOX_LEASE_SECONDS", 0.2)
+    old = time.time() - 1
+    whatsapp_db.execute(
+        "INSERT INTO outbox (idem_key, source, recipient, payload, status, created_at, next_attempt_at, updated_at) "
+        "VALUES (?, 'test', '9170003', '{\"to\": \"9170003\", \"type\": \"text\"}', 'sending', ?, ?, ?)",
+        (key, old, old, old),
+    )
+
+    assert wait_for(lambda: status(key) == "sent")
+
+
+def test_immediate_send_is_recorded_for_delivery_stats(app, graph_server):
+    from whatsapp_delivery import delivery
+
+    data, code = outbox.deliver({"to": "9170004", "type": "text"}, "chatbot")
+
+    assert code == 200
+    record = delivery.message(data["messages"][0]["id"])
+    assert record["status"] == "sent" and record["source"] == "chatbot"
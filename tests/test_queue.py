@@ -0,0 +1,86 @@
+# tests/test_queue.py
+"""JobQueue claims shared through SQLite; two instances stand in for two gunicorn workers."""
+import threading
+import time
+import uuid
+
+import pytest
+
+import whatsapp_db
+import whatsapp_queue
+from whatsapp_queue import JobQueue
+
+
+@pytest.fixture
+def name(app, monkeypatch):
+    monkeypatch.setattr(whatsapp_queue, "QUEUE_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(whatsapp_queue, "QUEUE_POLL_INTERVAL", 0.05)
+    return f"test-{uuid.uuid4().hex}"
+
+
+def statuses(name):
+    return [s for s, in whatsapp_db.fetchall("SELECT status FROM jobs WHERE queue = ? ORDER BY id", (name,))]
+
+
+def test_each_key_runs_in_order_across_workers(name):
+    lock = threading.Lock()
+    running, seen, overlaps = set(), {}, []
+
+    def handler(payload):
+        key = payload["key"]
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(0.01)
+        with lock:
+            running.discard(key)
+            seen.setdefault(key, []).append(payload["n"])
+
+    workers = [JobQueue(name, handler, lanes=4) for _ in range(2)]
+    for n in range(10):
+        for key in ("a", "b", "c"):
+            # Alternate submitters, as Meta spreads one sender's messages over workers.
+            workers[n % 2].submit(key, {"key": key, "n": n})
+
+    assert workers[0].join(timeout=10)
+    assert overlaps == []
+    assert seen == {key: list(range(10)) for key in ("a", "b", "c")}
+    assert statuses(name) == []
+
+
+def test_failed_job_is_retried_and_holds_back_its_key(name):
+    calls = []
+
+    def handler(payload):
+        calls.append(payload["n"])
+        if payload["n"] == 0 and calls.count(0) == 1:
+            raise RuntimeError("flaky")
+
+    queue = JobQueue(name, handler, lanes=2)
+    queue.submit("a", {"n": 0})
+    queue.submit("a", {"n": 1})
+
+    assert queue.join(timeout=5)
+    assert calls == [0, 0, 1]
+    assert queue.counters()["retried"] == 1
+
+
+def test_exhausted_job_is_parked_then_requeued(name):
+    healthy = threading.Event()
+
+    def handler(payload):
+        if not healthy.is_set():
+            raise RuntimeError("down")
+
+    queue = JobQueue(name, handler, lanes=1, max_attempts=2)
+    queue.submit("a", {})
+
+    assert queue.join(timeout=5)
+    assert statuses(name) == ["failed"]
+    assert queue.backlog() == {"depth": 0, "running": 0, "dead": 1}
+
+    healthy.set()
+    assert queue.requeue_failed() == [{}]
+    assert queue.join(timeout=5)
+    assert statuses(name) == []
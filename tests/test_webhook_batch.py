@@ -0,0 +1,123 @@
+# tests/test_webhook_batch.py
+"""Replays multi-message webhook payloads through /webhook (synchronous mode)."""
+import itertools
+import uuid
+
+from whatsapp_delivery import delivery
+from whatsapp_state import state_cache
+
+_numbers = itertools.count(919800000001)
+
+
+def sender():
+    return str(next(_numbers))
+
+
+def text(frm, body, msg_id=None):
+    return {"id": msg_id or f"wamid.{uuid.uuid4().hex}", "from": frm, "type": "text", "text": {"body": body}}
+
+
+def payload(*changes):
+    """One entry per argument; each argument is a list of change values."""
+    return {"object": "whatsapp_business_account",
+            "entry": [{"id": "waba", "changes": [{"field": "messages", "value": v} for v in values]}
+                      for values in changes]}
+
+
+def sent_to(server, to):
+    return [p for p in server.requests if p.get("to") == to]
+
+
+def test_every_entry_and_change_is_processed(client, graph_server):
+    a, b, c, d = sender(), sender(), sender(), sender()
+    data = payload(
+        [{"messages": [text(a, "hi")]}, {"messages": [text(b, "hi")]}],
+        [{"messages": [text(c, "hi"), text(d, "hi")]}],
+    )
+
+    res = client.post("/webhook", json=data)
+
+    assert res.status_code == 200
+    assert res.get_data(as_text=True) == "Processed 4 messages"
+    for to in (a, b, c, d):
+        assert [p["type"] for p in sent_to(graph_server, to)] == ["interactive"]
+        assert state_cache.get(to) == "awaiting_option"
+
+
+def test_duplicate_inside_one_batch_is_processed_once(client, graph_server):
+    a = sender()
+    msg = text(a, "hi")
+    data = payload([{"messages": [msg]}, {"messages": [dict(msg)]}])
+
+    res = client.post("/webhook", json=data)
+
+    assert res.get_data(as_text=True) == "Greeting sent"
+    assert len(sent_to(graph_server, a)) == 1
+
+
+def test_duplicate_across_requests_is_ignored(client, graph_server):
+    a = sender()
+    data = payload([{"messages": [text(a, "hi")]}])
+
+    first = client.post("/webhook", json=data)
+    second = client.post("/webhook", json=data)
+
+    assert first.get_data(as_text=True) == "Greeting sent"
+    assert second.get_data(as_text=True) == "Duplicate"
+    assert len(sent_to(graph_server, a)) == 1
+
+
+def test_redelivered_batch_only_runs_new_messages(client, graph_server):
+    a = sender()
+    hi = text(a, "hi")
+    client.post("/webhook", json=payload([{"messages": [hi]}]))
+
+    res = client.post("/webhook", json=payload([{"messages": [hi, text(a, "2")]}]))
+
+    assert res.get_data(as_text=True) == "Asked for article"
+    assert [p["type"] for p in sent_to(graph_server, a)] == ["interactive", "text"]
+
+
+def test_statuses_mixed_with_messages(client, graph_server):
+    a = sender()
+    wamid = f"wamid.{uuid.uuid4().hex}"
+    statuses = [
+        {"id": wamid, "status": "sent", "timestamp": "1700000000", "recipient_id": a},
+        {"id": wamid, "status": "delivered", "timestamp": "1700000002", "recipient_id": a},
+    ]
+    data = payload([{"statuses": statuses[:1], "messages": [text(a, "hi")]}, {"statuses": statuses[1:]}])
+
+    res = client.post("/webhook", json=data)
+
+    assert res.get_data(as_text=True) == "Greeting sent"
+    assert len(sent_to(graph_server, a)) == 1
+    record = delivery.message(wamid)
+    assert record["status"] == "delivered"
+    assert record["delivered_at"] - record["sent_at"] == 2
+
+
+def test_status_only_payload(client, graph_server):
+    wamid = f"wamid.{uuid.uuid4().hex}"
+    data = payload([{"statuses": [{"id": wamid, "status": "read", "timestamp": "1700000005"}]}])
+
+    res = client.post("/webhook", json=data)
+
+    assert res.get_data(as_text=True) == "Status OK"
+    assert graph_server.requests == []
+    assert delivery.message(wamid)["status"] == "read"
+
+
+def test_each_sender_keeps_arrival_order(client, graph_server):
+    a, b = sender(), sender()
+    data = payload(
+        [{"messages": [text(a, "hi"), text(b, "hi")]}],
+        [{"messages": [text(a, "2"), text(b, "2")]}, {"messages": [text(a, "1")]}],
+    )
+
+    res = client.post("/webhook", json=data)
+
+    assert res.get_data(as_text=True) == "Processed 5 messages"
+    assert [p["type"] for p in sent_to(graph_server, a)] == ["interactive", "text", "interactive"]
+    assert [p["type"] for p in sent_to(graph_server, b)] == ["interactive", "text"]
+    assert state_cache.get(a) == "awaiting_option"
+    assert state_cache.get(b) == "awaiting_article"
@@ -1,70 +1,65 @@
 # whatsapp_admin.py
 import os
-import sqlite3
-import pandas as pd
-from io import BytesIO
+import zipfile
 from flask import (
-    render_template, request, redirect, url_for, session, send_file
+    render_template, request, redirect, url_for, session,
+    Response, stream_with_context
 )
-import cloudinary
-import cloudinary.uploader
 from dotenv import load_dotenv
 
+import whatsapp_db
+from whatsapp_backup import snapshot_response, start_scheduler
+from whatsapp_catalog import catalog, product_count
+from whatsapp_delivery import DELIVERY_ROLLUP_RETENTION_DAYS, delivery
+from whatsapp_export import (
+    DEFAULT_EXPORT_COLUMNS, iter_rows, parse_columns,
+    remove_on_close, stream_csv, stream_ndjson, stream_file, write_xlsx
+)
+from whatsapp_flows import flows
+from whatsapp_images import prepare_image, queue_upload, retry_failed_uploads, upload_queue
+from whatsapp_import import import_products, read_sheet
+from whatsapp_logging import get_logger
+from whatsapp_search import search_products
+
 load_dotenv()
 
+log = get_logger("admin")
+
 # ======================================================
 # PATH & CONFIG
 # ======================================================
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-
-DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, "data"))
-os.makedirs(DATA_DIR, exist_ok=True)
-
-DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "products.db"))
+DB_PATH = whatsapp_db.DB_PATH
 
 BACKUP_TOKEN = os.getenv("BACKUP_TOKEN", "WalkBack2025")
 
-cloudinary.config(
-    cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
-    api_key=os.getenv("CLOUDINARY_API_KEY"),
-    api_secret=os.getenv("CLOUDINARY_API_SECRET")
-)
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+ADMIN_PAGE_SIZE_MAX = 500
+PRODUCT_COLUMNS = ("id", "main_product", "option", "image", "description", "mrp", "category", "image_status")
 
 # ======================================================
-# DATABASE INITIALIZATION (SAFE)
+# PRODUCT LISTING (KEYSET PAGINATION)
 # ======================================================
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            main_product TEXT,
-            option TEXT,
-            image TEXT,
-            description TEXT,
-            mrp TEXT,
-            category TEXT
+def _int_arg(name, default):
+    try:
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def product_page(search_query, cursor, size):
+    """
+    Returns (rows, next_cursor). Plain listing pages by id (keyset), so every
+    page costs the same no matter how deep; ranked search results page by offset.
+    """
+    if search_query:
+        rows = search_products(search_query, limit=size + 1, offset=cursor)
+        next_cursor = cursor + size if len(rows) > size else None
+    else:
+        rows = whatsapp_db.fetchall(
+            "SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?", (cursor, size + 1)
         )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_state (
-            user_id TEXT PRIMARY KEY,
-            state TEXT,
-            last_updated INTEGER
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS processed_messages (
-            id TEXT PRIMARY KEY
-        )
-    """)
-
-    conn.commit()
-    conn.close()
+        next_cursor = rows[size - 1][0] if len(rows) > size else None
+    return rows[:size], next_cursor
 
 
 # ======================================================
@@ -72,8 +67,8 @@ def init_db():
 # ======================================================
 def register_admin_routes(app):
 
-    # ✅ SAFE DB INIT (Render-compatible)
-    init_db()
+    start_scheduler()
+    upload_queue.start()
 
     # ---------------- LOGIN ----------------
     @app.route('/login', methods=['GET', 'POST'])
@@ -103,30 +98,38 @@ def register_admin_routes(app):
             return redirect(url_for('login'))
 
         search_query = request.args.get('search', '').strip()
+        size = max(1, min(_int_arg('size', ADMIN_PAGE_SIZE), ADMIN_PAGE_SIZE_MAX))
+        cursor = max(0, _int_arg('after', 0))
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        if search_query:
-            c.execute("""
-                SELECT * FROM products WHERE
-                main_product LIKE ? OR
-                option LIKE ? OR
-                description LIKE ? OR
-                category LIKE ?
-            """, (f"%{search_query}%",) * 4)
-        else:
-            c.execute("SELECT * FROM products")
-
-        products = c.fetchall()
-        conn.close()
+        products, next_cursor = product_page(search_query, cursor, size)
 
         return render_template(
             'admin.html',
             products=products,
-            search_query=search_query
+            search_query=search_query,
+            page_size=size,
+            next_cursor=next_cursor,
+            is_first_page=cursor == 0,
+            total_products=product_count()
         )
 
+    # ---------------- PRODUCT LIST (JSON) ----------------
+    @app.route('/admin/products.json')
+    def admin_products_json():
+        if 'user' not in session:
+            return {"error": "Unauthorized"}, 401
+
+        search_query = request.args.get('search', '').strip()
+        size = max(1, min(_int_arg('size', ADMIN_PAGE_SIZE), ADMIN_PAGE_SIZE_MAX))
+        cursor = max(0, _int_arg('after', 0))
+
+        products, next_cursor = product_page(search_query, cursor, size)
+        return {
+            "products": [dict(zip(PRODUCT_COLUMNS, row)) for row in products],
+            "next": next_cursor,
+            "total": product_count()
+        }
+
     # ---------------- ADD PRODUCT ----------------
     @app.route('/add', methods=['POST'])
     def add_product():
@@ -141,40 +144,65 @@ def register_admin_routes(app):
             category = request.form.get('category', '').strip()
             file = request.files.get('image')
 
-            image_url = None
+            # Resize locally, save the row now and let the upload finish in
+            # the background; the image column is filled in when it lands.
+            image_data = prepare_image(file.stream) if file and file.filename else None
 
-            if file and file.filename:
-                upload_result = cloudinary.uploader.upload(
-                    file,
-                    folder="walkmate"
-                )
-                image_url = upload_result.get("secure_url")
-
-            conn = sqlite3.connect(DB_PATH)
-            conn.execute("""
+            cur = whatsapp_db.execute("""
                 INSERT INTO products
-                (main_product, option, image, description, mrp, category)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (main_product, option, image_url, description, mrp, category))
-            conn.commit()
-            conn.close()
+                (main_product, option, image, description, mrp, category, image_status)
+                VALUES (?, ?, NULL, ?, ?, ?, ?)
+            """, (main_product, option, description, mrp, category, 'pending' if image_data else None))
+            catalog.invalidate()
+
+            if image_data:
+                queue_upload(cur.lastrowid, image_data)
 
             return redirect(url_for('admin'))
 
-        except Exception as e:
-            print("❌ ERROR in /add:", e, flush=True)
+        except Exception:
+            log.exception("❌ ERROR in /add")
             return "Internal Server Error", 500
 
+    # ---------------- BULK IMPORT ----------------
+    @app.route('/import', methods=['POST'])
+    def import_products_route():
+        if 'user' not in session:
+            return redirect(url_for('login'))
+
+        sheet = request.files.get('sheet')
+        images = request.files.get('images')
+        mode = request.form.get('mode', 'insert')
+        if not sheet or not sheet.filename:
+            return {"ok": False, "error": "Upload a .xlsx or .csv sheet"}, 400
+        if mode not in ('insert', 'upsert'):
+            return {"ok": False, "error": "mode must be insert or upsert"}, 400
+
+        try:
+            records = read_sheet(sheet.filename, sheet.stream)
+            report = import_products(
+                records,
+                images_zip=images.stream if images and images.filename else None,
+                mode=mode
+            )
+        except (ValueError, zipfile.BadZipFile) as e:
+            return {"ok": False, "error": str(e)}, 400
+        except Exception:
+            log.exception("❌ ERROR in /import")
+            return {"ok": False, "error": "Internal Server Error"}, 500
+
+        catalog.invalidate()
+        log.info("📥 Import finished", extra={k: report[k] for k in ("inserted", "updated", "failed")})
+        return {"ok": report["failed"] == 0, **report}, 200
+
     # ---------------- DELETE PRODUCT ----------------
     @app.route('/delete/<int:id>', methods=['POST'])
     def delete_product(id):
         if 'user' not in session:
             return redirect(url_for('login'))
 
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("DELETE FROM products WHERE id = ?", (id,))
-        conn.commit()
-        conn.close()
+        whatsapp_db.execute("DELETE FROM products WHERE id = ?", (id,))
+        catalog.invalidate()
 
         return redirect(url_for('admin'))
 
@@ -184,25 +212,97 @@ def register_admin_routes(app):
         if 'user' not in session:
             return redirect(url_for('login'))
 
-        conn = sqlite3.connect(DB_PATH)
-        df = pd.read_sql_query(
-            "SELECT id, main_product, option, description, mrp, category FROM products",
-            conn
-        )
-        conn.close()
+        path = write_xlsx(list(DEFAULT_EXPORT_COLUMNS), iter_rows(DEFAULT_EXPORT_COLUMNS))
+        return remove_on_close(Response(
+            stream_with_context(stream_file(path)),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={
+                'Content-Disposition': 'attachment; filename=walkmate_products.xlsx',
+                'Content-Length': str(os.path.getsize(path))
+            }
+        ), path)
+
+    # ---------------- EXPORT (STREAMING, FILTERED) ----------------
+    @app.route('/export')
+    def export_products():
+        if 'user' not in session:
+            return redirect(url_for('login'))
 
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Products')
+        fmt = request.args.get('format', 'csv').lower()
+        try:
+            columns = parse_columns(request.args.get('columns'))
+        except ValueError as e:
+            return str(e), 400
+
+        rows = iter_rows(
+            columns,
+            category=request.args.get('category', '').strip() or None,
+            main_product=request.args.get('main_product', '').strip() or None,
+            search=request.args.get('search', '').strip() or None
+        )
 
-        output.seek(0)
+        path = None
+        if fmt == 'csv':
+            body, mimetype, ext = stream_csv(columns, rows), 'text/csv', 'csv'
+        elif fmt == 'ndjson':
+            body, mimetype, ext = stream_ndjson(columns, rows), 'application/x-ndjson', 'ndjson'
+        elif fmt == 'xlsx':
+            path = write_xlsx(columns, rows)
+            body = stream_file(path)
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            ext = 'xlsx'
+        else:
+            return "Unsupported format", 400
 
-        return send_file(
-            output,
-            download_name='walkmate_products.xlsx',
-            as_attachment=True,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        response = Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=walkmate_products.{ext}'}
         )
+        return remove_on_close(response, path) if path else response
+
+    # ---------------- RETRY FAILED IMAGE UPLOADS ----------------
+    @app.route('/admin/images/retry', methods=['POST'])
+    def retry_image_uploads():
+        if 'user' not in session:
+            return {"error": "Unauthorized"}, 401
+
+        count = retry_failed_uploads()
+        log.info("🖼️ Failed image uploads re-queued", extra={"products": count})
+        return {"ok": True, "requeued": count}, 200
+
+    # ---------------- DELIVERY STATS (JSON) ----------------
+    @app.route('/admin/delivery.json')
+    def admin_delivery_json():
+        if 'user' not in session:
+            return {"error": "Unauthorized"}, 401
+
+        days = max(1, min(_int_arg('days', 7), DELIVERY_ROLLUP_RETENTION_DAYS))
+        return delivery.report(days, request.args.get('template', '').strip() or None)
+
+    # ---------------- CONVERSATION FLOW ----------------
+    @app.route('/admin/flows', methods=['GET', 'POST', 'DELETE'])
+    def admin_flows():
+        if 'user' not in session:
+            return {"error": "Unauthorized"}, 401
+
+        if request.method == 'POST':
+            definition = request.get_json(silent=True)
+            if not isinstance(definition, dict):
+                return {"ok": False, "error": "Send the flow definition as a JSON object"}, 400
+            try:
+                version = flows.save(definition)
+            except (ValueError, KeyError, TypeError) as e:
+                return {"ok": False, "error": str(e)}, 400
+            log.info("🧭 Flow updated", extra={"version": version})
+            return {"ok": True, "version": version}, 200
+
+        if request.method == 'DELETE':
+            flows.reset()
+            log.info("🧭 Flow reset to default")
+            return {"ok": True}, 200
+
+        return {"flow": flows.definition(), "version": flows.current().version}
 
     # ---------------- DOWNLOAD DB (RAW) ----------------
     @app.route('/download-db')
@@ -213,15 +313,13 @@ def register_admin_routes(app):
             return "Unauthorized", 403
 
         if os.path.exists(DB_PATH):
-            return send_file(DB_PATH, as_attachment=True)
+            return snapshot_response("products.db")
 
         return "Database not found", 404
 
-    # ---------------- DOWNLOAD DB (ZIP – TEMPORARY) ----------------
+    # ---------------- DOWNLOAD DB (ZIP) ----------------
     @app.route('/download-db-zip')
     def download_db_zip():
-        import zipfile
-
         token = request.args.get('token')
 
         if token != BACKUP_TOKEN:
@@ -230,15 +328,4 @@ def register_admin_routes(app):
         if not os.path.exists(DB_PATH):
             return "Database not found", 404
 
-        mem = BytesIO()
-        with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.write(DB_PATH, arcname="products.db")
-
-        mem.seek(0)
-
-        return send_file(
-            mem,
-            as_attachment=True,
-            download_name="products_db_backup.zip",
-            mimetype="application/zip"
-        )
+        return snapshot_response("products_db_backup.zip", compress="zip")
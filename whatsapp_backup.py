@@ -0,0 +1,174 @@
+# whatsapp_backup.py
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+
+from flask import Response, stream_with_context
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(whatsapp_db.DATA_DIR, "backups"))
+BACKUP_INTERVAL_MINUTES = int(os.getenv("BACKUP_INTERVAL_MINUTES", "0"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "1024"))
+BACKUP_CHUNK_BYTES = 1024 * 1024
+os.makedirs(BACKUP_DIR, exist_ok=True)
+
+log = get_logger("backup")
+
+
+# ====== Snapshots ======
+def snapshot(dest_path):
+    """
+    Writes a consistent copy of the live database to dest_path.
+
+    VACUUM INTO reads inside one WAL read transaction, so chatbot writers are
+    never blocked and the copy is never torn. Where it is unavailable the
+    sqlite3 backup API copies BACKUP_STEP_PAGES pages per step instead.
+    """
+    src = sqlite3.connect(whatsapp_db.DB_PATH, timeout=whatsapp_db.DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            src.execute("VACUUM INTO ?", (dest_path,))
+        else:
+            dst = sqlite3.connect(dest_path)
+            try:
+                src.backup(dst, pages=BACKUP_STEP_PAGES, sleep=0.005)
+            finally:
+                dst.close()
+    finally:
+        src.close()
+    return dest_path
+
+
+def _temp_snapshot():
+    fd, path = tempfile.mkstemp(suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    os.remove(path)  # VACUUM INTO needs a path that does not exist yet
+    return snapshot(path)
+
+
+class _ChunkSink:
+    """Write-only file object that hands its buffered bytes to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_snapshot(compress=None, arcname="products.db"):
+    """Yields a fresh snapshot as raw bytes, gzip or a single-entry zip, in chunks."""
+    path = _temp_snapshot()
+    try:
+        with open(path, "rb") as f:
+            if compress is None:
+                while True:
+                    block = f.read(BACKUP_CHUNK_BYTES)
+                    if not block:
+                        break
+                    yield block
+                return
+
+            sink = _ChunkSink()
+            if compress == "zip":
+                archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED)
+                out = archive.open(arcname, "w", force_zip64=True)
+            else:
+                archive = None
+                out = gzip.GzipFile(filename=arcname, mode="wb", fileobj=sink)
+            while True:
+                block = f.read(BACKUP_CHUNK_BYTES)
+                if not block:
+                    break
+                out.write(block)
+                data = sink.drain()
+                if data:
+                    yield data
+            out.close()
+            if archive:
+                archive.close()
+            yield sink.drain()
+    finally:
+        os.remove(path)
+
+
+def snapshot_response(download_name, compress=None):
+    mimetype = {"zip": "application/zip", "gzip": "application/gzip"}.get(compress, "application/octet-stream")
+    return Response(
+        stream_with_context(iter_snapshot(compress)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={download_name}"}
+    )
+
+
+# ====== Scheduled Local Snapshots ======
+def write_local_snapshot():
+    """Stores a gzipped snapshot in BACKUP_DIR and prunes to BACKUP_KEEP files."""
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    final = os.path.join(BACKUP_DIR, f"products-{stamp}.db.gz")
+    path = _temp_snapshot()
+    try:
+        with open(path, "rb") as src, gzip.open(final + ".part", "wb") as dst:
+            shutil.copyfileobj(src, dst, BACKUP_CHUNK_BYTES)
+        os.replace(final + ".part", final)
+    finally:
+        os.remove(path)
+
+    backups = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("products-") and f.endswith(".db.gz"))
+    for old in backups[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(BACKUP_DIR, old))
+    return final
+
+
+def _acquire_scheduler_lock():
+    # Only one gunicorn worker should run the schedule.
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    handle = open(os.path.join(BACKUP_DIR, ".scheduler.lock"), "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _scheduler["lock"] = handle
+    return True
+
+
+def _run_scheduler():
+    while True:
+        time.sleep(BACKUP_INTERVAL_MINUTES * 60)
+        try:
+            log.info("💾 Snapshot written", extra={"path": write_local_snapshot()})
+        except Exception:
+            log.exception("❌ Scheduled snapshot failed")
+
+
+_scheduler = {"pid": None, "lock": None}
+
+
+def start_scheduler():
+    if BACKUP_INTERVAL_MINUTES <= 0 or _scheduler["pid"] == os.getpid():
+        return
+    _scheduler["pid"] = os.getpid()
+    if _acquire_scheduler_lock():
+        threading.Thread(target=_run_scheduler, name="db-backup", daemon=True).start()
+
@@ -0,0 +1,175 @@
+# whatsapp_broadcast.py
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import whatsapp_db
+from whatsapp_delivery import delivery
+from whatsapp_graph import graph
+from whatsapp_logging import get_logger
+from whatsapp_queue import QUEUE_STALE_SECONDS, JobQueue
+
+log = get_logger("broadcast")
+
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+
+
+def template_payload(to, name, lang, params):
+    """Builds a template message with one body parameter per value."""
+    parameters = [{"type": "text", "text": str(v)} for v in params]
+    components = [{"type": "body", "parameters": parameters}] if parameters else []
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "template",
+        "template": {
+            "name": name,
+            "language": {"code": lang},
+            "components": components
+        }
+    }
+
+
+# ====== Job Store ======
+def create_job(template, lang, rows, queued=True):
+    """
+    Persists a broadcast and queues it. ``rows`` is a list of dicts with
+    ``to``, ``params`` (list of strings) and an optional caller ``ref``.
+    With ``queued=False`` the caller runs it itself via run_job().
+    """
+    now = time.time()
+    with whatsapp_db.transaction() as conn:
+        job_id = conn.execute(
+            "INSERT INTO broadcast_jobs (template, lang, status, total, created_at) VALUES (?, ?, 'queued', ?, ?)",
+            (template, lang, len(rows), now),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO broadcast_recipients (job_id, row_no, ref, to_no, params, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(job_id, i, row.get("ref"), row["to"], json.dumps(row["params"]), now) for i, row in enumerate(rows)],
+        )
+    if queued:
+        broadcast_queue.submit(job_id, {"job_id": job_id})
+    return job_id
+
+
+def job_status(job_id):
+    job = whatsapp_db.fetchone(
+        "SELECT id, template, lang, status, total, created_at, started_at, finished_at FROM broadcast_jobs WHERE id = ?",
+        (job_id,),
+    )
+    if not job:
+        return None
+    counts = dict(whatsapp_db.fetchall(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,)
+    ))
+    keys = ("id", "template", "lang", "status", "total", "created_at", "started_at", "finished_at")
+    result = dict(zip(keys, job))
+    result["counts"] = {s: counts.get(s, 0) for s in ("pending", "sending", "sent", "failed")}
+    return result
+
+
+def job_recipients(job_id, status=None, limit=500, offset=0):
+    sql = ("SELECT row_no, ref, to_no, params, status, message_id, error, attempts "
+           "FROM broadcast_recipients WHERE job_id = ?")
+    params = [job_id]
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    sql += " ORDER BY row_no LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    keys = ("row", "ref", "to", "params", "status", "message_id", "error", "attempts")
+    rows = []
+    for r in whatsapp_db.fetchall(sql, params):
+        row = dict(zip(keys, r))
+        row["params"] = json.loads(row["params"])
+        rows.append(row)
+    return rows
+
+
+def retry_failed(job_id):
+    """Puts failed recipients back to pending and re-queues the job."""
+    with whatsapp_db.transaction() as conn:
+        count = conn.execute(
+            "UPDATE broadcast_recipients SET status = 'pending', error = NULL WHERE job_id = ? AND status = 'failed'",
+            (job_id,),
+        ).rowcount
+        if count:
+            conn.execute("UPDATE broadcast_jobs SET status = 'queued', finished_at = NULL WHERE id = ?", (job_id,))
+    if count:
+        broadcast_queue.submit(job_id, {"job_id": job_id})
+    return count
+
+
+# ====== Worker ======
+def _claim_row(rec_id):
+    """Moves one recipient from pending to sending; False when another run already took it."""
+    with whatsapp_db.transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcast_recipients SET status = 'sending', updated_at = ? "
+            "WHERE id = ? AND status = 'pending' RETURNING id",
+            (time.time(), rec_id),
+        ).fetchone() is not None
+
+
+def _send_row(template, lang, row):
+    rec_id, to, params = row
+    if not _claim_row(rec_id):
+        return "skipped"
+    payload = template_payload(to, template, lang, json.loads(params))
+    data, code = graph.post_message(payload)
+    if code in (200, 201):
+        messages = data.get("messages") or [{}]
+        status, message_id, error = "sent", messages[0].get("id"), None
+        delivery.record_sent(message_id, payload, "broadcast")
+    else:
+        status, message_id, error = "failed", None, json.dumps(data)[:1000]
+        log.warning("❌ Broadcast row failed", extra={"row_id": rec_id, "to": to, "status": code, "error": data})
+    whatsapp_db.execute(
+        "UPDATE broadcast_recipients SET status = ?, message_id = ?, error = ?, attempts = attempts + 1, "
+        "updated_at = ? WHERE id = ?",
+        (status, message_id, error, time.time(), rec_id),
+    )
+    return status
+
+
+def run_job(job_id):
+    job = whatsapp_db.fetchone("SELECT template, lang FROM broadcast_jobs WHERE id = ?", (job_id,))
+    if not job:
+        return
+    template, lang = job
+    whatsapp_db.execute(
+        "UPDATE broadcast_jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ?",
+        (time.time(), job_id),
+    )
+    now = time.time()
+    with whatsapp_db.transaction() as conn:
+        # A row left in 'sending' by a worker that died mid-send may or may not have
+        # gone out; fail it so a retry is an explicit decision rather than a duplicate.
+        conn.execute(
+            "UPDATE broadcast_recipients SET status = 'failed', error = ?, updated_at = ? "
+            "WHERE job_id = ? AND status = 'sending' AND updated_at < ?",
+            ('{"error": "interrupted while sending; delivery unknown"}', now, job_id, now - QUEUE_STALE_SECONDS),
+        )
+        rows = conn.execute(
+            "SELECT id, to_no, params FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' "
+            "ORDER BY row_no",
+            (job_id,),
+        ).fetchall()
+    # Each row is claimed right before its send, so a second run of the same job
+    # (a recovered or re-queued one) never sends a row twice.
+    results = list(_pool.map(lambda r: _send_row(template, lang, r), rows))
+
+    failed = whatsapp_db.fetchone(
+        "SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = ? AND status = 'failed'", (job_id,)
+    )[0]
+    whatsapp_db.execute(
+        "UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?",
+        ("done_with_errors" if failed else "done", time.time(), job_id),
+    )
+    log.info("📣 Broadcast finished", extra={"job_id": job_id, "sent": results.count("sent"), "failed": failed})
+
+
+_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+broadcast_queue = JobQueue("broadcast", lambda payload: run_job(payload["job_id"]), lanes=2)
@@ -0,0 +1,121 @@
+# whatsapp_browse.py
+import os
+
+from whatsapp_catalog import band_label
+
+# A list message holds at most 10 rows: a page of articles plus "More" and "Back".
+BROWSE_PAGE_SIZE = max(1, min(int(os.getenv("BROWSE_PAGE_SIZE", "8")), 8))
+CATEGORY_PAGE_SIZE = 9
+HEADER_LIMIT = 60  # characters in an interactive message's text header
+
+# Row ids ride back on list_reply; "|" never appears in a category name we
+# produce (categories are stripped, lowercased sheet values).
+#   cats|<page>                      category list
+#   cat|<category>                   price bands of a category
+#   list|<category>|<band>|<page>    articles (band is an index or "all")
+
+
+def _clip(text, limit):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _count(n, noun):
+    return f"{n} {noun}" if n == 1 else f"{n} {noun}s"
+
+
+def _price(value):
+    return f"₹{value:g}" if value is not None else "—"
+
+
+def _price_range(lo, hi):
+    if lo is None:
+        return "price on request"
+    return _price(lo) if lo == hi else f"{_price(lo)} – {_price(hi)}"
+
+
+def _list(body, rows, params, header=None):
+    return {
+        "type": "list",
+        "header": _clip(header, HEADER_LIMIT) if header else header,
+        "body": _clip(body, 1024),
+        "button": _clip(params.get("button", "View"), 20),
+        "sections": [{"title": _clip(header or "Walkmate", 24), "rows": rows}],
+    }
+
+
+def category_menu(index, params, page=0):
+    """First step: every category with its article count and price range; None when empty."""
+    if not index.categories:
+        return None
+    pages = (len(index.categories) + CATEGORY_PAGE_SIZE - 1) // CATEGORY_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * CATEGORY_PAGE_SIZE
+    chunk = index.categories[start:start + CATEGORY_PAGE_SIZE]
+    rows = [{"id": f"cat|{category}", "title": _clip(category.title(), 24),
+             "description": _clip(f"{_count(count, 'article')} · {_price_range(lo, hi)}", 72)}
+            for category, count, lo, hi in chunk]
+    if start + CATEGORY_PAGE_SIZE < len(index.categories):
+        rows.append({"id": f"cats|{page + 1}", "title": "More categories ▶"})
+    return _list(params.get("categories", "Pick a category 👇"), rows, params, header="Categories")
+
+
+def band_menu(index, params, category):
+    """Second step: the price bands that have stock; small categories skip straight to articles."""
+    articles = index.articles(category)
+    bands = index.bands(category)
+    if not articles:
+        return None
+    if len(articles) <= BROWSE_PAGE_SIZE or len(bands) <= 1:
+        return article_menu(index, params, category, None, 0)
+    rows = [{"id": f"list|{category}|{band}|0", "title": _clip(band_label(band), 24),
+             "description": _count(count, "article")} for band, count in bands]
+    rows.append({"id": f"list|{category}|all|0", "title": "All prices", "description": _count(len(articles), "article")})
+    rows.append({"id": "cats|0", "title": "⬅ Categories"})
+    body = params.get("prices", "Pick a price range for {category}").format(category=category.title())
+    return _list(body, rows, params, header=category.title())
+
+
+def article_menu(index, params, category, band, page):
+    """Last step: one page of articles, cheapest first; the row id is the article number."""
+    articles = index.articles(category, band)
+    if not articles:
+        return None
+    pages = (len(articles) + BROWSE_PAGE_SIZE - 1) // BROWSE_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * BROWSE_PAGE_SIZE
+    rows = [{"id": article, "title": _clip(article.upper(), 24),
+             "description": _clip(f"{_price(price)} · {_count(variants, 'colour')}", 72)}
+            for article, price, variants in articles[start:start + BROWSE_PAGE_SIZE]]
+    band_key = "all" if band is None else band
+    if page + 1 < pages:
+        rows.append({"id": f"list|{category}|{band_key}|{page + 1}", "title": "More articles ▶",
+                     "description": f"Page {page + 2} of {pages}"})
+    rows.append({"id": "cats|0", "title": "⬅ Categories"})
+    where = category.title() if band is None else f"{category.title()} · {band_label(band)}"
+    body = params.get("articles", "{where} — pick an article (page {page} of {pages})").format(
+        where=where, page=page + 1, pages=pages)
+    return _list(body, rows, params, header=category.title())
+
+
+def menu_for(index, params, selection):
+    """
+    Maps a list_reply row id to the next menu spec. Returns None when the
+    input is not a browse id (e.g. a typed or picked article number); an id
+    that no longer resolves because the catalog changed reopens the categories.
+    """
+    kind, _, rest = selection.partition("|")
+    spec = None
+    try:
+        if kind == "cats":
+            spec = category_menu(index, params, int(rest or 0))
+        elif kind == "cat":
+            spec = band_menu(index, params, rest)
+        elif kind == "list":
+            category, band, page = rest.rsplit("|", 2)
+            spec = article_menu(index, params, category, None if band == "all" else int(band), int(page))
+        else:
+            return None
+    except ValueError:
+        pass
+    return spec or category_menu(index, params)
@@ -0,0 +1,191 @@
+# whatsapp_catalog.py
+import os
+import threading
+import time
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+log = get_logger("catalog")
+
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
+BROWSE_PRICE_BANDS = os.getenv("BROWSE_PRICE_BANDS", "0-499,500-999,1000-1999,2000-")
+
+
+def current_version():
+    row = whatsapp_db.fetchone("SELECT version FROM catalog_version WHERE id = 1")
+    return row[0] if row else 0
+
+
+# ====== Browse Index ======
+def parse_bands(spec):
+    """"0-499,500-999,1000-" -> ((0, 499), (500, 999), (1000, None)); at most 8 bands fit a list."""
+    bands = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        lo, _, hi = part.partition("-")
+        bands.append((float(lo or 0), float(hi) if hi.strip() else None))
+    return tuple(bands[:8])
+
+
+PRICE_BANDS = parse_bands(BROWSE_PRICE_BANDS)
+
+
+def parse_mrp(value):
+    """MRP is free text in the sheet ("499", "₹1,299", "Rs. 799"); returns a float or None."""
+    if value is None:
+        return None
+    text = str(value).lower().replace(",", "").replace("₹", "").replace("rs.", "").replace("rs", "").strip()
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def band_label(band):
+    lo, hi = PRICE_BANDS[band]
+    return f"₹{lo:g}+" if hi is None else f"₹{lo:g} – ₹{hi:g}"
+
+
+def _band_of(price):
+    if price is None:
+        return None
+    for i, (lo, hi) in enumerate(PRICE_BANDS):
+        if price >= lo and (hi is None or price <= hi):
+            return i
+    return None
+
+
+class BrowseIndex:
+    """
+    Category and price-band listings built once per catalog load, so every
+    browse step is a dict lookup plus a slice. Articles are listed cheapest
+    first; an article's price is the lowest MRP among its variants.
+    """
+
+    def __init__(self, articles=None):
+        self.categories = []   # [(category, count, min_price, max_price)], alphabetical
+        self._bands = {}       # category -> [(band, count)], non-empty bands only
+        self._lists = {}       # (category, band or None) -> [(article, price, variants)]
+        by_category = {}
+        for article, (category, price, variants) in (articles or {}).items():
+            by_category.setdefault(category, []).append((article, price, variants))
+
+        for category in sorted(by_category):
+            entries = sorted(by_category[category], key=lambda e: (e[1] is None, e[1] or 0, e[0]))
+            prices = [e[1] for e in entries if e[1] is not None]
+            self.categories.append((category, len(entries),
+                                    min(prices) if prices else None, max(prices) if prices else None))
+            self._lists[(category, None)] = entries
+            for entry in entries:
+                band = _band_of(entry[1])
+                if band is not None:
+                    self._lists.setdefault((category, band), []).append(entry)
+            self._bands[category] = [(band, len(self._lists[(category, band)]))
+                                     for band in range(len(PRICE_BANDS)) if (category, band) in self._lists]
+
+    def bands(self, category):
+        return self._bands.get(category, [])
+
+    def articles(self, category, band=None):
+        return self._lists.get((category, band), [])
+
+
+class CatalogCache:
+    """
+    In-process copy of the products table keyed by main_product.
+
+    Triggers on products bump catalog_version on every write. Each worker
+    compares its loaded version at most once per CATALOG_CHECK_INTERVAL and
+    reloads when it changed; admin writes in this worker call invalidate()
+    so they show up on the very next lookup.
+    """
+
+    def __init__(self, check_interval=CATALOG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self._by_article = {}
+        self._browse = BrowseIndex()
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        with self._lock:
+            version = current_version()
+            by_article, articles = {}, {}
+            for main_product, image, description, mrp, category in whatsapp_db.fetchall(
+                # Rows still waiting on a background upload are hidden until it finishes;
+                # products saved without an image (or whose upload failed) stay listed.
+                "SELECT main_product, image, description, mrp, category FROM products "
+                "WHERE image_status IS NOT 'pending' ORDER BY id"
+            ):
+                by_article.setdefault(main_product, []).append((image, description))
+                price = parse_mrp(mrp)
+                entry = articles.get(main_product)
+                if entry is None:
+                    articles[main_product] = [(category or "").strip().lower() or "other", price, 0]
+                elif price is not None and (entry[1] is None or price < entry[1]):
+                    entry[1] = price
+            for main_product, entry in articles.items():
+                entry[2] = len(by_article[main_product])
+            self._by_article = by_article
+            self._browse = BrowseIndex(articles)
+            self.version = version
+            self._checked_at = time.time()
+        log.info("📦 Catalog loaded", extra={"articles": len(by_article), "categories": len(self._browse.categories),
+                                             "version": version})
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def _refresh_if_stale(self):
+        if time.time() - self._checked_at < self.check_interval:
+            return
+        if current_version() != self.version:
+            self.load()
+        else:
+            self._checked_at = time.time()
+
+    def lookup(self, article):
+        """Returns [(image, description), ...] for an article number."""
+        self._refresh_if_stale()
+        products = self._by_article.get(article)
+        if products is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return products
+
+    def browse(self):
+        """The BrowseIndex for the current catalog version."""
+        self._refresh_if_stale()
+        return self._browse
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "version": self.version,
+            "articles": len(self._by_article),
+            "categories": len(self._browse.categories),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_count_cache = {"version": None, "count": 0}
+
+
+def product_count():
+    """Row count of products, recomputed only when the catalog version moves."""
+    version = current_version()
+    if _count_cache["version"] != version:
+        _count_cache["count"] = whatsapp_db.fetchone("SELECT COUNT(*) FROM products")[0]
+        _count_cache["version"] = version
+    return _count_cache["count"]
+
+
+catalog = CatalogCache()
+metrics.register_collector("catalog_cache", catalog.stats, counters=("hits", "misses"), gauges=("articles", "categories"))
@@ -1,161 +1,292 @@
 # whatsapp_chatbot.py
+import contextvars
 import os
-import sqlite3
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import request
 from dotenv import load_dotenv
 
+import whatsapp_db
+import whatsapp_graph
+import whatsapp_queue
+from whatsapp_browse import category_menu, menu_for
+from whatsapp_catalog import catalog
+from whatsapp_dedup import dedup
+from whatsapp_delivery import delivery
+from whatsapp_flows import build_payload, flows, reply_buttons
+from whatsapp_logging import get_logger, log_payload
+from whatsapp_metrics import metrics
+from whatsapp_outbox import outbox
+from whatsapp_search import suggest_articles
+from whatsapp_state import state_cache
+
 load_dotenv()
 
+log = get_logger("chatbot")
+
 # ====== Environment Variables ======
-ACCESS_TOKEN = os.getenv("WHATSAPP_TOKEN")
-PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
-GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v21.0")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "Walkmate2025")
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "4"))
+FANOUT_COLLAPSE = os.getenv("FANOUT_COLLAPSE", "1") == "1"
 
 # ====== Database Setup (shared with admin panel) ======
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, "data"))
-os.makedirs(DATA_DIR, exist_ok=True)
-DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "products.db"))
+DB_PATH = whatsapp_db.DB_PATH
 
 
 def graph_messages_url():
-    return f"https://graph.facebook.com/{GRAPH_API_VERSION}/{PHONE_ID}/messages"
-
-
-# ====== Database Initialization ======
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            main_product TEXT,
-            option TEXT,
-            image TEXT,
-            description TEXT,
-            mrp TEXT,
-            category TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_state (
-            user_id TEXT PRIMARY KEY,
-            state TEXT,
-            last_updated INTEGER
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS processed_messages (
-            id TEXT PRIMARY KEY
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
-init_db()
+    return whatsapp_graph.messages_url()
+
 
 # ====== User State Management ======
+# Cached per worker; see StateCache for how hits are kept consistent across workers.
 def get_user_state(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT state, last_updated FROM user_state WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result:
-        state, last_updated = result
-        # Reset if last update older than 10 minutes
-        if time.time() - int(last_updated) > 600:
-            clear_user_state(user_id)
-            return None
-        return state
-    return None
+    return state_cache.get(user_id)
 
 
 def set_user_state(user_id, state):
-    now = int(time.time())
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("REPLACE INTO user_state (user_id, state, last_updated) VALUES (?, ?, ?)", (user_id, state, now))
-    conn.commit()
-    conn.close()
+    state_cache.set(user_id, state)
 
 
 def clear_user_state(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    state_cache.clear(user_id)
 
 
 # ====== Message Deduplication ======
-def is_duplicate_message(msg_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id FROM processed_messages WHERE id = ?", (msg_id,))
-    exists = c.fetchone()
-    conn.close()
-    return exists is not None
+def claim_message(msg_id):
+    """Atomically marks a message as processed; False if it was already seen."""
+    return dedup.claim_one(msg_id)
 
 
-def mark_message_processed(msg_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO processed_messages (id) VALUES (?)", (msg_id,))
-    conn.commit()
-    conn.close()
+# ====== WhatsApp Message Sending ======
+def _log_send(kind, to, code, data):
+    if code == 202:
+        log.warning("⏳ %s queued for retry", kind, extra={"to": to, "outbox_id": data.get("outbox_id")})
+    elif code < 400:
+        messages = data.get("messages") or [{}]
+        log.info("%s sent", kind, extra={"to": to, "status": code, "message_id": messages[0].get("id")})
+    else:
+        log.warning("❌ %s send failed", kind, extra={"to": to, "status": code, "error": data.get("error", data)})
+
+
+_SEND_KINDS = {"text": "📨 Text", "buttons": "🔘 Button message", "list": "📋 List message"}
+
+
+def send_payload(to, payload, kind="text"):
+    """Sends a prebuilt flow payload; only the recipient is filled in per call."""
+    data, code = outbox.deliver({**payload, "to": to}, "chatbot")
+    _log_send(_SEND_KINDS.get(kind, "📨 Message"), to, code, data)
 
 
-# ====== WhatsApp Message Sending ======
 def send_text(to, message):
-    url = graph_messages_url()
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
     payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": message}}
-    try:
-        res = requests.post(url, headers=headers, json=payload, timeout=20)
-        print("📨 Text sent:", res.status_code, res.text, flush=True)
-    except Exception as e:
-        print("❌ Text send failed:", e, flush=True)
+    data, code = outbox.deliver(payload, "chatbot")
+    _log_send("📨 Text", to, code, data)
 
 
 def send_image(to, image_url, caption=""):
-    url = graph_messages_url()
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
     payload = {
         "messaging_product": "whatsapp",
         "to": to,
         "type": "image",
         "image": {"link": image_url, "caption": caption},
     }
-    try:
-        res = requests.post(url, headers=headers, json=payload, timeout=20)
-        print("🖼️ Image sent:", res.status_code, res.text, flush=True)
-    except Exception as e:
-        print("❌ Image send failed:", e, flush=True)
+    data, code = outbox.deliver(payload, "chatbot")
+    _log_send("🖼️ Image", to, code, data)
 
 
-def send_button_message(to, body, buttons):
-    url = graph_messages_url()
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+def send_button_message(to, body, buttons, header_image=None):
+    interactive = {"type": "button", "body": {"text": body}, "action": {"buttons": buttons}}
+    if header_image:
+        interactive["header"] = {"type": "image", "image": {"link": header_image}}
     payload = {
         "messaging_product": "whatsapp",
         "to": to,
         "type": "interactive",
-        "interactive": {"type": "button", "body": {"text": body}, "action": {"buttons": buttons}},
+        "interactive": interactive,
     }
+    data, code = outbox.deliver(payload, "chatbot")
+    _log_send("🔘 Button message", to, code, data)
+
+
+def send_product_images(to, products, body, buttons):
+    """
+    Sends every variant image concurrently (bounded by the fan-out pool) and
+    only then the follow-up button, so the menu always arrives last. With
+    FANOUT_COLLAPSE the last variant rides along as the button's image header,
+    saving one message per article.
+    """
+    products = list(products)
+    final_image = None
+    if FANOUT_COLLAPSE and products:
+        final_url, final_desc = products.pop()
+        combined = f"{final_desc}\n\n{body}" if final_desc else body
+        if final_url and len(combined) <= 1024:
+            final_image, body = final_url, combined
+        else:
+            products.append((final_url, final_desc))
+
+    if len(products) == 1:
+        send_image(to, *products[0])
+    elif products:
+        # Each send carries the conversation's context (outbox idempotency scope).
+        futures = [_fanout_pool.submit(contextvars.copy_context().run, send_image, to, image_url, desc)
+                   for image_url, desc in products]
+        wait(futures)
+    send_button_message(to, body, buttons, header_image=final_image)
+
+
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_CONCURRENCY, thread_name_prefix="image-fanout")
+
+
+# ====== Conversation Logic ======
+def process_message(msg):
+    """Runs the conversation for one inbound message and returns a short result label."""
+    start = time.perf_counter()
+    result = "Error"
     try:
-        res = requests.post(url, headers=headers, json=payload, timeout=20)
-        print("🔘 Button message sent:", res.status_code, res.text, flush=True)
-    except Exception as e:
-        print("❌ Button send failed:", e, flush=True)
+        with outbox.scope(msg.get("id")):
+            result = _converse(msg)
+        return result
+    finally:
+        metrics.observe("webhook_message_seconds", time.perf_counter() - start, branch=result)
+
+
+def _converse(msg):
+    from_no = msg.get("from")
+    msg_type = msg.get("type")
+
+    # Extract text input
+    user_input = ""
+    if msg_type == "text":
+        user_input = msg["text"].get("body", "").strip().lower()
+    elif msg_type == "interactive":
+        inter = msg["interactive"]
+        if inter.get("type") == "button_reply":
+            user_input = inter["button_reply"]["title"].strip().lower()
+        elif inter.get("type") == "list_reply":
+            # List rows carry their routing in the id (see whatsapp_browse).
+            reply = inter["list_reply"]
+            user_input = (reply.get("id") or reply["title"]).strip().lower()
+
+    # --- Main Chat Logic (table-driven, see whatsapp_flows) ---
+    state = get_user_state(from_no)
+    log.info("👤 Message", extra={"from": from_no, "input": user_input, "state": state})
+
+    action = flows.current().resolve(state, user_input)
+    if action.payload is not None:
+        send_payload(from_no, action.payload, action.kind)
+    if action.handler is not None:
+        action.handler(from_no, user_input, state, action.params)
+    if action.next_state:
+        set_user_state(from_no, action.next_state)
+    return action.label
+
+
+# ====== Flow Handlers ======
+def article_lookup(to, article, state, params):
+    products = catalog.lookup(article)
+    if not products:
+        suggestions = suggest_articles(article)
+        hint = f"\nDid you mean: {', '.join(suggestions)}?" if suggestions else ""
+        send_text(to, params["not_found"] + hint)
+        return
+    send_product_images(to, products, params["body"], reply_buttons(params["buttons"]))
+
+
+def _send_menu(to, spec, params):
+    if spec is None:
+        send_text(to, params["empty"])
+    else:
+        send_payload(to, build_payload(spec), "list")
+
+
+def browse_categories(to, text, state, params):
+    _send_menu(to, category_menu(catalog.browse(), params), params)
+
+
+def browse_select(to, text, state, params):
+    # Menu rows carry "kind|..." ids; anything else is an article number,
+    # either picked from an article page or typed.
+    if "|" in text:
+        _send_menu(to, menu_for(catalog.browse(), params, text), params)
+    else:
+        article_lookup(to, text, state, params)
+
+
+flows.register_handler("article_lookup", article_lookup)
+flows.register_handler("browse_categories", browse_categories)
+flows.register_handler("browse_select", browse_select)
+
+
+# ====== Batch Ingestion ======
+def collect_webhook_events(data):
+    """Walks every entry and change of a webhook payload and returns (messages, statuses)."""
+    messages, statuses = [], []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            messages.extend(value.get("messages") or [])
+            statuses.extend(value.get("statuses") or [])
+    return messages, statuses
+
+
+def claim_new_messages(messages):
+    """Returns the messages not seen before (in batch order) and marks them processed."""
+    batch = {}
+    for msg in messages:
+        batch.setdefault(msg.get("id"), msg)
+    fresh_ids = dedup.claim(list(batch))
+    return [msg for msg_id, msg in batch.items() if msg_id in fresh_ids]
+
+
+def _process_sender(msgs):
+    results = []
+    for msg in msgs:
+        try:
+            results.append(process_message(msg))
+        except Exception:
+            log.exception("❌ Message failed", extra={"message_id": msg.get("id")})
+            results.append("Error")
+    return results
+
+
+def dispatch_messages(messages):
+    """
+    Processes a batch synchronously: senders run concurrently on the batch
+    pool, each sender's messages run one after another in arrival order.
+    """
+    by_sender = {}
+    for msg in messages:
+        by_sender.setdefault(msg.get("from"), []).append(msg)
+
+    if len(by_sender) == 1:
+        return _process_sender(messages)
+
+    results = []
+    for sender_results in _batch_pool.map(_process_sender, by_sender.values()):
+        results.extend(sender_results)
+    return results
+
+
+_batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="webhook-batch")
+
+
+# Fast-ack mode: the webhook only dedupes and persists the message, then a
+# background lane in any worker runs process_message, one message per sender
+# at a time. Retries are safe: sends are keyed by the message id (outbox.scope).
+message_queue = whatsapp_queue.JobQueue("webhook", process_message)
 
 
 # ====== Webhook Route ======
 def handle_webhook(app):
+    catalog.load()
+    flows.load()
+    if WEBHOOK_ASYNC:
+        message_queue.start()
+    outbox.start()
+
     @app.route("/webhook", methods=["GET", "POST"])
     def webhook():
         # --- Verification Step ---
@@ -163,106 +294,51 @@ def handle_webhook(app):
             token = request.args.get("hub.verify_token")
             challenge = request.args.get("hub.challenge")
             if token == VERIFY_TOKEN:
-                print("✅ Webhook verified successfully", flush=True)
+                log.info("✅ Webhook verified successfully")
                 return challenge, 200
             return "Invalid token", 403
 
         # --- Incoming Message Processing ---
+        start = time.perf_counter()
+        body, code = _receive()
+        outcome = "Processed batch" if body.startswith("Processed ") else body
+        metrics.observe("webhook_request_seconds", time.perf_counter() - start, outcome=outcome)
+        return body, code
+
+    def _receive():
         try:
             data = request.get_json(force=True)
-            print("📩 Webhook received:", data, flush=True)
+            log_payload("📩 Webhook received", data)
 
-            entry = data.get("entry", [{}])[0]
-            changes = entry.get("changes", [{}])[0]
-            value = changes.get("value", {})
+            messages, statuses = collect_webhook_events(data)
 
-            # Handle status callbacks
-            if "statuses" in value:
-                for s in value["statuses"]:
-                    print(f"📬 Status Update: {s.get('status')} | ID: {s.get('id')}", flush=True)
-                return "Status OK", 200
+            # Status callbacks only touch an in-memory buffer (see whatsapp_delivery)
+            if statuses:
+                delivery.ingest(statuses)
+                log.debug("📬 Status updates", extra={"count": len(statuses)})
 
-            messages = value.get("messages", [])
             if not messages:
-                return "No messages", 200
+                return ("Status OK", 200) if statuses else ("No messages", 200)
+
+            # Avoid duplicates (one query for the whole batch)
+            fresh = claim_new_messages(messages)
+            fresh_refs = {id(m) for m in fresh}
+            for msg in messages:
+                if id(msg) not in fresh_refs:
+                    log.info("⚠️ Duplicate message ignored", extra={"message_id": msg.get("id")})
+            if not fresh:
+                return "Duplicate", 200
 
-            msg = messages[0]
-            msg_id = msg.get("id")
-            from_no = msg.get("from")
-            msg_type = msg.get("type")
+            if WEBHOOK_ASYNC:
+                for msg in fresh:
+                    message_queue.submit(msg.get("from"), msg)
+                return "Queued", 200
 
-            # Avoid duplicates
-            if is_duplicate_message(msg_id):
-                print(f"⚠️ Duplicate message {msg_id} ignored", flush=True)
-                return "Duplicate", 200
-            mark_message_processed(msg_id)
-
-            # Extract text input
-            user_input = ""
-            if msg_type == "text":
-                user_input = msg["text"].get("body", "").strip().lower()
-            elif msg_type == "interactive":
-                inter = msg["interactive"]
-                if inter.get("type") == "button_reply":
-                    user_input = inter["button_reply"]["title"].strip().lower()
-                elif inter.get("type") == "list_reply":
-                    user_input = inter["list_reply"]["title"].strip().lower()
-
-            # --- Main Chat Logic ---
-            state = get_user_state(from_no)
-            print(f"👤 {from_no} | Input: {user_input} | State: {state}", flush=True)
-
-            # Step 1: Greeting
-            if user_input in ["hi", "hello"]:
-                send_button_message(
-                    from_no,
-                    "Hi 👋, welcome to Walkmate!\nPlease reply with '2' to get product images.",
-                    [{"type": "reply", "reply": {"id": "option_2", "title": "2"}}],
-                )
-                set_user_state(from_no, "awaiting_option")
-                return "Greeting sent", 200
-
-            # Step 2: User chooses option 2
-            if user_input == "2" and state == "awaiting_option":
-                send_text(from_no, "Please enter the article number (e.g., 2205)")
-                set_user_state(from_no, "awaiting_article")
-                return "Asked for article", 200
-
-            # Step 3: Fetch product by article number
-            if state == "awaiting_article":
-                if user_input == "1":
-                    send_button_message(
-                        from_no,
-                        "Hi 👋, welcome to Walkmate!\nPlease reply with '2' to get product images.",
-                        [{"type": "reply", "reply": {"id": "option_2", "title": "2"}}],
-                    )
-                    set_user_state(from_no, "awaiting_option")
-                    return "Returned to menu", 200
-
-                article = user_input
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("SELECT image, description FROM products WHERE main_product=?", (article,))
-                products = c.fetchall()
-                conn.close()
-
-                if not products:
-                    send_text(from_no, "❌ No product found with that article number.")
-                else:
-                    for image_url, desc in products:
-                        send_image(from_no, image_url, desc)
-                    send_button_message(
-                        from_no,
-                        "✅ Reply with 1 to go back to the main menu or enter another article number to view another product.",
-                        [{"type": "reply", "reply": {"id": "go_main", "title": "1"}}],
-                    )
-                    set_user_state(from_no, "awaiting_article")
-                return "Products sent", 200
-
-            # Step 4: Default fallback
-            send_text(from_no, "Please type 'hi' to start again.")
-            return "Fallback", 200
-
-        except Exception as e:
-            print("❌ Webhook error:", e, flush=True)
+            results = dispatch_messages(fresh)
+            if len(results) == 1:
+                return results[0], 200
+            return f"Processed {len(results)} messages", 200
+
+        except Exception:
+            log.exception("❌ Webhook error")
             return "Error", 200
@@ -0,0 +1,490 @@
+# whatsapp_db.py
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics, statement_label
+
+load_dotenv()
+
+log = get_logger("db")
+
+# ====== Database Config (shared by chatbot, orders and admin) ======
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, "data"))
+os.makedirs(DATA_DIR, exist_ok=True)
+DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "products.db"))
+
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# One connection per (process, thread). Gunicorn forks workers after import,
+# so the pid is stored alongside the connection and a fork gets a fresh one.
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def get_conn():
+    """Returns the reusable connection for the current thread."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def close_conn():
+    """Closes the current thread's connection (tests / shutdown)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+# ====== Query Helpers ======
+_labels = {}
+
+
+def _observe(sql, start):
+    label = _labels.get(sql)
+    if label is None:
+        label = statement_label(sql)
+        if len(_labels) < 1024:
+            _labels[sql] = label
+    metrics.observe("db_statement_seconds", time.perf_counter() - start, statement=label)
+
+
+def fetchone(sql, params=()):
+    start = time.perf_counter()
+    row = get_conn().execute(sql, params).fetchone()
+    _observe(sql, start)
+    return row
+
+
+def fetchall(sql, params=()):
+    start = time.perf_counter()
+    rows = get_conn().execute(sql, params).fetchall()
+    _observe(sql, start)
+    return rows
+
+
+def execute(sql, params=()):
+    """Runs a single write statement and commits it."""
+    conn = get_conn()
+    start = time.perf_counter()
+    try:
+        cur = conn.execute(sql, params)
+        conn.commit()
+        return cur
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _observe(sql, start)
+
+
+def executemany(sql, seq_of_params):
+    conn = get_conn()
+    start = time.perf_counter()
+    try:
+        cur = conn.executemany(sql, seq_of_params)
+        conn.commit()
+        return cur
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _observe(sql, start)
+
+
+@contextmanager
+def transaction():
+    """Groups several writes into one commit on the thread's connection."""
+    conn = get_conn()
+    start = time.perf_counter()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        metrics.observe("db_transaction_seconds", time.perf_counter() - start)
+
+
+# ====== Full-Text Index ======
+FTS_COLUMNS = "main_product, option, description, category"
+
+
+def _init_fts(conn):
+    """Full-text index over products, kept in sync by triggers (needs FTS5)."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone()
+    try:
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                {FTS_COLUMNS},
+                content='products', content_rowid='id',
+                prefix='1 2 3', tokenize='unicode61'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        log.warning("⚠️ FTS5 unavailable, product search falls back to LIKE", extra={"error": str(e)})
+        return
+    new_cols = ", ".join(f"new.{c.strip()}" for c in FTS_COLUMNS.split(","))
+    old_cols = ", ".join(f"old.{c.strip()}" for c in FTS_COLUMNS.split(","))
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, {FTS_COLUMNS}) VALUES (new.id, {new_cols});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', old.id, {old_cols});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', old.id, {old_cols});
+            INSERT INTO products_fts (rowid, {FTS_COLUMNS}) VALUES (new.id, {new_cols});
+        END
+    """)
+    if not exists:
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+
+# ====== Schema Migrations ======
+# Append-only: each step runs once per database, in order, and is recorded in
+# schema_migrations. Steps are written to be safe on databases created before
+# the table existed, since those already have some of the objects.
+def _products(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            main_product TEXT,
+            option TEXT,
+            image TEXT,
+            description TEXT,
+            mrp TEXT,
+            category TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_main_product ON products (main_product)")
+
+
+def _products_image_status(conn):
+    product_columns = {row[1] for row in conn.execute("PRAGMA table_info(products)")}
+    if "image_status" not in product_columns:
+        # NULL = image set synchronously (or none); 'pending' / 'ready' / 'failed' for background uploads.
+        conn.execute("ALTER TABLE products ADD COLUMN image_status TEXT")
+
+
+def _catalog_version(conn):
+    # Bumped by triggers on every catalog write so each worker's catalog
+    # cache can tell when it is stale.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()}
+            AFTER {event} ON products
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+
+
+def _user_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id TEXT PRIMARY KEY,
+            state TEXT,
+            last_updated INTEGER
+        )
+    """)
+
+
+def _user_state_version(conn):
+    # Bumped on every write so a worker can tell its cached state is stale.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(user_state)")}
+    if "version" not in columns:
+        conn.execute("ALTER TABLE user_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+def _processed_messages(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            id TEXT PRIMARY KEY,
+            seen_at INTEGER
+        )
+    """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(processed_messages)")}
+    if "seen_at" not in columns:
+        # Older databases: stamp existing ids so they age out with the window.
+        conn.execute("ALTER TABLE processed_messages ADD COLUMN seen_at INTEGER")
+        conn.execute("UPDATE processed_messages SET seen_at = strftime('%s', 'now')")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_messages_seen_at ON processed_messages (seen_at)")
+
+
+def _jobs(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue TEXT NOT NULL,
+            job_key TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            enqueued_at REAL NOT NULL,
+            claimed_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue_status ON jobs (queue, status, claimed_at)")
+
+
+def _jobs_run_after(conn):
+    # Retry backoff, plus the per-key lookup workers claim jobs with.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "run_after" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN run_after REAL NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs (queue, job_key, status)")
+
+
+def _rate_buckets(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _broadcasts(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            row_no INTEGER NOT NULL,
+            ref TEXT,
+            to_no TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            message_id TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_job ON broadcast_recipients (job_id, status)"
+    )
+
+
+def _metric_samples(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_samples (
+            worker TEXT NOT NULL,
+            series TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            value REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (worker, series)
+        ) WITHOUT ROWID
+    """)
+
+
+def _flows(conn):
+    # Conversation flow definitions (JSON); NULL definition = built-in default.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS flows (
+            name TEXT PRIMARY KEY,
+            definition TEXT,
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _outbox(conn):
+    # Graph sends that failed transiently, retried by whatsapp_outbox.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT NOT NULL UNIQUE,
+            source TEXT NOT NULL,
+            recipient TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            message_id TEXT,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            claimed_by TEXT,
+            claimed_until REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_recipient ON outbox (recipient, status)")
+
+
+def _delivery(conn):
+    # Per-message delivery timestamps (recent days) and per-day rollups kept
+    # after the raw rows are gone; see whatsapp_delivery.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_status (
+            message_id TEXT PRIMARY KEY,
+            template TEXT,
+            source TEXT,
+            recipient TEXT,
+            sent_at REAL,
+            delivered_at REAL,
+            read_at REAL,
+            failed_at REAL,
+            error_code TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_status_updated ON message_status (updated_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_rollups (
+            day TEXT NOT NULL,
+            template TEXT NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            read INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            delivery_hist TEXT NOT NULL,
+            read_hist TEXT NOT NULL,
+            errors TEXT NOT NULL,
+            PRIMARY KEY (day, template)
+        )
+    """)
+
+
+MIGRATIONS = (
+    (1, "products", _products),
+    (2, "products_image_status", _products_image_status),
+    (3, "products_fts", _init_fts),
+    (4, "catalog_version", _catalog_version),
+    (5, "user_state", _user_state),
+    (6, "processed_messages", _processed_messages),
+    (7, "jobs", _jobs),
+    (8, "rate_buckets", _rate_buckets),
+    (9, "broadcasts", _broadcasts),
+    (10, "metric_samples", _metric_samples),
+    (11, "flows", _flows),
+    (12, "outbox", _outbox),
+    (13, "delivery", _delivery),
+    (14, "user_state_version", _user_state_version),
+    (15, "jobs_run_after", _jobs_run_after),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_schema = {"checked": False}
+
+
+def _retry_fts(conn):
+    """
+    Migration 3 is recorded even when FTS5 was missing at the time, so each
+    boot builds the index if it is still absent (e.g. after a SQLite upgrade).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone():
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _init_fts(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def schema_version(conn=None):
+    """Highest migration applied to the database (0 for a fresh one)."""
+    conn = conn or get_conn()
+    try:
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def init_db():
+    """
+    Applies pending migrations. Workers booting together serialise on one
+    write lock and re-check the version under it, so each step runs once;
+    after the first call per process this returns without touching SQLite.
+    """
+    if _schema["checked"]:
+        return
+    conn = get_conn()
+    if schema_version(conn) >= SCHEMA_VERSION:
+        _retry_fts(conn)
+        _schema["checked"] = True
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at REAL NOT NULL
+            )
+        """)
+        current = schema_version(conn)
+        for version, name, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, time.time()),
+            )
+            log.info("🗄️ Migration applied", extra={"version": version, "migration": name})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _schema["checked"] = True
@@ -0,0 +1,113 @@
+# whatsapp_dedup.py
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+# Meta retries undelivered webhooks for up to 7 days.
+DEDUP_RETENTION_SECONDS = int(os.getenv("DEDUP_RETENTION_SECONDS", str(7 * 24 * 3600)))
+DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", "100000"))
+DEDUP_COMPACT_INTERVAL = int(os.getenv("DEDUP_COMPACT_INTERVAL", "3600"))
+
+log = get_logger("dedup")
+
+
+class MessageDedup:
+    """
+    Time-windowed message id store.
+
+    A bounded in-memory LRU answers repeats seen by this worker without a
+    query. Everything else is claimed atomically in processed_messages with
+    INSERT ... ON CONFLICT DO NOTHING, so two workers can never both process
+    the same id. Rows older than the retention window are compacted away.
+    """
+
+    def __init__(self, retention=DEDUP_RETENTION_SECONDS, memory_size=DEDUP_MEMORY_SIZE,
+                 compact_interval=DEDUP_COMPACT_INTERVAL):
+        self.retention = retention
+        self.memory_size = memory_size
+        self.compact_interval = compact_interval
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.claimed = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="dedup-compactor", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                removed = self.compact()
+                if removed:
+                    log.info("🧹 Compacted processed message ids", extra={"removed": removed})
+            except Exception:
+                log.exception("❌ Dedup compaction failed")
+            time.sleep(self.compact_interval)
+
+    def compact(self):
+        cutoff = int(time.time()) - self.retention
+        return whatsapp_db.execute("DELETE FROM processed_messages WHERE seen_at < ?", (cutoff,)).rowcount
+
+    def _remember(self, ids):
+        with self._lock:
+            for msg_id in ids:
+                self._recent[msg_id] = None
+                self._recent.move_to_end(msg_id)
+            while len(self._recent) > self.memory_size:
+                self._recent.popitem(last=False)
+
+    def claim(self, ids):
+        """Claims a batch of message ids and returns the set that was new."""
+        self._ensure_started()
+        with self._lock:
+            distinct = [i for i in dict.fromkeys(ids) if i]
+            unknown = [i for i in distinct if i not in self._recent]
+            self.memory_hits += len(distinct) - len(unknown)
+        if not unknown:
+            return set()
+
+        now = int(time.time())
+        placeholders = ",".join("(?, ?)" for _ in unknown)
+        params = [v for msg_id in unknown for v in (msg_id, now)]
+        with whatsapp_db.transaction() as conn:
+            fresh = {row[0] for row in conn.execute(
+                f"INSERT INTO processed_messages (id, seen_at) VALUES {placeholders} "
+                "ON CONFLICT(id) DO NOTHING RETURNING id",
+                params,
+            ).fetchall()}
+
+        self._remember(unknown)
+        with self._lock:
+            self.claimed += len(fresh)
+            self.db_hits += len(unknown) - len(fresh)
+        return fresh
+
+    def claim_one(self, msg_id):
+        return msg_id in self.claim([msg_id])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_size": len(self._recent),
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "claimed": self.claimed,
+            }
+
+
+dedup = MessageDedup()
+metrics.register_collector("dedup", dedup.stats, counters=("memory_hits", "db_hits", "claimed"),
+                           gauges=("memory_size",))
@@ -0,0 +1,353 @@
+# whatsapp_delivery.py
+import atexit
+import json
+import os
+import threading
+import time
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+DELIVERY_FLUSH_INTERVAL = float(os.getenv("DELIVERY_FLUSH_INTERVAL", "1.0"))
+DELIVERY_BUFFER_MAX = int(os.getenv("DELIVERY_BUFFER_MAX", "50000"))
+# Rows untouched for this long are final: folded into the daily rollups and deleted.
+DELIVERY_RAW_RETENTION_HOURS = float(os.getenv("DELIVERY_RAW_RETENTION_HOURS", "72"))
+DELIVERY_ROLLUP_RETENTION_DAYS = int(os.getenv("DELIVERY_ROLLUP_RETENTION_DAYS", "400"))
+DELIVERY_ROLLUP_INTERVAL = float(os.getenv("DELIVERY_ROLLUP_INTERVAL", "3600"))
+
+# Upper bounds (seconds) of the sent -> delivered / sent -> read latency buckets.
+LATENCY_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600)
+SESSION = "(session)"  # free-form replies, not a template
+
+_FIELDS = ("template", "source", "recipient", "sent_at", "delivered_at", "read_at", "failed_at", "error_code")
+_STATUS_FIELD = {"sent": "sent_at", "delivered": "delivered_at", "read": "read_at", "failed": "failed_at"}
+
+log = get_logger("delivery")
+
+
+def _combine(rec, fields):
+    """Folds new values into a pending record: earliest send, first of each status, latest template/error."""
+    for key, value in fields.items():
+        if value is None:
+            continue
+        current = rec[key]
+        if key == "sent_at":
+            rec[key] = value if current is None else min(current, value)
+        elif key in ("template", "source", "error_code"):
+            rec[key] = value
+        elif current is None:
+            rec[key] = value
+
+
+def _day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+# ====== Aggregation ======
+def _empty():
+    return {"sent": 0, "delivered": 0, "read": 0, "failed": 0,
+            "delivery_hist": [0] * (len(LATENCY_BUCKETS) + 1),
+            "read_hist": [0] * (len(LATENCY_BUCKETS) + 1), "errors": {}}
+
+
+def _bucket(seconds):
+    for i, le in enumerate(LATENCY_BUCKETS):
+        if seconds <= le:
+            return i
+    return len(LATENCY_BUCKETS)
+
+
+def _add_row(agg, sent_at, delivered_at, read_at, failed_at, error_code):
+    agg["sent"] += 1
+    if delivered_at is not None or read_at is not None:
+        agg["delivered"] += 1
+    if read_at is not None:
+        agg["read"] += 1
+    if failed_at is not None:
+        agg["failed"] += 1
+        code = str(error_code or "unknown")
+        agg["errors"][code] = agg["errors"].get(code, 0) + 1
+    if sent_at is not None:
+        if delivered_at is not None:
+            agg["delivery_hist"][_bucket(max(0.0, delivered_at - sent_at))] += 1
+        if read_at is not None:
+            agg["read_hist"][_bucket(max(0.0, read_at - sent_at))] += 1
+
+
+def _merge(agg, other):
+    for key in ("sent", "delivered", "read", "failed"):
+        agg[key] += other[key]
+    for key in ("delivery_hist", "read_hist"):
+        agg[key] = [a + b for a, b in zip(agg[key], other[key])]
+    for code, n in other["errors"].items():
+        agg["errors"][code] = agg["errors"].get(code, 0) + n
+
+
+def percentile(hist, q):
+    """Estimates a quantile from bucket counts (linear within a bucket); None when empty."""
+    total = sum(hist)
+    if not total:
+        return None
+    rank, running = q * total, 0
+    for i, n in enumerate(hist):
+        if n and running + n >= rank:
+            lo = LATENCY_BUCKETS[i - 1] if i else 0
+            hi = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+            return round(lo + (hi - lo) * (rank - running) / n, 1)
+        running += n
+    return float(LATENCY_BUCKETS[-1])
+
+
+def _summary(template, agg):
+    sent = agg["sent"] or 1
+    return {
+        "template": template,
+        "sent": agg["sent"],
+        "delivered": agg["delivered"],
+        "read": agg["read"],
+        "failed": agg["failed"],
+        "delivery_rate": round(agg["delivered"] / sent, 4),
+        "read_rate": round(agg["read"] / sent, 4),
+        "failure_rate": round(agg["failed"] / sent, 4),
+        "delivery_seconds": {f"p{q}": percentile(agg["delivery_hist"], q / 100) for q in (50, 90, 99)},
+        "read_seconds": {f"p{q}": percentile(agg["read_hist"], q / 100) for q in (50, 90, 99)},
+        "errors": dict(sorted(agg["errors"].items(), key=lambda kv: -kv[1])[:5]),
+    }
+
+
+# ====== Store ======
+class DeliveryStore:
+    """
+    Delivery timestamps of sent messages, fed by send results and webhook
+    status callbacks.
+
+    Both only touch an in-memory buffer keyed by message id, so the webhook
+    never waits on SQLite; a flusher merges the buffer into message_status
+    with one batched upsert per interval (several callbacks for one message
+    usually collapse into a single row write). Rows untouched for
+    DELIVERY_RAW_RETENTION_HOURS are folded into per-day, per-template
+    rollups (counts, error codes and latency histograms) and deleted, so the
+    table holds a few days of traffic while reports still cover months.
+    """
+
+    def __init__(self, flush_interval=DELIVERY_FLUSH_INTERVAL, buffer_max=DELIVERY_BUFFER_MAX):
+        self.flush_interval = flush_interval
+        self.buffer_max = buffer_max
+        self._pending = {}  # message_id -> {field: value}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.recorded = 0
+        self.ingested = 0
+        self.flushed = 0
+        self.dropped = 0
+
+    # ---------- background writer ----------
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = {}  # the parent flushes its own buffer
+            threading.Thread(target=self._run, name="delivery-flusher", daemon=True).start()
+
+    def _run(self):
+        last_rollup = 0.0
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_rollup >= DELIVERY_ROLLUP_INTERVAL:
+                    last_rollup = time.time()
+                    self.rollup()
+            except Exception:
+                log.exception("❌ Delivery flush failed")
+
+    def _buffer(self, message_id, fields):
+        with self._lock:
+            rec = self._pending.get(message_id)
+            if rec is None:
+                if len(self._pending) >= self.buffer_max:
+                    self.dropped += 1
+                    return False
+                rec = self._pending[message_id] = dict.fromkeys(_FIELDS)
+            _combine(rec, fields)
+        return True
+
+    def flush(self):
+        """Upserts everything buffered in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        now = time.time()
+        rows = [(mid, *(rec[f] for f in _FIELDS), now) for mid, rec in pending.items()]
+        try:
+            with whatsapp_db.transaction() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO message_status (message_id, template, source, recipient, sent_at,
+                                                delivered_at, read_at, failed_at, error_code, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(message_id) DO UPDATE SET
+                        template = COALESCE(excluded.template, template),
+                        source = COALESCE(excluded.source, source),
+                        recipient = COALESCE(recipient, excluded.recipient),
+                        sent_at = MIN(COALESCE(sent_at, excluded.sent_at), COALESCE(excluded.sent_at, sent_at)),
+                        delivered_at = COALESCE(delivered_at, excluded.delivered_at),
+                        read_at = COALESCE(read_at, excluded.read_at),
+                        failed_at = COALESCE(failed_at, excluded.failed_at),
+                        error_code = COALESCE(excluded.error_code, error_code),
+                        updated_at = excluded.updated_at
+                    """,
+                    rows,
+                )
+        except Exception:
+            with self._lock:
+                for mid, rec in pending.items():
+                    newer = self._pending.get(mid)
+                    if newer is not None:
+                        _combine(rec, newer)
+                    self._pending[mid] = rec
+            raise
+        with self._lock:
+            self.flushed += len(rows)
+        return len(rows)
+
+    def rollup(self, now=None):
+        """Folds final rows into delivery_rollups, deletes them and expires old rollups."""
+        now = now or time.time()
+        cutoff = now - DELIVERY_RAW_RETENTION_HOURS * 3600
+        with whatsapp_db.transaction() as conn:
+            # Take the write lock before reading: workers rolling up at the same time
+            # would otherwise fold the same rows and overwrite each other's totals.
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT template, sent_at, delivered_at, read_at, failed_at, error_code "
+                "FROM message_status WHERE updated_at < ?",
+                (cutoff,),
+            ).fetchall()
+            aggs = {}
+            for template, sent_at, delivered_at, read_at, failed_at, error_code in rows:
+                ts = next(t for t in (sent_at, delivered_at, read_at, failed_at, now) if t is not None)
+                key = (_day(ts), template or SESSION)
+                _add_row(aggs.setdefault(key, _empty()), sent_at, delivered_at, read_at, failed_at, error_code)
+
+            for (day, template), agg in aggs.items():
+                existing = conn.execute(
+                    "SELECT sent, delivered, read, failed, delivery_hist, read_hist, errors "
+                    "FROM delivery_rollups WHERE day = ? AND template = ?",
+                    (day, template),
+                ).fetchone()
+                if existing:
+                    _merge(agg, _from_row(existing))
+                conn.execute(
+                    "REPLACE INTO delivery_rollups (day, template, sent, delivered, read, failed, "
+                    "delivery_hist, read_hist, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (day, template, agg["sent"], agg["delivered"], agg["read"], agg["failed"],
+                     json.dumps(agg["delivery_hist"]), json.dumps(agg["read_hist"]), json.dumps(agg["errors"])),
+                )
+            conn.execute("DELETE FROM message_status WHERE updated_at < ?", (cutoff,))
+            conn.execute(
+                "DELETE FROM delivery_rollups WHERE day < ?", (_day(now - DELIVERY_ROLLUP_RETENTION_DAYS * 86400),)
+            )
+        if rows:
+            log.info("🧮 Delivery statuses rolled up", extra={"messages": len(rows), "groups": len(aggs)})
+        return len(rows)
+
+    # ---------- ingestion ----------
+    def record_sent(self, message_id, payload, source):
+        """Remembers a message id returned by the Graph API, with its template name."""
+        if not message_id:
+            return
+        self._ensure_started()
+        template = payload.get("template", {}).get("name") if payload.get("type") == "template" else None
+        if self._buffer(message_id, {"template": template, "source": source,
+                                     "recipient": payload.get("to"), "sent_at": time.time()}):
+            with self._lock:
+                self.recorded += 1
+
+    def ingest(self, statuses):
+        """Buffers webhook status callbacks (sent / delivered / read / failed)."""
+        self._ensure_started()
+        accepted = 0
+        for status in statuses:
+            field = _STATUS_FIELD.get(status.get("status"))
+            message_id = status.get("id")
+            if field is None or not message_id:
+                continue
+            try:
+                ts = float(status.get("timestamp") or time.time())
+            except (TypeError, ValueError):
+                ts = time.time()
+            fields = {field: ts, "recipient": status.get("recipient_id")}
+            if field == "failed_at":
+                errors = status.get("errors") or [{}]
+                fields["error_code"] = str(errors[0].get("code") or "unknown")
+            accepted += self._buffer(message_id, fields)
+        with self._lock:
+            self.ingested += accepted
+        return accepted
+
+    # ---------- reporting ----------
+    def report(self, days=7, template=None):
+        """Per-template counts, rates and latency percentiles over the last ``days`` days."""
+        now = time.time()
+        since = now - days * 86400
+        aggs = {}
+
+        sql, params = ("SELECT template, sent, delivered, read, failed, delivery_hist, read_hist, errors "
+                       "FROM delivery_rollups WHERE day >= ?"), [_day(since)]
+        if template:
+            sql += " AND template = ?"
+            params.append(template)
+        for row in whatsapp_db.fetchall(sql, params):
+            _merge(aggs.setdefault(row[0], _empty()), _from_row(row[1:]))
+
+        sql, params = ("SELECT COALESCE(template, ?), sent_at, delivered_at, read_at, failed_at, error_code "
+                       "FROM message_status WHERE COALESCE(sent_at, delivered_at, read_at, failed_at) >= ?"),\
+            [SESSION, since]
+        if template:
+            sql += " AND COALESCE(template, ?) = ?"
+            params += [SESSION, template]
+        for name, *row in whatsapp_db.fetchall(sql, params):
+            _add_row(aggs.setdefault(name, _empty()), *row)
+
+        templates = sorted((_summary(name, agg) for name, agg in aggs.items()), key=lambda t: -t["sent"])
+        return {"days": days, "since": since, "templates": templates}
+
+    def message(self, message_id):
+        row = whatsapp_db.fetchone(
+            "SELECT template, source, recipient, sent_at, delivered_at, read_at, failed_at, error_code "
+            "FROM message_status WHERE message_id = ?",
+            (message_id,),
+        )
+        with self._lock:
+            buffered = dict(self._pending.get(message_id) or {})
+        if row is None and not buffered:
+            return None
+        rec = dict(zip(_FIELDS, row)) if row else dict.fromkeys(_FIELDS)
+        _combine(rec, buffered)
+        status = next((s for s in ("failed", "read", "delivered", "sent") if rec[_STATUS_FIELD[s]] is not None),
+                      "unknown")
+        return {"message_id": message_id, "status": status, **rec}
+
+    def stats(self):
+        with self._lock:
+            return {"buffered": len(self._pending), "recorded": self.recorded, "ingested": self.ingested,
+                    "flushed": self.flushed, "dropped": self.dropped}
+
+
+def _from_row(row):
+    sent, delivered, read, failed, delivery_hist, read_hist, errors = row
+    return {"sent": sent, "delivered": delivered, "read": read, "failed": failed,
+            "delivery_hist": json.loads(delivery_hist), "read_hist": json.loads(read_hist),
+            "errors": json.loads(errors)}
+
+
+delivery = DeliveryStore()
+atexit.register(delivery.flush)
+metrics.register_collector("delivery", delivery.stats, counters=("recorded", "ingested", "flushed", "dropped"),
+                           gauges=("buffered",))
@@ -0,0 +1,130 @@
+# whatsapp_export.py
+import csv
+import io
+import json
+import os
+import tempfile
+
+import whatsapp_db
+from whatsapp_search import fts_available, fts_query
+
+EXPORT_COLUMNS = ("id", "main_product", "option", "image", "description", "mrp", "category")
+DEFAULT_EXPORT_COLUMNS = ("id", "main_product", "option", "description", "mrp", "category")
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+EXPORT_READ_BYTES = 64 * 1024
+
+
+def parse_columns(value):
+    """Validates a comma-separated column list against the products table."""
+    if not value:
+        return list(DEFAULT_EXPORT_COLUMNS)
+    columns = [c.strip() for c in value.split(",") if c.strip()]
+    unknown = [c for c in columns if c not in EXPORT_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+    return columns
+
+
+def iter_rows(columns, category=None, main_product=None, search=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yields product rows in id order, fetched from one cursor in chunks."""
+    where, params = [], []
+    if category:
+        where.append("category = ?")
+        params.append(category)
+    if main_product:
+        where.append("main_product = ?")
+        params.append(main_product.lower())
+    if search:
+        if fts_available():
+            where.append("id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)")
+            params.append(fts_query(search))
+        else:
+            where.append("(main_product LIKE ? OR option LIKE ? OR description LIKE ? OR category LIKE ?)")
+            params += [f"%{search}%"] * 4
+
+    sql = f"SELECT {', '.join(columns)} FROM products"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+
+    cur = whatsapp_db.get_conn().execute(sql, params)
+    try:
+        while True:
+            chunk = cur.fetchmany(chunk_rows)
+            if not chunk:
+                break
+            yield from chunk
+    finally:
+        cur.close()
+
+
+# ====== Formats ======
+def stream_csv(columns, rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def stream_ndjson(columns, rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+        if len(lines) >= chunk_rows:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def write_xlsx(columns, rows):
+    """
+    Writes rows with XlsxWriter's constant_memory mode (each row is flushed
+    to disk as it is written) and returns the temp file path. xlsx is a zip
+    assembled on close, so it cannot go straight to the socket.
+    """
+    import xlsxwriter
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "tmpdir": tempfile.gettempdir()})
+    try:
+        sheet = workbook.add_worksheet("Products")
+        header = workbook.add_format({"bold": True})
+        sheet.write_row(0, 0, columns, header)
+        for r, row in enumerate(rows, 1):
+            sheet.write_row(r, 0, row)
+    finally:
+        workbook.close()
+    return path
+
+
+def stream_file(path):
+    """Yields a file in fixed-size chunks."""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(EXPORT_READ_BYTES)
+            if not block:
+                break
+            yield block
+
+
+def remove_on_close(response, path):
+    """
+    Deletes ``path`` once the server closes ``response``, which also happens
+    when the client disconnects before the body is ever iterated.
+    """
+    def remove():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    response.call_on_close(remove)
+    return response
@@ -0,0 +1,272 @@
+# whatsapp_flows.py
+import copy
+import json
+import os
+import threading
+import time
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+
+log = get_logger("flows")
+
+FLOW_CHECK_INTERVAL = float(os.getenv("FLOW_CHECK_INTERVAL", "5"))
+
+# ====== Default Flow ======
+# A flow is plain data:
+#   global   - input -> action, matched in every state (checked first)
+#   states   - per state: "on" (input -> action) and an optional "default" action
+#   fallback - action when nothing else matches
+#   actions  - what to send ("send"), which handler to run ("handler" with
+#              "params"), the state to move to ("next") and the result label
+# Inputs are matched after strip().lower(), like the typed text and the
+# titles of tapped buttons.
+MAIN_MENU = {
+    "type": "buttons",
+    "body": "Hi 👋, welcome to Walkmate!\nPlease reply with '2' to get product images or '3' to browse by "
+            "category and price.",
+    "buttons": [{"id": "option_2", "title": "2"}, {"id": "option_3", "title": "3"}],
+}
+
+DEFAULT_FLOW = {
+    "global": {"hi": "greet", "hello": "greet", "browse": "browse"},
+    "states": {
+        "awaiting_option": {"on": {"2": "ask_article", "3": "browse"}},
+        "awaiting_article": {"on": {"1": "main_menu"}, "default": "article_lookup"},
+        "browsing": {"on": {"1": "main_menu"}, "default": "browse_select"},
+    },
+    "fallback": "fallback",
+    "actions": {
+        "greet": {"send": MAIN_MENU, "next": "awaiting_option", "label": "Greeting sent"},
+        "main_menu": {"send": MAIN_MENU, "next": "awaiting_option", "label": "Returned to menu"},
+        "ask_article": {
+            "send": {"type": "text", "body": "Please enter the article number (e.g., 2205)"},
+            "next": "awaiting_article",
+            "label": "Asked for article",
+        },
+        "article_lookup": {
+            "handler": "article_lookup",
+            "params": {
+                "body": "✅ Reply with 1 to go back to the main menu or enter another article number "
+                        "to view another product.",
+                "buttons": [{"id": "go_main", "title": "1"}],
+                "not_found": "❌ No product found with that article number.",
+            },
+            "next": "awaiting_article",
+            "label": "Products sent",
+        },
+        "browse": {
+            "handler": "browse_categories",
+            "params": {"categories": "Pick a category 👇", "button": "View",
+                       "empty": "No products to browse yet, please enter an article number instead."},
+            "next": "browsing",
+            "label": "Categories sent",
+        },
+        "browse_select": {
+            "handler": "browse_select",
+            "params": {
+                "categories": "Pick a category 👇",
+                "prices": "Pick a price range for {category}",
+                "articles": "{where} — pick an article (page {page} of {pages})",
+                "button": "View",
+                "empty": "No products to browse yet, please enter an article number instead.",
+                "body": "✅ Reply with 1 to go back to the main menu, tap Browse to keep browsing or enter "
+                        "another article number.",
+                "buttons": [{"id": "go_main", "title": "1"}, {"id": "browse", "title": "Browse"}],
+                "not_found": "❌ No product found with that article number.",
+            },
+            "next": "browsing",
+            "label": "Browse step sent",
+        },
+        "fallback": {"send": {"type": "text", "body": "Please type 'hi' to start again."}, "label": "Fallback"},
+    },
+}
+
+
+# ====== Payloads ======
+def reply_buttons(buttons):
+    return [{"type": "reply", "reply": {"id": b["id"], "title": b["title"]}} for b in buttons]
+
+
+def build_payload(spec):
+    """Turns a message spec from a flow into a Graph payload without the recipient."""
+    kind = spec.get("type", "text")
+    if kind == "text":
+        return {"messaging_product": "whatsapp", "type": "text", "text": {"body": spec["body"]}}
+    if kind == "buttons":
+        interactive = {"type": "button", "body": {"text": spec["body"]},
+                       "action": {"buttons": reply_buttons(spec["buttons"])}}
+    elif kind == "list":
+        interactive = {"type": "list", "body": {"text": spec["body"]},
+                       "action": {"button": spec.get("button", "Choose"), "sections": spec["sections"]}}
+    else:
+        raise ValueError(f"unknown message type '{kind}'")
+    if spec.get("header"):
+        interactive["header"] = {"type": "text", "text": spec["header"]}
+    return {"messaging_product": "whatsapp", "type": "interactive", "interactive": interactive}
+
+
+# ====== Compiled Flow ======
+class Action:
+    """One compiled action; ``payload`` is prebuilt once and shared by every send."""
+
+    __slots__ = ("name", "label", "payload", "kind", "handler", "params", "next_state")
+
+    def __init__(self, name, label, payload, kind, handler, params, next_state):
+        self.name = name
+        self.label = label
+        self.payload = payload
+        self.kind = kind
+        self.handler = handler
+        self.params = params
+        self.next_state = next_state
+
+
+class Flow:
+    """
+    A flow compiled into dispatch tables: resolving (state, input) is at most
+    three dict lookups, however many states and menus the flow defines.
+    """
+
+    def __init__(self, definition, handlers, version=0):
+        self.version = version
+        self.definition = definition
+        actions = definition.get("actions") or {}
+        if not actions:
+            raise ValueError("flow has no actions")
+
+        self.actions = {}
+        for name, spec in actions.items():
+            handler = spec.get("handler")
+            if handler is not None and handler not in handlers:
+                raise ValueError(f"action '{name}' uses unknown handler '{handler}'")
+            if not spec.get("send") and handler is None:
+                raise ValueError(f"action '{name}' neither sends a message nor runs a handler")
+            send = spec.get("send")
+            self.actions[name] = Action(
+                name=name,
+                label=spec.get("label", name),
+                payload=build_payload(send) if send else None,
+                kind=(send or {}).get("type"),
+                handler=handlers.get(handler) if handler else None,
+                params=spec.get("params") or {},
+                next_state=spec.get("next"),
+            )
+
+        def action(name, where):
+            if name not in self.actions:
+                raise ValueError(f"{where} points at unknown action '{name}'")
+            return self.actions[name]
+
+        self._global = {k.strip().lower(): action(v, f"global '{k}'")
+                        for k, v in (definition.get("global") or {}).items()}
+        self._table, self._defaults = {}, {}
+        for state, spec in (definition.get("states") or {}).items():
+            for text, name in (spec.get("on") or {}).items():
+                self._table[(state, text.strip().lower())] = action(name, f"state '{state}' input '{text}'")
+            if spec.get("default"):
+                self._defaults[state] = action(spec["default"], f"state '{state}' default")
+        self._fallback = action(definition.get("fallback", "fallback"), "fallback")
+
+    def resolve(self, state, text):
+        return (self._global.get(text)
+                or self._table.get((state, text))
+                or self._defaults.get(state)
+                or self._fallback)
+
+
+# ====== Registry (hot reload) ======
+class FlowRegistry:
+    """
+    Serves the compiled conversation flow. The definition lives in the flows
+    table (falling back to DEFAULT_FLOW); each worker checks its version at
+    most once per FLOW_CHECK_INTERVAL and recompiles when it moved, so menus
+    can change without a restart. A definition that fails to compile is
+    rejected on save and never replaces the running flow.
+    """
+
+    def __init__(self, name="main", check_interval=FLOW_CHECK_INTERVAL):
+        self.name = name
+        self.check_interval = check_interval
+        self.handlers = {}
+        self._flow = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def register_handler(self, name, fn):
+        """``fn(to, text, state, params)`` runs for actions with ``"handler": name``."""
+        self.handlers[name] = fn
+
+    def _stored(self):
+        return whatsapp_db.fetchone("SELECT definition, version FROM flows WHERE name = ?", (self.name,))
+
+    def _stored_version(self):
+        row = whatsapp_db.fetchone("SELECT version FROM flows WHERE name = ?", (self.name,))
+        return row[0] if row else 0
+
+    def load(self):
+        with self._lock:
+            row = self._stored()
+            version = row[1] if row else 0
+            definition = json.loads(row[0]) if row and row[0] else DEFAULT_FLOW
+            try:
+                self._flow = Flow(definition, self.handlers, version)
+            except (ValueError, KeyError, TypeError) as e:
+                log.error("❌ Stored flow does not compile, keeping the previous one",
+                          extra={"flow": self.name, "version": version, "error": str(e)})
+                if self._flow is None:
+                    self._flow = Flow(DEFAULT_FLOW, self.handlers, 0)
+                self._flow.version = version  # do not retry until it changes again
+            self._checked_at = time.time()
+            log.info("🧭 Flow loaded", extra={"flow": self.name, "version": version})
+        return self._flow
+
+    def current(self):
+        flow = self._flow
+        if flow is None:
+            return self.load()
+        if time.time() - self._checked_at >= self.check_interval:
+            if self._stored_version() != flow.version:
+                return self.load()
+            self._checked_at = time.time()
+        return flow
+
+    def definition(self):
+        row = self._stored()
+        return json.loads(row[0]) if row and row[0] else copy.deepcopy(DEFAULT_FLOW)
+
+    def save(self, definition):
+        """Validates and stores a new definition; returns its version."""
+        Flow(definition, self.handlers)  # raises ValueError on a broken flow
+        with whatsapp_db.transaction() as conn:
+            conn.execute(
+                """
+                INSERT INTO flows (name, definition, version, updated_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET definition = excluded.definition,
+                    version = flows.version + 1, updated_at = excluded.updated_at
+                """,
+                (self.name, json.dumps(definition, ensure_ascii=False), time.time()),
+            )
+        self.invalidate()
+        return self._stored_version()
+
+    def reset(self):
+        """Clears the stored definition so DEFAULT_FLOW applies again (the version still moves)."""
+        whatsapp_db.execute(
+            "UPDATE flows SET definition = NULL, version = version + 1, updated_at = ? WHERE name = ?",
+            (time.time(), self.name),
+        )
+        self.invalidate()
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def stats(self):
+        flow = self._flow
+        if flow is None:
+            return {"version": None}
+        return {"version": flow.version, "actions": len(flow.actions),
+                "routes": len(flow._global) + len(flow._table)}
+
+
+flows = FlowRegistry()
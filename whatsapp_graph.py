@@ -0,0 +1,242 @@
+# whatsapp_graph.py
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+from whatsapp_ratelimit import limiter
+
+load_dotenv()
+
+log = get_logger("graph")
+
+# ====== Environment Variables ======
+ACCESS_TOKEN = os.getenv("WHATSAPP_TOKEN")
+PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
+GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v21.0")
+GRAPH_BASE_URL = os.getenv("GRAPH_BASE_URL", "https://graph.facebook.com").rstrip("/")
+
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "20"))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "5"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "20"))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "3"))
+GRAPH_BACKOFF = float(os.getenv("GRAPH_BACKOFF", "0.5"))
+GRAPH_BREAKER_THRESHOLD = int(os.getenv("GRAPH_BREAKER_THRESHOLD", "5"))
+GRAPH_BREAKER_COOLDOWN = float(os.getenv("GRAPH_BREAKER_COOLDOWN", "30"))
+
+CIRCUIT_OPEN = "circuit open"
+
+
+def messages_url():
+    return f"{GRAPH_BASE_URL}/{GRAPH_API_VERSION}/{PHONE_ID}/messages"
+
+
+def is_transient(code):
+    """True for outcomes worth retrying later: network errors, 5xx, 429 and an open breaker."""
+    return code >= 500 or code == 429
+
+
+class CircuitBreaker:
+    """
+    Fails sends fast while the Graph API is unhealthy.
+
+    After ``threshold`` consecutive transient failures the breaker opens and
+    every call is rejected without touching the network. Once ``cooldown``
+    seconds have passed a single probe is let through (half-open): success
+    closes the breaker, failure opens it for another cooldown. State is per
+    worker process; each one finds out on its own within a few calls.
+    """
+
+    def __init__(self, threshold=GRAPH_BREAKER_THRESHOLD, cooldown=GRAPH_BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state, self._probing = "half_open", False
+            if self.state == "closed" or (self.state == "half_open" and not self._probing):
+                self._probing = self.state == "half_open"
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            previous = self.state
+            if ok:
+                self.state, self.failures, self._probing = "closed", 0, False
+            else:
+                self.failures += 1
+                if self.state == "half_open" or self.failures >= self.threshold:
+                    self.state, self._opened_at, self._probing = "open", time.monotonic(), False
+                    if previous != "open":
+                        self.opens += 1
+        if self.state != previous:
+            level = log.info if self.state == "closed" else log.warning
+            level("🔌 Graph circuit %s", self.state, extra={"failures": self.failures, "previous": previous})
+
+    def release(self):
+        """Gives back a half-open probe that never reached the network."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+
+    def retry_in(self):
+        """Seconds until a call would be let through again (0 when closed or probing is due)."""
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "open": int(self.state != "closed"), "failures": self.failures,
+                    "opens": self.opens, "rejected": self.rejected}
+
+
+class GraphClient:
+    """
+    Shared keep-alive client for the WhatsApp Cloud API.
+
+    One pooled requests.Session per worker process, so sends reuse TLS
+    connections to graph.facebook.com. Only failures where the message
+    cannot have gone out are retried here: connection errors and 429
+    (backing off, honouring Retry-After). A read timeout or 5xx may follow
+    a delivered message, so it is returned as-is and left to the outbox.
+    Every call is timed for the stats endpoint, and a circuit breaker
+    rejects calls outright while the API keeps failing.
+    """
+
+    def __init__(self, pool_size=GRAPH_POOL_SIZE, timeout=(GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT),
+                 max_retries=GRAPH_MAX_RETRIES, backoff=GRAPH_BACKOFF):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.by_status = {}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _build_session(self):
+        # POST is not idempotent: never resend after the request may have been read.
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            other=0,
+            status=self.max_retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(429,),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "Authorization": f"Bearer {ACCESS_TOKEN}",
+            "Content-Type": "application/json",
+        })
+        return session
+
+    @property
+    def session(self):
+        # Sockets must not be shared across a gunicorn fork.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _record(self, status, elapsed, retries=0):
+        with self._lock:
+            self.calls += 1
+            self.retries += retries
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+            if not 200 <= status < 300:
+                self.errors += 1
+        metrics.observe("graph_request_seconds", elapsed)
+        metrics.inc("graph_responses_total", status=status)
+        if retries:
+            metrics.inc("graph_retries_total", retries)
+
+    def post(self, url, payload):
+        """POSTs JSON to the Graph API and returns (data, status_code); 503 while the circuit is open."""
+        if not self.breaker.allow():
+            return {"error": CIRCUIT_OPEN}, 503
+        return self._send(url, payload)
+
+    def _send(self, url, payload):
+        start = time.perf_counter()
+        try:
+            res = self.session.post(url, json=payload, timeout=self.timeout)
+        except Exception as e:
+            self._record(0, time.perf_counter() - start)
+            self.breaker.record(False)
+            return {"error": str(e)}, 500
+
+        retry_state = getattr(res.raw, "retries", None)
+        self._record(res.status_code, time.perf_counter() - start,
+                     len(retry_state.history) if retry_state else 0)
+        self.breaker.record(not is_transient(res.status_code))
+        try:
+            return res.json(), res.status_code
+        except ValueError:
+            return {"error": res.text}, res.status_code
+
+    def post_message(self, payload):
+        """Sends a message once the shared rate limiter allows it (an open circuit fails before waiting)."""
+        if not self.breaker.allow():
+            return {"error": CIRCUIT_OPEN}, 503
+        try:
+            limiter.acquire(payload.get("to"))
+        except BaseException:
+            # e.g. "database is locked": the probe never went out, so let the next call take it.
+            self.breaker.release()
+            raise
+        return self._send(messages_url(), payload)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "by_status": {str(k): v for k, v in self.by_status.items()},
+                "latency_avg_ms": round(self.latency_total / (self.calls or 1) * 1000, 2),
+                "latency_max_ms": round(self.latency_max * 1000, 2),
+                "breaker": self.breaker.stats(),
+            }
+
+
+graph = GraphClient()
+metrics.register_collector("graph_breaker", graph.breaker.stats, counters=("opens", "rejected"), gauges=("open",))
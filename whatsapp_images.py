@@ -0,0 +1,136 @@
+# whatsapp_images.py
+import io
+import os
+import time
+import uuid
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_queue import JobQueue
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+IMAGE_UPLOAD_WORKERS = int(os.getenv("IMAGE_UPLOAD_WORKERS", "2"))
+IMAGE_UPLOAD_ATTEMPTS = int(os.getenv("IMAGE_UPLOAD_ATTEMPTS", "4"))
+IMAGE_UPLOAD_BACKOFF = float(os.getenv("IMAGE_UPLOAD_BACKOFF", "2"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(whatsapp_db.DATA_DIR, "uploads"))
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+log = get_logger("images")
+
+
+def prepare_image(fileobj):
+    """
+    Downscales to IMAGE_MAX_SIDE and re-encodes as progressive JPEG, which is
+    what WhatsApp fetches on every send_image. Returns the JPEG bytes, or the
+    original bytes if Pillow cannot read the file.
+    """
+    from PIL import Image, ImageOps
+
+    raw = fileobj.read()
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                rgba = img.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                img = background
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    except Exception as e:
+        log.warning("⚠️ Image resize skipped", extra={"error": str(e)})
+        return raw
+    data = out.getvalue()
+    return data if len(data) < len(raw) else raw
+
+
+_cloudinary = {"configured": False}
+
+
+def upload_bytes(data):
+    # Imported on first upload so webhook-only workers never load the SDK.
+    import cloudinary
+    import cloudinary.uploader
+
+    if not _cloudinary["configured"]:
+        cloudinary.config(
+            cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
+            api_key=os.getenv("CLOUDINARY_API_KEY"),
+            api_secret=os.getenv("CLOUDINARY_API_SECRET")
+        )
+        _cloudinary["configured"] = True
+    result = cloudinary.uploader.upload(io.BytesIO(data), folder="walkmate")
+    return result.get("secure_url")
+
+
+# ====== Background Upload ======
+def queue_upload(product_id, data):
+    """Spools the prepared image to disk and uploads it in the background."""
+    path = os.path.join(UPLOAD_DIR, f"{product_id}-{uuid.uuid4().hex}.jpg")
+    with open(path, "wb") as f:
+        f.write(data)
+    upload_queue.submit(product_id, {"product_id": product_id, "path": path})
+
+
+def _set_failed(product_id):
+    whatsapp_db.execute(
+        "UPDATE products SET image_status = 'failed' WHERE id = ? AND image_status = 'pending'", (product_id,)
+    )
+
+
+def _upload_job(payload):
+    """
+    Uploads one spooled image, retrying with exponential backoff. When every
+    attempt fails the product is marked 'failed' and the spool file is kept,
+    so retry_failed_uploads() can send it again later.
+    """
+    product_id, path = payload["product_id"], payload["path"]
+    row = whatsapp_db.fetchone("SELECT image_status FROM products WHERE id = ?", (product_id,))
+    if not row or row[0] != "pending":
+        # Deleted, or re-imported with a new image since this was queued.
+        if os.path.exists(path):
+            os.remove(path)
+        log.info("🖼️ Image upload dropped", extra={"product_id": product_id})
+        return
+    if not os.path.exists(path):
+        # Nothing left to retry from; fail the product instead of the job.
+        _set_failed(product_id)
+        log.error("❌ Image spool file missing", extra={"product_id": product_id, "path": path})
+        return
+    for attempt in range(1, IMAGE_UPLOAD_ATTEMPTS + 1):
+        try:
+            with open(path, "rb") as f:
+                url = upload_bytes(f.read())
+            break
+        except Exception as e:
+            if attempt == IMAGE_UPLOAD_ATTEMPTS:
+                _set_failed(product_id)
+                raise
+            delay = IMAGE_UPLOAD_BACKOFF * 2 ** (attempt - 1)
+            log.warning("⚠️ Image upload failed, retrying", extra={"product_id": product_id, "attempt": attempt,
+                                                                   "retry_in": delay, "error": str(e)})
+            time.sleep(delay)
+    whatsapp_db.execute(
+        "UPDATE products SET image = ?, image_status = 'ready' WHERE id = ? AND image_status = 'pending'",
+        (url, product_id),
+    )
+    os.remove(path)
+    log.info("🖼️ Image uploaded", extra={"product_id": product_id})
+
+
+def retry_failed_uploads():
+    """Re-queues every upload that gave up; returns how many products went back to pending."""
+    def mark_pending(conn, payloads):
+        # Same transaction as the requeue, so no job can run before its product is pending.
+        conn.executemany(
+            "UPDATE products SET image_status = 'pending' WHERE id = ? AND image_status = 'failed'",
+            [(p["product_id"],) for p in payloads],
+        )
+
+    return len(upload_queue.requeue_failed(prepare=mark_pending))
+
+
+# _upload_job already retries with backoff; a failed job waits for retry_failed_uploads().
+upload_queue = JobQueue("image_upload", _upload_job, lanes=IMAGE_UPLOAD_WORKERS, max_attempts=1)
@@ -0,0 +1,169 @@
+# whatsapp_import.py
+import csv
+import io
+import os
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import whatsapp_db
+from whatsapp_images import prepare_image, upload_bytes
+
+IMPORT_COLUMNS = ("main_product", "option", "image", "description", "mrp", "category")
+IMPORT_UPLOAD_WORKERS = int(os.getenv("IMPORT_UPLOAD_WORKERS", "8"))
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "20000"))
+
+
+# ====== Parsing ======
+def read_sheet(filename, stream):
+    """Reads an .xlsx or .csv upload into a list of dicts keyed by lowercased header."""
+    name = (filename or "").lower()
+    if name.endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = [str(h or "").strip().lower() for h in next(rows, ())]
+            records = [
+                {h: ("" if v is None else str(v).strip()) for h, v in zip(header, row)}
+                for row in rows if any(v not in (None, "") for v in row)
+            ]
+        finally:
+            workbook.close()
+        return records
+    if name.endswith(".csv"):
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig")
+        return [
+            {(k or "").strip().lower(): (v or "").strip() for k, v in rec.items()}
+            for rec in csv.DictReader(text)
+        ]
+    raise ValueError("Spreadsheet must be .xlsx or .csv")
+
+
+def _clean_row(rec):
+    row = {col: str(rec.get(col) or "").strip() for col in IMPORT_COLUMNS}
+    row["main_product"] = row["main_product"].lower()
+    if row["mrp"].endswith(".0"):
+        # Excel hands whole numbers back as floats.
+        row["mrp"] = row["mrp"][:-2]
+    return row
+
+
+# ====== Images ======
+def _zip_index(zf):
+    """Maps both full member paths and bare file names (lowercased) to members."""
+    index = {}
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        index.setdefault(info.filename.lower(), info.filename)
+        index.setdefault(posixpath.basename(info.filename).lower(), info.filename)
+    return index
+
+
+def _upload_member(zf, member):
+    with zf.open(member) as f:
+        return upload_bytes(prepare_image(f))
+
+
+def upload_images(zf, members):
+    """Uploads zip members concurrently; returns {member: url or Exception}."""
+    results = {}
+    if not members:
+        return results
+    with ThreadPoolExecutor(max_workers=IMPORT_UPLOAD_WORKERS, thread_name_prefix="import-upload") as pool:
+        futures = {member: pool.submit(_upload_member, zf, member) for member in members}
+        for member, future in futures.items():
+            try:
+                results[member] = future.result()
+            except Exception as e:
+                results[member] = e
+    return results
+
+
+# ====== Import ======
+def import_products(records, images_zip=None, mode="insert"):
+    """
+    Validates rows, uploads their images in parallel and writes everything in
+    a single transaction. ``mode="upsert"`` updates rows that already exist
+    for the same (main_product, option) instead of adding duplicates.
+    Returns a report with per-row errors (row numbers match the sheet).
+    """
+    if len(records) > IMPORT_MAX_ROWS:
+        raise ValueError(f"At most {IMPORT_MAX_ROWS} rows per import")
+
+    zf = zipfile.ZipFile(images_zip) if images_zip else None
+    index = _zip_index(zf) if zf else {}
+    errors, valid = [], []
+
+    try:
+        for line, rec in enumerate(records, start=2):  # line 1 is the header
+            row = _clean_row(rec)
+            if not row["main_product"] or not row["option"]:
+                errors.append({"row": line, "error": "main_product and option are required"})
+                continue
+            image = row["image"]
+            if image and not image.lower().startswith(("http://", "https://")):
+                member = index.get(image.lower())
+                if member is None:
+                    errors.append({"row": line, "error": f"image '{image}' not found in zip"})
+                    continue
+                row["image"] = ("zip", member)
+            valid.append((line, row))
+
+        members = {row["image"][1] for _, row in valid if isinstance(row["image"], tuple)}
+        uploaded = upload_images(zf, members)
+    finally:
+        if zf:
+            zf.close()
+
+    ready = []
+    for line, row in valid:
+        if isinstance(row["image"], tuple):
+            url = uploaded.get(row["image"][1])
+            if isinstance(url, Exception) or not url:
+                errors.append({"row": line, "error": f"image upload failed: {url}"})
+                continue
+            row["image"] = url
+        ready.append(row)
+
+    if mode == "upsert":
+        # Within one sheet the last row for a (main_product, option) wins.
+        ready = list({(r["main_product"], r["option"]): r for r in ready}.values())
+
+    with whatsapp_db.transaction() as conn:
+        existing = {}
+        if mode == "upsert" and ready:
+            for pid, main_product, option in conn.execute("SELECT id, main_product, option FROM products"):
+                existing.setdefault((main_product, option), pid)
+
+        inserts, updates = [], []
+        for row in ready:
+            values = tuple(row[c] or None for c in IMPORT_COLUMNS)
+            pid = existing.get((row["main_product"], row["option"]))
+            if pid is None:
+                inserts.append(values)
+            else:
+                # Keep the stored image if the sheet row has none.
+                updates.append(values[2:] + (pid,))
+
+        conn.executemany(
+            f"INSERT INTO products ({', '.join(IMPORT_COLUMNS)}) VALUES ({', '.join('?' * len(IMPORT_COLUMNS))})",
+            inserts,
+        )
+        # A new image replaces whatever upload was pending or failed for the old one.
+        conn.executemany(
+            "UPDATE products SET image_status = CASE WHEN ?1 IS NULL OR ?1 IS image THEN image_status END, "
+            "image = COALESCE(?1, image), description = ?2, mrp = ?3, category = ?4 WHERE id = ?5",
+            updates,
+        )
+
+    return {
+        "rows": len(records),
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "failed": len(errors),
+        "images_uploaded": sum(1 for v in uploaded.values() if not isinstance(v, Exception)),
+        "errors": sorted(errors, key=lambda e: e["row"]),
+    }
@@ -0,0 +1,187 @@
+# whatsapp_logging.py
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from whatsapp_metrics import metrics
+
+# ====== Logging Config ======
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")          # e.g. "admin=WARNING,payload=INFO"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")      # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+LOG_REDACT = os.getenv("LOG_REDACT", "1") == "1"
+
+ROOT_LOGGER = "whatsapp"
+
+# ====== PII Redaction ======
+PII_KEYS = {"to", "from", "wa_id", "phone", "phone_number", "recipient_id", "mobile", "profile"}
+_PHONE = re.compile(r"(?<!\d)(?:\+?\d{11,15}|[6-9]\d{9})(?!\d)")
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def mask_phone(value):
+    """Keeps only the last four digits of a phone number."""
+    digits = str(value)
+    return "*" * max(len(digits) - 4, 0) + digits[-4:]
+
+
+def redact(value, key=None):
+    """Masks phone numbers in nested dicts/lists/strings; PII keys are masked outright."""
+    if key in PII_KEYS and value not in (None, ""):
+        return "***" if isinstance(value, (dict, list, tuple)) else mask_phone(value)
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return _PHONE.sub(lambda m: mask_phone(m.group()), value)
+    return value
+
+
+# ====== Formatters ======
+def _extras(record):
+    return {k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS and not k.startswith("_")}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg plus any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(_extras(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if LOG_REDACT:
+            entry = redact(entry)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable variant for local runs (LOG_FORMAT=text)."""
+
+    def format(self, record):
+        msg, extras = record.getMessage(), _extras(record)
+        if LOG_REDACT:
+            msg, extras = redact(msg), redact(extras)
+        fields = " ".join(f"{k}={v}" for k, v in extras.items())
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        text = f"{stamp} {record.levelname:<7} {record.name}: {msg}" + (f" | {fields}" if fields else "")
+        return text + "\n" + record.exc_text if record.exc_text else text
+
+
+# ====== Async Handler ======
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without ever blocking the request:
+    when the queue is full the record is dropped and counted instead.
+    Formatting, redaction and stdout writes all happen on the listener.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Keep args and extras intact for the listener's formatter; only
+        # resolve the traceback now since it cannot cross threads lazily.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {"dropped": self.dropped, "queued": self.queue.qsize()}
+
+
+def _level(name):
+    level = logging.getLevelName(name.strip().upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+def _apply_levels(spec):
+    logging.getLogger(ROOT_LOGGER).setLevel(_level(LOG_LEVEL))
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        name = name.strip()
+        if not name.startswith(ROOT_LOGGER):
+            name = f"{ROOT_LOGGER}.{name}"
+        logging.getLogger(name).setLevel(_level(level))
+
+
+_state = {"handler": None, "listener": None}
+
+
+def _start_listener():
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    listener = QueueListener(_state["handler"].queue, output, respect_handler_level=False)
+    listener.start()
+    _state["listener"] = listener
+
+
+def _after_fork():
+    # The listener thread does not survive a fork; give the child its own.
+    if _state["handler"] is not None:
+        _state["handler"].queue = queue.Queue(LOG_QUEUE_SIZE)
+        _state["handler"].dropped = 0
+        _start_listener()
+
+
+def _stop():
+    if _state["listener"] is not None:
+        _state["listener"].stop()
+
+
+def configure():
+    """Installs the async handler on the ``whatsapp`` logger tree (idempotent)."""
+    if _state["handler"] is not None:
+        return
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(handler)
+    root.propagate = False
+    _state["handler"] = handler
+    _apply_levels(LOG_LEVELS)
+    _start_listener()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork)
+    atexit.register(_stop)
+    metrics.register_collector("log", lambda: _state["handler"].stats(), counters=("dropped",), gauges=("queued",))
+
+
+def get_logger(name):
+    configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+# ====== Sampled Payload Logs ======
+payload_log = get_logger("payload")
+
+
+def log_payload(message, payload, **fields):
+    """Logs a full payload for LOG_PAYLOAD_SAMPLE_RATE of calls (after redaction)."""
+    if LOG_PAYLOAD_SAMPLE_RATE <= 0 or not payload_log.isEnabledFor(logging.INFO):
+        return
+    if LOG_PAYLOAD_SAMPLE_RATE < 1 and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    payload_log.info(message, extra=dict(fields, payload=payload))
@@ -0,0 +1,229 @@
+# whatsapp_metrics.py
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+METRICS_WORKER_TTL = int(os.getenv("METRICS_WORKER_TTL", "3600"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RETIRED_WORKER = "retired"
+
+# Not whatsapp_logging.get_logger: that module imports this one.
+log = logging.getLogger("whatsapp.metrics")
+
+_SQL_SPACE = re.compile(r"\s+")
+_SQL_VALUES = re.compile(r"\(\?(?:,\s*\?)*\)(?:\s*,\s*\(\?(?:,\s*\?)*\))+")
+_SQL_IN_LIST = re.compile(r"\?(?:\s*,\s*\?){2,}")
+
+
+def statement_label(sql):
+    """Collapses a SQL string into a short, low-cardinality label."""
+    sql = _SQL_SPACE.sub(" ", sql).strip()
+    sql = _SQL_VALUES.sub("(…)", sql)
+    sql = _SQL_IN_LIST.sub("…", sql)
+    return sql[:80].replace("\\", "").replace('"', "'")
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    inner = ",".join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{inner}}}"
+
+
+class Metrics:
+    """
+    Per-process counters, gauges and latency histograms.
+
+    Recording is a dict update under a lock. Every METRICS_FLUSH_INTERVAL
+    seconds each gunicorn worker writes its cumulative values to the
+    metric_samples table under its own worker id, and /metrics sums them:
+    counters over every worker that ever ran, gauges over live workers only.
+    """
+
+    def __init__(self):
+        self._values = {}       # (name, labels) -> value
+        self._kinds = {}        # name -> counter | gauge | histogram
+        self._collectors = []
+        self._shared = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self.worker_id = None
+
+    # ---------- recording ----------
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0) + value
+        if self._pid != os.getpid():
+            self._ensure_started()
+
+    def observe(self, name, seconds, **labels):
+        """Adds one observation to a cumulative, fixed-bucket histogram."""
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._kinds.setdefault(name, "histogram")
+            key = (name, labels)
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            for i, le in enumerate(LATENCY_BUCKETS):
+                if seconds <= le:
+                    hist[0][i] += 1
+                    break
+            hist[1] += 1
+            hist[2] += seconds
+        if self._pid != os.getpid():
+            self._ensure_started()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the block; the yielded dict can add labels (e.g. the outcome)."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, prefix, fn, counters=(), gauges=(), **labels):
+        """Exports selected keys of ``fn()`` (a stats dict) as ``<prefix>_<key>``."""
+        self._collectors.append((prefix, fn, tuple(counters), tuple(gauges), tuple(sorted(labels.items()))))
+
+    def register_shared(self, prefix, fn, gauges=(), **labels):
+        """
+        Like register_collector for gauges that already describe every worker
+        (e.g. a row count in the shared database): read once per scrape
+        instead of being flushed per worker and summed.
+        """
+        self._shared.append((prefix, fn, tuple(gauges), tuple(sorted(labels.items()))))
+
+    # ---------- aggregation ----------
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Anything inherited through a fork was the parent's.
+            self._values = {}
+            self._pid = os.getpid()
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{int(time.time())}"
+        threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("❌ Metrics flush failed")
+
+    def samples(self):
+        """Flattens this process's values into (series, kind, value) rows."""
+        with self._lock:
+            values = [(name, labels, v if not isinstance(v, list) else [list(v[0]), v[1], v[2]])
+                      for (name, labels), v in self._values.items()]
+            kinds = dict(self._kinds)
+
+        rows = []
+        for name, labels, v in values:
+            kind = kinds[name]
+            if kind != "histogram":
+                rows.append((_series(name, labels), kind, v))
+                continue
+            buckets, count, total = v
+            running = 0
+            for le, n in zip(LATENCY_BUCKETS, buckets):
+                running += n
+                rows.append((_series(f"{name}_bucket", labels + (("le", f"{le:g}"),)), kind, running))
+            rows.append((_series(f"{name}_bucket", labels + (("le", "+Inf"),)), kind, count))
+            rows.append((_series(f"{name}_sum", labels), kind, total))
+            rows.append((_series(f"{name}_count", labels), kind, count))
+
+        for prefix, fn, counters, gauges, labels in self._collectors:
+            try:
+                stats = fn()
+            except Exception:
+                continue
+            for kind, keys in (("counter", counters), ("gauge", gauges)):
+                for k in keys:
+                    if k in stats:
+                        rows.append((_series(f"{prefix}_{k}", labels), kind, stats[k]))
+        return rows
+
+    def flush(self):
+        import whatsapp_db
+
+        self._ensure_started()
+        now = time.time()
+        with whatsapp_db.transaction() as conn:
+            conn.executemany(
+                "REPLACE INTO metric_samples (worker, series, kind, value, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(self.worker_id, series, kind, value, now) for series, kind, value in self.samples()],
+            )
+
+    def _retire_stale(self, conn, now):
+        # Fold counters of workers gone for METRICS_WORKER_TTL into one row
+        # each so the totals stay monotonic while the table stays small.
+        cutoff = now - METRICS_WORKER_TTL
+        conn.execute(
+            """
+            INSERT INTO metric_samples (worker, series, kind, value, updated_at)
+            SELECT ?, series, kind, SUM(value), ? FROM metric_samples
+            WHERE worker != ? AND kind != 'gauge' AND updated_at < ?
+            GROUP BY series, kind
+            ON CONFLICT(worker, series) DO UPDATE SET value = value + excluded.value
+            """,
+            (RETIRED_WORKER, now, RETIRED_WORKER, cutoff),
+        )
+        conn.execute(
+            "DELETE FROM metric_samples WHERE worker != ? AND updated_at < ?", (RETIRED_WORKER, cutoff)
+        )
+
+    def collect(self):
+        """Returns [(series, kind, value)] summed across workers, sorted by series."""
+        import whatsapp_db
+
+        self.flush()
+        now = time.time()
+        live_after = now - 3 * METRICS_FLUSH_INTERVAL
+        with whatsapp_db.transaction() as conn:
+            self._retire_stale(conn, now)
+            rows = conn.execute(
+                """
+                SELECT series, kind, SUM(value) FROM metric_samples
+                WHERE kind != 'gauge' OR updated_at >= ? OR worker = ?
+                GROUP BY series, kind ORDER BY series
+                """,
+                (live_after, self.worker_id),
+            ).fetchall()
+
+        for prefix, fn, gauges, labels in self._shared:
+            try:
+                stats = fn()
+            except Exception:
+                log.exception("❌ Shared metrics collector failed", extra={"prefix": prefix})
+                continue
+            rows += [(_series(f"{prefix}_{k}", labels), "gauge", stats[k]) for k in gauges if k in stats]
+        return sorted(rows)
+
+    def render_prometheus(self):
+        lines, typed = [], set()
+        for series, kind, value in self.collect():
+            name = series.split("{", 1)[0]
+            if kind == "histogram":
+                name = re.sub(r"_(bucket|sum|count)$", "", name)
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{series} {value:.6g}" if isinstance(value, float) else f"{series} {value}")
+        return "\n".join(lines) + "\n"
+
+    def render_json(self):
+        return {series: value for series, _, value in self.collect()}
+
+
+metrics = Metrics()
@@ -1,42 +1,123 @@
 # whatsapp_orders.py
+import csv
+import io
 import os
-import requests
 from flask import request
 from dotenv import load_dotenv
 
+import whatsapp_broadcast
+import whatsapp_graph
+from whatsapp_broadcast import template_payload
+from whatsapp_delivery import DELIVERY_ROLLUP_RETENTION_DAYS, delivery
+from whatsapp_logging import get_logger
+from whatsapp_outbox import outbox
+
 load_dotenv()
 
-ACCESS_TOKEN = os.getenv("WHATSAPP_TOKEN")
-PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
-GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v21.0")
+log = get_logger("orders")
+
 BACKUP_TOKEN = os.getenv("BACKUP_TOKEN", "WalkBack2025")
 
+# Body placeholders of the approved shipment_details template, in order.
+SHIPMENT_TEMPLATE = "shipment_details"
+SHIPMENT_FIELDS = ("order_id", "cases", "vehicle", "driver_name", "driver_contact")
+SHIPMENT_BATCH_MAX = int(os.getenv("SHIPMENT_BATCH_MAX", "500"))
+
 def graph_messages_url():
     """Builds Graph API message URL"""
-    return f"https://graph.facebook.com/{GRAPH_API_VERSION}/{PHONE_ID}/messages"
-
-def _post_whatsapp(payload):
-    """Send payload to WhatsApp Graph API"""
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    url = graph_messages_url()
+    return whatsapp_graph.messages_url()
+
+def _post_whatsapp(payload, key=None):
+    """Send payload to WhatsApp Graph API; transient failures are queued in the outbox (202)."""
+    data, code = outbox.deliver(payload, "orders", key=key)
+    if code == 202:
+        log.warning("⏳ Template queued for retry", extra={"to": payload.get("to"), "outbox_id": data.get("outbox_id"),
+                                                          "error": data.get("error")})
+    elif code == 500 and "error" in data:
+        log.error("❌ WhatsApp send failed", extra={"to": payload.get("to"), "error": data["error"]})
+    elif code < 400:
+        messages = data.get("messages") or [{}]
+        log.info("📤 Template sent", extra={"to": payload.get("to"), "status": code,
+                                          "message_id": messages[0].get("id")})
+    else:
+        log.warning("❌ Template send rejected", extra={"to": payload.get("to"), "status": code,
+                                                      "error": data.get("error", data)})
+    return data, code
+
+
+def _idempotency_key():
+    """Optional caller key (Idempotency-Key header or idempotency_key arg) so retried calls send once."""
+    key = (request.headers.get("Idempotency-Key") or request.args.get("idempotency_key") or "").strip()
+    return key or None
+
+
+def _int_arg(name, default):
     try:
-        res = requests.post(url, headers=headers, json=payload, timeout=20)
-        print(f"📤 Template Sent {res.status_code}: {res.text}", flush=True)
-        return res.json(), res.status_code
-    except Exception as e:
-        print(f"❌ WhatsApp send failed: {e}", flush=True)
-        return {"error": str(e)}, 500
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _split_vars(value):
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value or "").split(",") if v.strip()]
+
+
+def _parse_bulk_rows(body):
+    """
+    Reads bulk recipients from a JSON body ({"recipients": [{"to", "vars", "ref"}]})
+    or a CSV upload / body with a "to" column and either a "vars" column or
+    var1..varN columns. Returns (rows, rejected).
+    """
+    if body:
+        raw = body.get("recipients") or []
+    else:
+        upload = request.files.get("file")
+        text = upload.read().decode("utf-8-sig") if upload else request.get_data(as_text=True)
+        raw = []
+        for rec in csv.DictReader(io.StringIO(text)):
+            rec = {(k or "").strip().lower(): (v or "").strip() for k, v in rec.items()}
+            if "vars" not in rec:
+                var_cols = sorted((k for k in rec if k.startswith("var") and k[3:].isdigit()), key=lambda k: int(k[3:]))
+                rec["vars"] = [rec[k] for k in var_cols]
+            raw.append(rec)
+
+    rows, rejected = [], []
+    for i, rec in enumerate(raw):
+        to = str(rec.get("to") or "").strip().replace("+", "")
+        if not to.isdigit():
+            rejected.append({"row": i, "error": "invalid or missing 'to'"})
+            continue
+        rows.append({"to": to, "params": _split_vars(rec.get("vars")), "ref": rec.get("ref")})
+    return rows, rejected
+
+
+def _validate_shipment(rec):
+    """Returns (to, params, error) for one shipment record."""
+    to = str(rec.get("to") or "").strip().replace("+", "")
+    params = [str(rec.get(f) or "").strip() for f in SHIPMENT_FIELDS]
+    missing = [f for f, v in zip(SHIPMENT_FIELDS, params) if not v or v == "0"]
+    if not to.isdigit():
+        return to, params, "invalid or missing 'to'"
+    if missing:
+        return to, params, f"{SHIPMENT_TEMPLATE} needs {len(SHIPMENT_FIELDS)} parameters, missing: {', '.join(missing)}"
+    return to, params, None
 
 
 def register_order_routes(app):
     """
     Registers WhatsApp message endpoints:
       /send-template - for order confirmations or general messages
+      /send-template-bulk - queued template broadcast to many recipients
+      /broadcast/<id> - broadcast job status, recipients and retry
+      /delivery/stats, /delivery/<id> - delivery and read latency per template
       /send-shipment - for shipment details
+      /send-shipment-batch - shipment details for a whole dispatch run
     """
+    outbox.start()
+    whatsapp_broadcast.broadcast_queue.start()
+
     # ===========================================================
     # 1️⃣ Generic Template Sender
     # ===========================================================
@@ -52,34 +133,84 @@ def register_order_routes(app):
             lang = request.args.get("lang", "en_US").strip()
             vars_csv = request.args.get("vars", "").strip()
 
-            parameters = [{"type": "text", "text": v.strip()}
-                          for v in vars_csv.split(",") if v.strip()]
-            components = [{"type": "body", "parameters": parameters}] if parameters else []
+            payload = template_payload(to, name, lang, _split_vars(vars_csv))
 
-            payload = {
-                "messaging_product": "whatsapp",
-                "to": to,
-                "type": "template",
-                "template": {
-                    "name": name,
-                    "language": {"code": lang},
-                    "components": components
-                }
-            }
-
-            data, code = _post_whatsapp(payload)
+            data, code = _post_whatsapp(payload, _idempotency_key())
 
             if code == 400 and "Number of parameters" in str(data):
-                print("⚠️ Template parameter mismatch detected. Check placeholders.", flush=True)
+                log.warning("⚠️ Template parameter mismatch detected. Check placeholders.", extra={"template": name})
 
             # Always return 200 OK to stop Meta retries
-            return {"ok": code in (200, 201), "data": data, "status": code}, 200
+            return {"ok": code in (200, 201, 202), "queued": code == 202, "data": data, "status": code}, 200
 
         except Exception as e:
-            print(f"❌ send-template error: {e}", flush=True)
+            log.exception("❌ send-template error")
             return {"ok": False, "error": str(e)}, 200
 
 
+    # ===========================================================
+    # 1️⃣b Bulk Template Broadcast
+    # ===========================================================
+    @app.post("/send-template-bulk")
+    def send_template_bulk():
+        try:
+            # Authenticate from the header or query string before the body is read;
+            # uploads are never parsed for their key. JSON callers may still send it inline.
+            api_key = request.headers.get("X-Api-Key") or request.args.get("api_key")
+            body = {}
+            if not api_key and request.is_json:
+                body = request.get_json(silent=True) or {}
+                api_key = body.get("api_key")
+            if api_key != BACKUP_TOKEN:
+                return {"ok": False, "error": "Unauthorized"}, 403
+            if not body and request.is_json:
+                body = request.get_json(silent=True) or {}
+            rows, rejected = _parse_bulk_rows(body)
+
+            name = (body.get("name") or request.values.get("name", "")).strip()
+            lang = (body.get("lang") or request.values.get("lang", "en_US")).strip()
+            if not name:
+                return {"ok": False, "error": "Missing template name"}, 400
+            if not rows:
+                return {"ok": False, "error": "No valid recipients", "rejected": rejected}, 400
+
+            job_id = whatsapp_broadcast.create_job(name, lang, rows)
+            log.info("📣 Broadcast queued", extra={"job_id": job_id, "recipients": len(rows), "rejected": len(rejected)})
+            return {"ok": True, "job_id": job_id, "total": len(rows), "rejected": rejected}, 202
+
+        except Exception as e:
+            log.exception("❌ send-template-bulk error")
+            return {"ok": False, "error": str(e)}, 500
+
+    @app.get("/broadcast/<int:job_id>")
+    def broadcast_status(job_id):
+        if request.args.get("api_key") != BACKUP_TOKEN:
+            return {"ok": False, "error": "Unauthorized"}, 403
+        job = whatsapp_broadcast.job_status(job_id)
+        if not job:
+            return {"ok": False, "error": "Job not found"}, 404
+        return {"ok": True, "job": job}, 200
+
+    @app.get("/broadcast/<int:job_id>/recipients")
+    def broadcast_recipients(job_id):
+        if request.args.get("api_key") != BACKUP_TOKEN:
+            return {"ok": False, "error": "Unauthorized"}, 403
+        rows = whatsapp_broadcast.job_recipients(
+            job_id,
+            status=request.args.get("status"),
+            limit=max(1, min(_int_arg("limit", 500), 5000)),
+            offset=max(0, _int_arg("offset", 0)),
+        )
+        return {"ok": True, "recipients": rows}, 200
+
+    @app.post("/broadcast/<int:job_id>/retry")
+    def broadcast_retry(job_id):
+        if request.args.get("api_key") != BACKUP_TOKEN:
+            return {"ok": False, "error": "Unauthorized"}, 403
+        count = whatsapp_broadcast.retry_failed(job_id)
+        return {"ok": True, "requeued": count}, 200
+
+
     # ===========================================================
     # 2️⃣ Shipment Template Sender
     # ===========================================================
@@ -113,12 +244,85 @@ def register_order_routes(app):
                 }
             }
 
-            data, code = _post_whatsapp(payload)
+            data, code = _post_whatsapp(payload, _idempotency_key())
             if code == 400 and "Number of parameters" in str(data):
-                print("⚠️ Shipment template parameter mismatch detected.", flush=True)
+                log.warning("⚠️ Shipment template parameter mismatch detected.")
 
-            return {"ok": code in (200, 201), "data": data, "status": code}, 200
+            return {"ok": code in (200, 201, 202), "queued": code == 202, "data": data, "status": code}, 200
 
         except Exception as e:
-            print(f"❌ send-shipment error: {e}", flush=True)
+            log.exception("❌ send-shipment error")
             return {"ok": False, "error": str(e)}, 200
+
+
+    # ===========================================================
+    # 2️⃣b Batch Shipment Sender
+    # ===========================================================
+    @app.post("/send-shipment-batch")
+    def send_shipment_batch():
+        try:
+            body = request.get_json(silent=True) or {}
+            api_key = request.args.get("api_key") or body.get("api_key")
+            if api_key != BACKUP_TOKEN:
+                return {"ok": False, "error": "Unauthorized"}, 403
+
+            records = body.get("shipments") or []
+            if len(records) > SHIPMENT_BATCH_MAX:
+                return {"ok": False, "error": f"At most {SHIPMENT_BATCH_MAX} shipments per batch"}, 400
+
+            # Validate every record against the template before sending anything.
+            rows, results = [], []
+            for rec in records:
+                to, params, error = _validate_shipment(rec)
+                if error:
+                    results.append({"order_id": rec.get("order_id"), "to": to, "ok": False, "error": error})
+                else:
+                    rows.append({"to": to, "params": params, "ref": params[0]})
+
+            job_id = None
+            if rows:
+                job_id = whatsapp_broadcast.create_job(SHIPMENT_TEMPLATE, "en_US", rows, queued=False)
+                whatsapp_broadcast.run_job(job_id)
+                for r in whatsapp_broadcast.job_recipients(job_id, limit=len(rows)):
+                    results.append({
+                        "order_id": r["ref"],
+                        "to": r["to"],
+                        "ok": r["status"] == "sent",
+                        "message_id": r["message_id"],
+                        "error": r["error"],
+                    })
+
+            sent = sum(1 for r in results if r["ok"])
+            log.info("🚚 Shipment batch", extra={"sent": sent, "total": len(records)})
+            return {
+                "ok": sent == len(records),
+                "job_id": job_id,
+                "total": len(records),
+                "sent": sent,
+                "failed": len(records) - sent,
+                "results": results,
+            }, 200
+
+        except Exception as e:
+            log.exception("❌ send-shipment-batch error")
+            return {"ok": False, "error": str(e)}, 200
+
+
+    # ===========================================================
+    # 3️⃣ Delivery Stats (from status callbacks)
+    # ===========================================================
+    @app.get("/delivery/stats")
+    def delivery_stats():
+        if request.args.get("api_key") != BACKUP_TOKEN:
+            return {"ok": False, "error": "Unauthorized"}, 403
+        days = max(1, min(_int_arg("days", 7), DELIVERY_ROLLUP_RETENTION_DAYS))
+        return {"ok": True, **delivery.report(days, request.args.get("template") or None)}, 200
+
+    @app.get("/delivery/<message_id>")
+    def delivery_message(message_id):
+        if request.args.get("api_key") != BACKUP_TOKEN:
+            return {"ok": False, "error": "Unauthorized"}, 403
+        record = delivery.message(message_id)
+        if not record:
+            return {"ok": False, "error": "Message not found"}, 404
+        return {"ok": True, "message": record}, 200
@@ -0,0 +1,351 @@
+# whatsapp_outbox.py
+import contextvars
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import whatsapp_db
+from whatsapp_delivery import delivery
+from whatsapp_graph import CIRCUIT_OPEN, graph, is_transient
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+log = get_logger("outbox")
+
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12"))
+# Free-form replies are only allowed within 24h of the customer's last message.
+OUTBOX_MAX_AGE = int(os.getenv("OUTBOX_MAX_AGE", str(24 * 3600)))
+OUTBOX_RETENTION_SECONDS = int(os.getenv("OUTBOX_RETENTION_SECONDS", str(3 * 24 * 3600)))
+
+_REPLAY_STATUS = {"sent": 200, "sending": 202, "pending": 202, "dead": 422}
+
+_scope = contextvars.ContextVar("outbox_scope", default=None)
+
+
+def _digest(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:20]
+
+
+class Outbox:
+    """
+    Durable retry queue for Graph API sends.
+
+    deliver() sends straight away; when that fails transiently (network error,
+    5xx, 429 or an open circuit) the payload goes to the outbox table instead
+    of being dropped and deliver() answers 202. A dispatcher thread per worker
+    claims due rows under a lease, resends them once the circuit lets calls
+    through and backs off exponentially between attempts. The lease is
+    renewed (and checked) right before each send and every outcome is only
+    recorded by the lease holder, so a slow batch never overlaps another
+    worker's claim. Messages to one recipient keep their order.
+
+    Every row carries an idempotency key: the caller's, one derived from the
+    inbound message being answered (see scope()) and the payload, or a random
+    one. A key is stored once, so a replayed webhook or a retried API call does
+    not queue the same message twice. A caller's key is reserved (status
+    'sending') before the first send, so of two concurrent calls with one key
+    only the call that inserted the row sends; a send that raises turns the
+    reservation into a pending retry, and one left 'sending' for longer than
+    a lease (worker killed mid-send) is reclaimed by the dispatcher.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._backlog = True  # until the first poll says otherwise
+        self._purged_at = 0.0
+        self.enqueued = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+
+    # ---------- idempotency keys ----------
+    @contextmanager
+    def scope(self, key):
+        """Sends inside the block get keys derived from ``key`` (e.g. the inbound message id)."""
+        token = _scope.set(key)
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+
+    def key_for(self, payload):
+        scope = _scope.get()
+        return f"{scope}:{_digest(payload)}" if scope else uuid.uuid4().hex
+
+    # ---------- lifecycle ----------
+    def start(self):
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # The dispatcher thread does not survive a gunicorn fork.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True).start()
+
+    # ---------- producer ----------
+    def deliver(self, payload, source, key=None):
+        """Sends ``payload`` now or queues it; returns (data, status) like graph.post_message."""
+        self._ensure_started()
+        row_id = None
+        if key is not None:
+            row_id = self._store(payload, source, key, status="sending", reserve=True)
+            if row_id is None:
+                return self._replay(payload, source, key)
+
+        to = payload.get("to")
+        if self._backlog and to and whatsapp_db.fetchone(
+            "SELECT 1 FROM outbox WHERE recipient = ? AND status = 'pending' LIMIT 1", (to,)
+        ):
+            # Earlier messages to this recipient are still waiting; queue behind them.
+            return self._queue(payload, source, key, "queued behind earlier messages", delay=0, row_id=row_id)
+
+        try:
+            data, code = graph.post_message(payload)
+        except Exception as e:
+            # Never leave a reserved key in 'sending': hand the message to the dispatcher.
+            log.exception("❌ Send raised, queueing it", extra={"to": to, "source": source})
+            return self._queue(payload, source, key, str(e), delay=OUTBOX_BACKOFF_BASE, row_id=row_id)
+        if is_transient(code):
+            return self._queue(payload, source, key, data.get("error", data), delay=OUTBOX_BACKOFF_BASE,
+                               row_id=row_id)
+        if code < 400:
+            # Every successful send is recorded here, whichever caller made it.
+            delivery.record_sent(_message_id(data), payload, source)
+        if row_id is not None:
+            if code < 400:
+                whatsapp_db.execute(
+                    "UPDATE outbox SET status = 'sent', message_id = ?, attempts = 1, updated_at = ? WHERE id = ?",
+                    (_message_id(data), time.time(), row_id),
+                )
+            else:
+                # Rejected outright: release the key so the caller can fix the request and retry.
+                whatsapp_db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        return data, code
+
+    def _replay(self, payload, source, key):
+        row = whatsapp_db.fetchone("SELECT status, message_id, last_error FROM outbox WHERE idem_key = ?", (key,))
+        if row is None:
+            # The first call was rejected and released the key in the meantime.
+            return self.deliver(payload, source, key)
+        status, message_id, error = row
+        return ({"duplicate": True, "idempotency_key": key, "outbox_status": status, "error": error,
+                 "messages": [{"id": message_id}] if message_id else []}, _REPLAY_STATUS[status])
+
+    def _queue(self, payload, source, key, error, delay, row_id=None):
+        key = key or self.key_for(payload)
+        if row_id is None:
+            row_id = self._store(payload, source, key, error=error, delay=delay)
+        else:
+            now = time.time()
+            whatsapp_db.execute(
+                "UPDATE outbox SET status = 'pending', last_error = ?, next_attempt_at = ?, updated_at = ? "
+                "WHERE id = ?",
+                (json.dumps(error)[:1000], now + delay, now, row_id),
+            )
+        self._backlog = True
+        if not delay:
+            self._wake.set()
+        with self._lock:
+            self.enqueued += 1
+        log.warning("📮 Send queued in outbox", extra={"to": payload.get("to"), "source": source,
+                                                       "outbox_id": row_id, "error": error})
+        return {"queued": True, "outbox_id": row_id, "idempotency_key": key, "error": error}, 202
+
+    def _store(self, payload, source, key, status="pending", error=None, delay=0.0, reserve=False):
+        """Inserts a row for ``key`` and returns its id; with ``reserve``, None when the key already existed."""
+        now = time.time()
+        cur = whatsapp_db.execute(
+            "INSERT INTO outbox (idem_key, source, recipient, payload, status, last_error, "
+            "created_at, next_attempt_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(idem_key) DO NOTHING",
+            (key, source, payload.get("to"), json.dumps(payload), status,
+             None if error is None else json.dumps(error)[:1000], now, now + delay, now),
+        )
+        if cur.rowcount:
+            return cur.lastrowid
+        if reserve:
+            return None
+        return whatsapp_db.fetchone("SELECT id FROM outbox WHERE idem_key = ?", (key,))[0]
+
+    # ---------- dispatcher ----------
+    def _run(self):
+        while True:
+            busy = False
+            try:
+                busy = self.dispatch()
+                self._purge()
+            except Exception:
+                log.exception("❌ Outbox dispatch failed")
+            if not busy:
+                self._wake.wait(max(OUTBOX_POLL_INTERVAL, graph.breaker.retry_in()))
+                self._wake.clear()
+
+    def _claim(self):
+        token = f"{os.getpid()}-{uuid.uuid4().hex}"
+        now = time.time()
+        with whatsapp_db.transaction() as conn:
+            # A reservation still 'sending' after a lease means its worker died mid-send;
+            # resend it (at least once beats never).
+            conn.execute(
+                "UPDATE outbox SET status = 'pending', next_attempt_at = ?, "
+                "last_error = COALESCE(last_error, '\"interrupted while sending\"') "
+                "WHERE status = 'sending' AND updated_at < ?",
+                (now, now - OUTBOX_LEASE_SECONDS),
+            )
+            conn.execute(
+                """
+                UPDATE outbox SET claimed_by = ?, claimed_until = ? WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                      AND (claimed_until IS NULL OR claimed_until < ?)
+                    ORDER BY id LIMIT ?
+                )
+                """,
+                (token, now + OUTBOX_LEASE_SECONDS, now, now, OUTBOX_BATCH_SIZE),
+            )
+            return token, conn.execute(
+                "SELECT id, source, recipient, payload, attempts, created_at FROM outbox "
+                "WHERE claimed_by = ? ORDER BY id",
+                (token,),
+            ).fetchall()
+
+    def _renew(self, row_id, token):
+        """Extends our lease on one row right before sending it; False when it was lost."""
+        return whatsapp_db.execute(
+            "UPDATE outbox SET claimed_until = ? WHERE id = ? AND claimed_by = ? AND status = 'pending'",
+            (time.time() + OUTBOX_LEASE_SECONDS, row_id, token),
+        ).rowcount == 1
+
+    def dispatch(self):
+        """Sends one batch of due rows; returns True when there was work."""
+        if graph.breaker.retry_in() > 0:
+            return False
+        token, rows = self._claim()
+        if not rows:
+            self._backlog = whatsapp_db.fetchone("SELECT 1 FROM outbox WHERE status = 'pending' LIMIT 1") is not None
+            return False
+
+        held = []
+        blocked = set()
+        for i, (row_id, source, to, payload, attempts, created_at) in enumerate(rows):
+            if to in blocked:
+                held.append(row_id)
+                continue
+            if not self._renew(row_id, token):
+                # The lease ran out and another worker owns the row now; keep order behind it.
+                blocked.add(to)
+                continue
+            payload = json.loads(payload)
+            data, code = graph.post_message(payload)
+            if data.get("error") == CIRCUIT_OPEN:
+                held += [r[0] for r in rows[i:]]
+                break
+            if code < 400:
+                self._finish(row_id, token, "sent", message_id=_message_id(data))
+                delivery.record_sent(_message_id(data), payload, source)
+                with self._lock:
+                    self.delivered += 1
+                log.info("📤 Outbox message delivered", extra={"to": to, "source": source, "outbox_id": row_id,
+                                                              "attempts": attempts + 1,
+                                                              "message_id": _message_id(data)})
+            elif is_transient(code) and attempts + 1 < OUTBOX_MAX_ATTEMPTS \
+                    and time.time() - created_at < OUTBOX_MAX_AGE:
+                blocked.add(to)
+                self._retry(row_id, token, to, attempts + 1, data.get("error", data))
+            else:
+                self._finish(row_id, token, "dead", error=data.get("error", data))
+                with self._lock:
+                    self.dead += 1
+                log.error("❌ Outbox message given up", extra={"to": to, "source": source, "outbox_id": row_id,
+                                                              "attempts": attempts + 1, "status": code,
+                                                              "error": data.get("error", data)})
+        if held:
+            whatsapp_db.execute(
+                f"UPDATE outbox SET claimed_by = NULL, claimed_until = NULL "
+                f"WHERE claimed_by = ? AND id IN ({','.join('?' * len(held))})",
+                [token, *held],
+            )
+        return len(held) < len(rows)
+
+    def _finish(self, row_id, token, status, message_id=None, error=None):
+        whatsapp_db.execute(
+            "UPDATE outbox SET status = ?, message_id = ?, last_error = ?, attempts = attempts + 1, "
+            "updated_at = ?, claimed_by = NULL, claimed_until = NULL WHERE id = ? AND claimed_by = ?",
+            (status, message_id, None if error is None else json.dumps(error)[:1000], time.time(), row_id, token),
+        )
+
+    def _retry(self, row_id, token, to, attempts, error):
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+        due = time.time() + delay * random.uniform(0.5, 1.0)
+        with whatsapp_db.transaction() as conn:
+            if not conn.execute(
+                "UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ?, updated_at = ?, "
+                "claimed_by = NULL, claimed_until = NULL WHERE id = ? AND claimed_by = ?",
+                (attempts, json.dumps(error)[:1000], due, time.time(), row_id, token),
+            ).rowcount:
+                return
+            # Later messages to the same recipient wait for this one.
+            conn.execute(
+                "UPDATE outbox SET next_attempt_at = MAX(next_attempt_at, ?) "
+                "WHERE recipient = ? AND status = 'pending' AND id > ?",
+                (due, to, row_id),
+            )
+        with self._lock:
+            self.retried += 1
+
+    def _purge(self):
+        now = time.time()
+        if now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        removed = whatsapp_db.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND updated_at < ?", (now - OUTBOX_RETENTION_SECONDS,)
+        ).rowcount
+        if removed:
+            log.info("🧹 Purged finished outbox rows", extra={"removed": removed})
+
+    # ---------- counters ----------
+    def backlog(self):
+        """Depth and age of the shared outbox table (all workers)."""
+        rows = whatsapp_db.fetchall("SELECT status, COUNT(*), MIN(created_at) FROM outbox GROUP BY status")
+        by_status = {status: (count, oldest) for status, count, oldest in rows}
+        pending, oldest = by_status.get("pending", (0, None))
+        return {
+            "pending": pending,
+            "dead": by_status.get("dead", (0, None))[0],
+            "oldest_pending_age_seconds": round(time.time() - oldest, 1) if oldest else 0.0,
+        }
+
+    def counters(self):
+        with self._lock:
+            return {"enqueued": self.enqueued, "delivered": self.delivered,
+                    "retried": self.retried, "dead_lettered": self.dead}
+
+    def stats(self):
+        return {**self.counters(), **self.backlog()}
+
+
+def _message_id(data):
+    messages = data.get("messages") or [{}]
+    return messages[0].get("id")
+
+
+outbox = Outbox()
+metrics.register_collector("outbox", outbox.counters, counters=("enqueued", "delivered", "retried", "dead_lettered"))
+metrics.register_shared("outbox", outbox.backlog, gauges=("pending", "dead", "oldest_pending_age_seconds"))
@@ -0,0 +1,283 @@
+# whatsapp_queue.py
+import json
+import os
+import threading
+import time
+import uuid
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+QUEUE_LANES = int(os.getenv("QUEUE_LANES", "8"))
+QUEUE_STALE_SECONDS = int(os.getenv("QUEUE_STALE_SECONDS", "120"))
+# Live workers renew the claim on their jobs this often, well inside the stale window.
+QUEUE_HEARTBEAT_SECONDS = float(os.getenv("QUEUE_HEARTBEAT_SECONDS", str(max(1, QUEUE_STALE_SECONDS // 4))))
+# Idle lanes look for jobs submitted by other workers this often.
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "0.5"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_BACKOFF_BASE = float(os.getenv("QUEUE_BACKOFF_BASE", "5"))
+QUEUE_BACKOFF_MAX = float(os.getenv("QUEUE_BACKOFF_MAX", "600"))
+QUEUE_RETENTION_SECONDS = int(os.getenv("QUEUE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+log = get_logger("queue")
+
+# The oldest pending job whose key has no running job and no older pending job,
+# claimed in one statement so two workers can never take the same key at once.
+_CLAIM = """
+    UPDATE jobs SET status = 'running', owner = ?, claimed_at = ?, attempts = attempts + 1
+    WHERE id = (
+        SELECT j.id FROM jobs j
+        WHERE j.queue = ? AND j.status = 'pending' AND j.run_after <= ?
+          AND NOT EXISTS (
+              SELECT 1 FROM jobs k
+              WHERE k.queue = j.queue AND k.job_key = j.job_key
+                AND (k.status = 'running' OR (k.status = 'pending' AND k.id < j.id))
+          )
+        ORDER BY j.id LIMIT 1
+    )
+    RETURNING id, payload, enqueued_at, attempts
+"""
+
+
+class JobQueue:
+    """
+    Durable job queue backed by the jobs table and shared by every worker.
+
+    submit() only persists the job; lane threads in any worker claim work
+    from SQLite. A job is claimed only when it is the oldest pending job for
+    its key (for the chatbot: the sender's number) and no job for that key
+    is running anywhere, so work for one sender runs in order across all
+    gunicorn workers while different senders run concurrently.
+
+    A job that raises is retried with exponential backoff (holding back
+    later jobs for its key) until ``max_attempts``, then parked as 'failed'
+    for requeue_failed() and purged after QUEUE_RETENTION_SECONDS. A
+    heartbeat thread renews claimed_at on running jobs and releases those
+    whose worker stopped renewing for QUEUE_STALE_SECONDS.
+    """
+
+    def __init__(self, name, handler, lanes=QUEUE_LANES, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.name = name
+        self.handler = handler
+        self.lane_count = max(1, lanes)
+        self.max_attempts = max(1, max_attempts)
+        self._pid = None
+        self._owner = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._purged_at = 0.0
+        self._reset_stats()
+        metrics.register_collector("queue", self.counters, counters=("enqueued", "processed", "failed", "retried"),
+                                   queue=name)
+        metrics.register_shared("queue", self.backlog, gauges=("depth", "running", "dead"), queue=name)
+
+    def _reset_stats(self):
+        self._enqueued = 0
+        self._processed = 0
+        self._failed = 0
+        self._retried = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    # ---------- lifecycle ----------
+    def start(self):
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # Threads do not survive a gunicorn fork, so lanes belong to a pid.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            with self._stats_lock:
+                self._reset_stats()
+            self._owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+            self._pid = os.getpid()
+            for i in range(self.lane_count):
+                threading.Thread(target=self._run_lane, name=f"{self.name}-lane-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat, name=f"{self.name}-heartbeat", daemon=True).start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(QUEUE_HEARTBEAT_SECONDS)
+            try:
+                whatsapp_db.execute(
+                    "UPDATE jobs SET claimed_at = ? WHERE queue = ? AND owner = ? AND status = 'running'",
+                    (time.time(), self.name, self._owner),
+                )
+                self._recover()
+                self._purge()
+            except Exception:
+                log.exception("❌ Queue heartbeat failed", extra={"queue": self.name})
+
+    def _recover(self):
+        """Releases running jobs whose owner stopped renewing them (crashed or restarted worker)."""
+        now = time.time()
+        released = whatsapp_db.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "owner = NULL, claimed_at = ? "
+            "WHERE queue = ? AND status = 'running' AND claimed_at < ?",
+            (self.max_attempts, now, self.name, now - QUEUE_STALE_SECONDS),
+        ).rowcount
+        if released:
+            log.info("♻️ Released stale jobs", extra={"queue": self.name, "jobs": released})
+            self._wake.set()
+
+    def _purge(self):
+        now = time.time()
+        if now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        removed = whatsapp_db.execute(
+            "DELETE FROM jobs WHERE queue = ? AND status = 'failed' AND claimed_at < ?",
+            (self.name, now - QUEUE_RETENTION_SECONDS),
+        ).rowcount
+        if removed:
+            log.info("🧹 Purged failed jobs", extra={"queue": self.name, "removed": removed})
+
+    def requeue_failed(self, prepare=None):
+        """
+        Puts failed jobs back to pending with fresh attempts; returns their payloads.
+        ``prepare(conn, payloads)`` runs in the same transaction, before any
+        lane can claim them, so callers can update their own rows atomically.
+        """
+        self._ensure_started()
+        with whatsapp_db.transaction() as conn:
+            rows = sorted(conn.execute(
+                "UPDATE jobs SET status = 'pending', owner = NULL, attempts = 0, run_after = 0 "
+                "WHERE queue = ? AND status = 'failed' RETURNING id, payload",
+                (self.name,),
+            ).fetchall())
+            payloads = [json.loads(payload) for _, payload in rows]
+            if prepare and payloads:
+                prepare(conn, payloads)
+        if payloads:
+            self._wake.set()
+        return payloads
+
+    # ---------- producer ----------
+    def submit(self, key, payload):
+        """Persists a job; a lane in this or any other worker picks it up."""
+        self._ensure_started()
+        now = time.time()
+        cur = whatsapp_db.execute(
+            "INSERT INTO jobs (queue, job_key, payload, status, enqueued_at, claimed_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?)",
+            (self.name, str(key), json.dumps(payload), now, now),
+        )
+        with self._stats_lock:
+            self._enqueued += 1
+        self._wake.set()
+        return cur.lastrowid
+
+    # ---------- consumer ----------
+    def _claim(self):
+        now = time.time()
+        # Idle lanes only read (WAL readers never block); the write lock is taken when there is work.
+        if not whatsapp_db.fetchone(
+            "SELECT 1 FROM jobs WHERE queue = ? AND status = 'pending' AND run_after <= ? LIMIT 1",
+            (self.name, now),
+        ):
+            return None
+        with whatsapp_db.transaction() as conn:
+            return conn.execute(_CLAIM, (self._owner, now, self.name, now)).fetchone()
+
+    def _run_lane(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception:
+                log.exception("❌ Job claim failed", extra={"queue": self.name})
+                job = None
+            if job is None:
+                self._wake.wait(QUEUE_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            # There may be more work for the other lanes.
+            self._wake.set()
+            self._run(*job)
+
+    def _run(self, job_id, payload, enqueued_at, attempts):
+        started = time.time()
+        ok = True
+        try:
+            self.handler(json.loads(payload))
+        except Exception:
+            ok = False
+            log.exception("❌ Job failed", extra={"queue": self.name, "job_id": job_id, "attempt": attempts})
+        finished = time.time()
+
+        retry = not ok and attempts < self.max_attempts
+        try:
+            if ok:
+                whatsapp_db.execute("DELETE FROM jobs WHERE id = ? AND owner = ?", (job_id, self._owner))
+            else:
+                delay = min(QUEUE_BACKOFF_BASE * 2 ** (attempts - 1), QUEUE_BACKOFF_MAX)
+                whatsapp_db.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL, run_after = ?, claimed_at = ? "
+                    "WHERE id = ? AND owner = ?",
+                    ("pending" if retry else "failed", finished + delay, finished, job_id, self._owner),
+                )
+        except Exception:
+            log.exception("❌ Job bookkeeping failed", extra={"queue": self.name, "job_id": job_id})
+
+        wait, run = started - enqueued_at, finished - started
+        with self._stats_lock:
+            self._processed += 1
+            if not ok:
+                self._failed += 1
+            if retry:
+                self._retried += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._run_total += run
+            self._run_max = max(self._run_max, run)
+        metrics.observe("queue_wait_seconds", wait, queue=self.name)
+        metrics.observe("queue_run_seconds", run, queue=self.name)
+
+    def join(self, timeout=None):
+        """Blocks until no job is pending or running in any worker (tests / benchmarks)."""
+        deadline = None if timeout is None else time.time() + timeout
+        while whatsapp_db.fetchone(
+            "SELECT 1 FROM jobs WHERE queue = ? AND status IN ('pending', 'running') LIMIT 1", (self.name,)
+        ):
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.02)
+        return True
+
+    # ---------- counters ----------
+    def backlog(self):
+        """Depth of the shared jobs table for this queue (all workers)."""
+        rows = whatsapp_db.fetchall(
+            "SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status", (self.name,)
+        )
+        by_status = dict(rows)
+        return {
+            "depth": by_status.get("pending", 0) + by_status.get("running", 0),
+            "running": by_status.get("running", 0),
+            "dead": by_status.get("failed", 0),
+        }
+
+    def counters(self):
+        """What this worker has run (summed across workers by the metrics flusher)."""
+        with self._stats_lock:
+            done = self._processed or 1
+            return {
+                "enqueued": self._enqueued,
+                "processed": self._processed,
+                "failed": self._failed,
+                "retried": self._retried,
+                "wait_avg_ms": round(self._wait_total / done * 1000, 2),
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+                "run_avg_ms": round(self._run_total / done * 1000, 2),
+                "run_max_ms": round(self._run_max * 1000, 2),
+            }
+
+    def stats(self):
+        return {**self.counters(), **self.backlog()}
@@ -0,0 +1,118 @@
+# whatsapp_ratelimit.py
+import os
+import threading
+import time
+
+import whatsapp_db
+from whatsapp_metrics import metrics
+
+# Cloud API defaults: 80 msg/s per business number, and a per-user pair
+# limit of roughly one message every 6 seconds with short bursts allowed.
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "80"))
+RATE_GLOBAL_BURST = float(os.getenv("RATE_GLOBAL_BURST", "80"))
+RATE_RECIPIENT_PER_SEC = float(os.getenv("RATE_RECIPIENT_PER_SEC", str(1 / 6)))
+RATE_RECIPIENT_BURST = float(os.getenv("RATE_RECIPIENT_BURST", "45"))
+RATE_MAX_WAIT = float(os.getenv("RATE_MAX_WAIT", "60"))
+RATE_SWEEP_INTERVAL = float(os.getenv("RATE_SWEEP_INTERVAL", "600"))
+
+
+class RateLimiter:
+    """
+    Token buckets stored in the rate_buckets table so every gunicorn worker
+    draws from the same budget.
+
+    acquire() reserves a token from the global bucket and the recipient's
+    bucket in one IMMEDIATE transaction. When a bucket is empty the token is
+    still reserved (the balance goes negative) and the caller is told how long
+    to wait, so bursts are queued and released smoothly instead of hitting 429.
+    """
+
+    def __init__(self, global_rate=RATE_GLOBAL_PER_SEC, global_burst=RATE_GLOBAL_BURST,
+                 recipient_rate=RATE_RECIPIENT_PER_SEC, recipient_burst=RATE_RECIPIENT_BURST,
+                 max_wait=RATE_MAX_WAIT):
+        self.buckets = {"global": (global_rate, global_burst)}
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._swept_at = 0.0
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_total = 0.0
+
+    def _reserve(self, conn, key, rate, burst, now):
+        row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        if tokens - 1 < -rate * self.max_wait:
+            # Too far behind already: do not reserve, just report the wait.
+            return (1 - tokens) / rate, False
+        tokens -= 1
+        conn.execute("REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now))
+        return (max(0.0, -tokens / rate) if rate else 0.0), True
+
+    def reserve(self, recipient=None):
+        """Reserves a send slot and returns the seconds to wait before sending."""
+        now = time.time()
+        buckets = dict(self.buckets)
+        if recipient:
+            buckets[f"to:{recipient}"] = (self.recipient_rate, self.recipient_burst)
+
+        conn = whatsapp_db.get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            wait = 0.0
+            for key, (rate, burst) in buckets.items():
+                if rate <= 0:
+                    continue
+                bucket_wait, reserved = self._reserve(conn, key, rate, burst, now)
+                if not reserved:
+                    conn.rollback()
+                    return bucket_wait, False
+                wait = max(wait, bucket_wait)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._maybe_sweep(now)
+        return wait, True
+
+    def acquire(self, recipient=None):
+        """Blocks until a send to ``recipient`` fits both budgets."""
+        waited = 0.0
+        while True:
+            wait, reserved = self.reserve(recipient)
+            if reserved:
+                break
+            time.sleep(min(wait, self.max_wait))
+            waited += min(wait, self.max_wait)
+        if wait > 0:
+            time.sleep(wait)
+            waited += wait
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.delayed += 1
+                self.wait_total += waited
+        return waited
+
+    def _maybe_sweep(self, now):
+        if now - self._swept_at < RATE_SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        # A bucket idle long enough to refill completely carries no state.
+        idle = self.recipient_burst / self.recipient_rate if self.recipient_rate else 0
+        whatsapp_db.execute(
+            "DELETE FROM rate_buckets WHERE key LIKE 'to:%' AND updated_at < ?", (now - idle,)
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "delayed": self.delayed,
+                "wait_total_s": round(self.wait_total, 3),
+            }
+
+
+limiter = RateLimiter()
+metrics.register_collector("rate_limit", limiter.stats, counters=("acquired", "delayed", "wait_total_s"))
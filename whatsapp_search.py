@@ -0,0 +1,66 @@
+# whatsapp_search.py
+import difflib
+import re
+
+import whatsapp_db
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def fts_available():
+    return whatsapp_db.fetchone("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'") is not None
+
+
+def fts_query(text, column=None):
+    """Turns free text into an FTS5 prefix query: every word must match a token prefix."""
+    terms = _TOKEN.findall(text.lower())
+    prefix = f"{column}:" if column else ""
+    return " ".join(f'{prefix}"{t}"*' for t in terms)
+
+
+def search_products(text, limit=None, offset=0):
+    """Ranked product search for the admin dashboard; LIKE scan if FTS5 is missing."""
+    query = fts_query(text)
+    if not query:
+        return []
+    limit_sql = " LIMIT ? OFFSET ?" if limit else ""
+    extra = (limit, offset) if limit else ()
+
+    if fts_available():
+        return whatsapp_db.fetchall(f"""
+            SELECT p.* FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+            ORDER BY bm25(products_fts, 10.0, 2.0, 1.0, 2.0)
+            {limit_sql}
+        """, (query,) + extra)
+
+    like = f"%{text}%"
+    return whatsapp_db.fetchall(f"""
+        SELECT * FROM products WHERE
+        main_product LIKE ? OR
+        option LIKE ? OR
+        description LIKE ? OR
+        category LIKE ?
+        {limit_sql}
+    """, (like,) * 4 + extra)
+
+
+def suggest_articles(article, limit=3):
+    """
+    Close article numbers for a mistyped lookup: candidates sharing a short
+    prefix come from the FTS index, then difflib ranks them by similarity.
+    """
+    article = article.strip().lower()
+    if not article or not fts_available():
+        return []
+    query = fts_query(article[:2], column="main_product")
+    if not query:
+        return []
+    candidates = [row[0] for row in whatsapp_db.fetchall(f"""
+        SELECT DISTINCT p.main_product FROM products_fts
+        JOIN products p ON p.id = products_fts.rowid
+        WHERE products_fts MATCH ?
+        LIMIT 500
+    """, (query,))]
+    return difflib.get_close_matches(article, candidates, n=limit, cutoff=0.6)
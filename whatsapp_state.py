@@ -0,0 +1,202 @@
+# whatsapp_state.py
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import whatsapp_db
+from whatsapp_logging import get_logger
+from whatsapp_metrics import metrics
+
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", "600"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+# The cache only saves work in exclusive mode, and that mode is only safe when a
+# single worker process serves every sender (gunicorn -w 1): hits are then
+# trusted without asking SQLite and writes are batched. The default (0) still
+# does one SQLite read per lookup and one write per change, i.e. it is about as
+# costly as having no cache, but stays correct with several workers. See README.md.
+STATE_CACHE_EXCLUSIVE = os.getenv("STATE_CACHE_EXCLUSIVE", "0") == "1"
+
+log = get_logger("state")
+
+_DELETED = object()
+
+_UPSERT = (
+    "INSERT INTO user_state (user_id, state, last_updated) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, last_updated = excluded.last_updated, "
+    "version = user_state.version + 1"
+)
+
+
+class StateCache:
+    """
+    Bounded LRU + TTL cache in front of the user_state table.
+
+    Meta does not pin a sender to one gunicorn worker, so by default the
+    table is the source of truth: set() and clear() write through, every
+    write bumps the row's version, and a cache hit is only served after a
+    primary-key lookup of that version shows no other worker has moved the
+    conversation on (a stale entry is re-read). With ``exclusive`` (one
+    worker owns every sender, see STATE_CACHE_EXCLUSIVE) hits skip SQLite
+    entirely and writes are coalesced into one transaction by a background
+    flusher instead. Either way a sweeper evicts expired entries (and their
+    rows) instead of the request path doing it.
+    """
+
+    def __init__(self, ttl=STATE_TTL_SECONDS, max_entries=STATE_CACHE_SIZE,
+                 flush_interval=STATE_FLUSH_INTERVAL, sweep_interval=STATE_SWEEP_INTERVAL,
+                 exclusive=STATE_CACHE_EXCLUSIVE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.exclusive = exclusive
+        self._entries = OrderedDict()   # user_id -> (state, last_updated, version)
+        self._dirty = {}                # user_id -> (state | _DELETED, last_updated, version); exclusive only
+        self._lock = threading.Lock()
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    # ---------- background writer / sweeper ----------
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="state-flusher", daemon=True).start()
+
+    def _run(self):
+        last_sweep = time.time()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_sweep >= self.sweep_interval:
+                    self.sweep()
+                    last_sweep = time.time()
+            except Exception:
+                log.exception("❌ State flush failed")
+
+    def flush(self):
+        """Writes all pending changes in a single transaction."""
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        if not pending:
+            return 0
+        upserts = [(uid, state, ts) for uid, (state, ts, _) in pending.items() if state is not _DELETED]
+        deletes = [(uid,) for uid, (state, _, _) in pending.items() if state is _DELETED]
+        try:
+            with whatsapp_db.transaction() as conn:
+                if upserts:
+                    conn.executemany(_UPSERT, upserts)
+                if deletes:
+                    conn.executemany("DELETE FROM user_state WHERE user_id = ?", deletes)
+        except Exception:
+            # Put the batch back unless a newer write superseded it.
+            with self._lock:
+                for uid, value in pending.items():
+                    self._dirty.setdefault(uid, value)
+            raise
+        return len(pending)
+
+    def sweep(self):
+        """Evicts expired conversations from memory and from the table."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [uid for uid, (_, ts, _) in self._entries.items() if ts < cutoff]
+            for uid in expired:
+                del self._entries[uid]
+        whatsapp_db.execute("DELETE FROM user_state WHERE last_updated < ?", (int(cutoff),))
+        return len(expired)
+
+    # ---------- public API ----------
+    def get(self, user_id):
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is None and user_id in self._dirty:
+                cached = self._dirty[user_id]
+        if cached is not None and not self.exclusive:
+            row = whatsapp_db.fetchone("SELECT version FROM user_state WHERE user_id = ?", (user_id,))
+            if row is None or row[0] != cached[2]:
+                # Another worker wrote (or cleared) this conversation since we cached it.
+                cached = None
+                with self._lock:
+                    self.stale += 1
+                    self._entries.pop(user_id, None)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+                if user_id in self._entries:
+                    self._entries.move_to_end(user_id)
+            state, ts, _ = cached
+            if state is _DELETED or now - ts > self.ttl:
+                return None
+            return state
+
+        with self._lock:
+            self.misses += 1
+        row = whatsapp_db.fetchone(
+            "SELECT state, last_updated, version FROM user_state WHERE user_id = ?", (user_id,)
+        )
+        if not row or now - int(row[1]) > self.ttl:
+            return None
+        with self._lock:
+            if user_id not in self._dirty and user_id not in self._entries:
+                self._remember(user_id, (row[0], int(row[1]), row[2]))
+        return row[0]
+
+    def set(self, user_id, state):
+        self._ensure_started()
+        ts = int(time.time())
+        if self.exclusive:
+            with self._lock:
+                self._remember(user_id, (state, ts, None))
+                self._dirty[user_id] = (state, ts, None)
+            return
+        with whatsapp_db.transaction() as conn:
+            version = conn.execute(_UPSERT + " RETURNING version", (user_id, state, ts)).fetchone()[0]
+        with self._lock:
+            self._remember(user_id, (state, ts, version))
+
+    def clear(self, user_id):
+        self._ensure_started()
+        with self._lock:
+            self._entries.pop(user_id, None)
+            if self.exclusive:
+                self._dirty[user_id] = (_DELETED, 0, None)
+                return
+        whatsapp_db.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    def _remember(self, user_id, value):
+        self._entries[user_id] = value
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            # Evicted entries that are still dirty stay in _dirty until flushed.
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+state_cache = StateCache()
+atexit.register(state_cache.flush)
+metrics.register_collector("state_cache", state_cache.stats, counters=("hits", "misses", "stale"),
+                           gauges=("size", "dirty"))